@@ -0,0 +1,428 @@
+import atexit
+import json
+import os
+import threading
+import time
+import weakref
+from datetime import datetime, timezone
+from typing import Optional
+
+import flask
+
+from alpha_store.models import db, SalesRecord
+from alpha_store.transactions import after_commit
+
+# fcntl is only available on POSIX. Without it, the spill files of other processes can't be told
+# from the ones of dead processes, so every spill file found is replayed (a single process is assumed)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class SalesIngestor:
+
+    """
+    Write-behind queue for the ``SalesRecord`` rows, so the checkout doesn't pay for the analytics writes
+
+    The sales recorded by a transaction are only enqueued when it commits (a rolled back checkout never
+    reaches the analytics) and a background worker inserts them in batches, when ``batch_size`` sales are
+    waiting or every ``flush_interval`` seconds.
+
+    Every enqueued sale is appended to the spill file too, and the file is rewritten with the remaining sales
+    after each flush, so the sales that were not flushed yet are loaded again when the process restarts.
+    If the process dies between a flush and the rewrite of the file, that batch is inserted again:
+    the delivery is at least once. The sales are only spilled when they are enqueued, right after the commit
+    of the checkout (a rolled back checkout must not be spilled): a crash between the commit and the
+    ``after_commit`` callback loses them. That window only runs in-memory work, it has no I/O.
+
+    Each process has its own spill file, ``<spill_file>.<pid>``, guarded by an exclusive ``flock`` on
+    ``<spill_file>.<pid>.lock`` held while the process lives. A process only replays the files whose lock it can
+    take, the ones left by dead processes (and ``<spill_file>`` itself, written by older versions), so the
+    workers of a WSGI server never rewrite or replay the sales of each other. The files of dead processes
+    are claimed when the ingestor is created and when its worker starts.
+
+    With ``sync=True`` (always used in test mode) there is no queue: the sales are inserted in the session
+    of the caller, in the same transaction of the checkout.
+    """
+
+    def __init__(self, app: flask.Flask, sync: bool = False, batch_size: int = 500, flush_interval: float = 2,
+                 spill_file: Optional[str] = None, fsync: bool = False) -> None:
+        self.app = app
+        self.sync = sync
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_file = spill_file
+        self.fsync = fsync
+
+        self._spill_lock = None
+        self._reset()
+
+        if not sync:
+            # The forked processes (WSGI workers) must not flush the sales inherited from the parent,
+            # the parent keeps them in its own spill file
+            reference = weakref.ref(self)
+            if hasattr(os, "register_at_fork"):
+                os.register_at_fork(after_in_child=lambda: (ingestor := reference()) and ingestor._after_fork())
+
+            if spill_file:
+                self._lock_spill_file()
+                self._claim_spill_files(own=True)
+
+    def _reset(self) -> None:
+        """Set the queue state of a new process"""
+
+        self._pid = os.getpid()
+        self._pending = []
+        self._spill = None
+        self._worker = None
+        self._stopping = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+
+        self.enqueued = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.replayed = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def _after_fork(self) -> None:
+
+        # The copies of the parent files are closed, the parent keeps its own (and its lock)
+        for file in (self._spill, self._spill_lock):
+            if file is not None:
+                file.close()
+        self._spill_lock = None
+
+        self._reset()
+        if self.spill_file:
+            self._lock_spill_file()
+            self._claim_spill_files(own=True)
+
+    @property
+    def spill_path(self) -> Optional[str]:
+        """The spill file of the current process"""
+        return f"{self.spill_file}.{self._pid}" if self.spill_file else None
+
+    def _lock_spill_file(self) -> None:
+        """Take the lock of the spill file of the current process, it's held until ``close``"""
+
+        if fcntl is None:
+            return
+
+        self._spill_lock = open(f"{self.spill_path}.lock", "w", encoding="utf-8")
+        fcntl.flock(self._spill_lock, fcntl.LOCK_EX)
+
+    def _orphan_spill_files(self) -> list:
+        """
+        Return ``(path, lock)`` of the spill files whose owner isn't running, with their lock taken
+        (``lock`` is ``None`` for the spill file of older versions, which is claimed by renaming it)
+        """
+
+        directory = os.path.dirname(self.spill_file) or "."
+        base = os.path.basename(self.spill_file)
+        orphans = []
+
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+
+            if name == base:
+                orphans.append((path, None))
+                continue
+
+            # Only ``<spill_file>.<pid>`` of other processes, the own file is replayed first
+            pid = name[len(base) + 1:] if name.startswith(f"{base}.") else ""
+            if not pid.isdigit() or int(pid) == self._pid:
+                continue
+
+            if fcntl is None:
+                orphans.append((path, None))
+                continue
+
+            lock = open(f"{path}.lock", "a", encoding="utf-8")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # The owner is alive
+                lock.close()
+                continue
+            orphans.append((path, lock))
+
+        return orphans
+
+    def _claim_spill_files(self, own: bool = False) -> None:
+        """
+        Load the sales left in the spill files of dead processes. With ``own``, that must only be used right after
+        the lock is taken, the sales left in the own spill file by a previous process with the same pid are loaded too.
+        They are written to the own spill file before the claimed files are removed, a crash in between
+        replays them twice, like the rest of the at least once delivery
+        """
+
+        with self._lock:
+            loaded = 0
+            claimed = []
+
+            own_file = [(self.spill_path, None)] if own else []
+            for path, lock in [*own_file, *self._orphan_spill_files()]:
+                if lock is None and path != self.spill_path:
+                    # Claim the file of older versions atomically, the other processes get FileNotFoundError
+                    claimed_path = f"{path}.claimed-{self._pid}"
+                    try:
+                        os.rename(path, claimed_path)
+                    except FileNotFoundError:
+                        continue
+                    path = claimed_path
+
+                try:
+                    with open(path, "r", encoding="utf-8") as file:
+                        sales = [sale for sale in map(self._load_line, file) if sale is not None]
+                except FileNotFoundError:
+                    sales = []
+
+                self._pending.extend(sales)
+                loaded += len(sales)
+                if path != self.spill_path:
+                    claimed.append((path, lock))
+
+            if loaded or claimed:
+                self._rewrite_spill_file()
+
+            for path, lock in claimed:
+                for claimed_file in (path, f"{path}.lock"):
+                    try:
+                        os.remove(claimed_file)
+                    except FileNotFoundError:
+                        pass
+                if lock is not None:
+                    lock.close()
+
+            self.replayed += loaded
+
+        if loaded:
+            self.app.logger.warning(f"{loaded} sales loaded from the spill files of {self.spill_file}")
+            self._ensure_worker()
+
+    @staticmethod
+    def _load_line(line: str) -> Optional[dict]:
+        try:
+            return json.loads(line)
+        except ValueError:
+            # A line cut by a crash in the middle of the write
+            return None
+
+    def record(self, sales: list) -> None:
+        """
+        Record the sales of the current transaction, a list of dicts with the ``SalesRecord`` columns
+        They are enqueued when the transaction of ``db.session`` commits
+        """
+
+        if not sales:
+            return
+
+        # The sale date is the checkout date, not the flush date, and both modes use the same clock.
+        # The column has no timezone, so the database converts the UTC time to its session timezone,
+        # like it does for the ``now()`` default of the other tables
+        sale_date = datetime.now(timezone.utc)
+
+        if self.sync:
+            db.session.execute(SalesRecord.__table__.insert(), [{**sale, "sale_date": sale_date} for sale in sales])
+            return
+
+        # The sales belong to the current transaction, so it's started here if it wasn't yet
+        session = db.session()
+        if not session.in_transaction():
+            session.begin()
+
+        after_commit(session, self.enqueue, [{**sale, "sale_date": sale_date.isoformat()} for sale in sales])
+
+    def enqueue(self, sales: list) -> None:
+
+        with self._lock:
+            if self.spill_file:
+                if self._spill is None:
+                    self._spill = open(self.spill_path, "a", encoding="utf-8")
+                self._spill.writelines(json.dumps(sale) + "\n" for sale in sales)
+                self._spill.flush()
+                if self.fsync:
+                    os.fsync(self._spill.fileno())
+
+            self._pending.extend(sales)
+            self.enqueued += len(sales)
+
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.notify()
+
+        self._ensure_worker()
+
+    def _ensure_worker(self) -> None:
+        """
+        The worker is started on first use, not on ``configure``, so it also runs in
+        the processes forked by a WSGI server after the app was created
+        """
+
+        if self._worker is not None and self._worker.is_alive():
+            return
+
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._stopping = False
+                self._worker = threading.Thread(target=self._run, name="sales-ingestor", daemon=True)
+                self._worker.start()
+
+    def _run(self) -> None:
+
+        if self.spill_file:
+            try:
+                self._claim_spill_files()
+            except OSError as error:
+                self.app.logger.error(f"Failed to claim the spill files of {self.spill_file}: {error}")
+
+        failures = 0
+        while True:
+            with self._lock:
+                # After a failure, wait longer before trying again (up to 1 minute)
+                timeout = min(self.flush_interval * 2 ** failures, 60)
+                if not self._stopping and len(self._pending) < self.batch_size:
+                    self._wakeup.wait(timeout)
+                if self._stopping:
+                    return
+
+            if self.flush():
+                failures = 0
+            else:
+                failures += 1
+
+    def flush(self) -> bool:
+        """Insert the waiting sales, a batch at a time. Return ``False`` if a batch failed"""
+
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = self._pending[:self.batch_size]
+                if not batch:
+                    return True
+
+                started = time.perf_counter()
+                try:
+                    with self.app.app_context():
+                        with db.engine.begin() as connection:
+                            # Sales spilled before the ``quantity`` column existed are single units
+                            connection.execute(SalesRecord.__table__.insert(), [
+                                {"quantity": 1, **sale, "sale_date": datetime.fromisoformat(sale["sale_date"])}
+                                for sale in batch])
+                except Exception as error:
+                    self.failed_flushes += 1
+                    self.app.logger.error(f"Failed to flush {len(batch)} sales: {error}")
+                    return False
+
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    # New sales are only appended, so the batch is still the head of the list
+                    del self._pending[:len(batch)]
+                    self._rewrite_spill_file()
+
+                    self.flushed += len(batch)
+                    self.flushes += 1
+                    self.last_flush_seconds = elapsed
+                    self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+                    self.total_flush_seconds += elapsed
+
+    def _rewrite_spill_file(self) -> None:
+        """Replace the spill file with the sales that are still waiting, must be called holding the lock"""
+
+        if not self.spill_file:
+            return
+
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+        temporary = f"{self.spill_path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.writelines(json.dumps(sale) + "\n" for sale in self._pending)
+            file.flush()
+            if self.fsync:
+                os.fsync(file.fileno())
+        os.replace(temporary, self.spill_path)
+
+    def close(self) -> None:
+        """
+        Stop the worker and flush what is still waiting, the spill file keeps anything that fails
+        Its lock is released, so the sales left in it can be claimed by another process.
+        When everything was flushed, the spill file and its lock are removed
+        """
+
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify()
+        if self._worker is not None:
+            self._worker.join()
+        self.flush()
+
+        with self._lock:
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+
+            if self.spill_file and not self._pending:
+                for path in (self.spill_path, f"{self.spill_path}.lock"):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+            if self._spill_lock is not None:
+                self._spill_lock.close()
+                self._spill_lock = None
+
+    def stats(self) -> dict:
+
+        with self._lock:
+            oldest = self._pending[0]["sale_date"] if self._pending else None
+            return {
+                "mode": "sync" if self.sync else "async",
+                "queue_depth": len(self._pending),
+                "oldest_sale_date": oldest,
+                "enqueued": self.enqueued,
+                "flushed": self.flushed,
+                "replayed": self.replayed,
+                "flushes": self.flushes,
+                "failed_flushes": self.failed_flushes,
+                "last_flush_ms": round(self.last_flush_seconds * 1000, 3),
+                "max_flush_ms": round(self.max_flush_seconds * 1000, 3),
+                "avg_flush_ms": round(self.total_flush_seconds / self.flushes * 1000, 3) if self.flushes else 0,
+                "worker_alive": self._worker is not None and self._worker.is_alive()
+            }
+
+
+def configure(app: flask.Flask) -> None:
+    """Create ``app.sales_ingestor``, using the ``ANALYTICS`` section of config file"""
+
+    cfg = app.config["cfg"]
+
+    sync = app.testing or cfg.get("ANALYTICS", "ingest_mode", fallback="async") == "sync"
+
+    # The spill files go to ``ingest_spill_dir``, or to the app instance folder when it isn't set
+    spill_file = cfg.get("ANALYTICS", "ingest_spill_file", fallback=None) or None
+    if spill_file and not sync:
+        spill_dir = cfg.get("ANALYTICS", "ingest_spill_dir", fallback=None) or app.instance_path
+        os.makedirs(spill_dir, exist_ok=True)
+        spill_file = os.path.join(spill_dir, spill_file)
+
+    app.sales_ingestor = SalesIngestor(
+        app,
+        sync=sync,
+        batch_size=cfg.getint("ANALYTICS", "ingest_batch_size", fallback=500),
+        flush_interval=cfg.getfloat("ANALYTICS", "ingest_flush_interval", fallback=2),
+        spill_file=spill_file,
+        fsync=cfg.getboolean("ANALYTICS", "ingest_fsync", fallback=False)
+    )
+
+    if not sync:
+        atexit.register(app.sales_ingestor.close)
+
+    app.logger.info(f"Sales ingestion configured ({'sync' if sync else 'async'})")
@@ -0,0 +1,94 @@
+from io import BytesIO
+
+from matplotlib.figure import Figure
+
+from alpha_store.models import db, SalesRecord, SalesDailyCategory, SalesDailyProduct, SalesRollupState
+from alpha_store.analytics.rollup import ROLLUP_STATE, sale_day
+
+# Number of products in the best sellers chart
+TOP_PRODUCTS = 10
+
+
+def sales_aggregates() -> dict:
+    """
+    Compute the data of the sales report from the rollup tables (see ``alpha_store.analytics.rollup``)
+    plus the sales not compacted yet (after the high-water mark), aggregated on the fly without any lock.
+    Each query reads the rollups, the mark and the new sales in a single statement (a single snapshot),
+    so a compaction committed meanwhile can't count the same sales twice:
+    - ``revenue_by_day``: list of ``(day, revenue)``, ordered by day
+    - ``revenue_by_category``: list of ``(category, revenue)``, ordered by category
+    - ``top_products``: list of ``(product_id, units sold)``, the ``TOP_PRODUCTS`` best sellers
+    """
+
+    last_id = db.select(SalesRollupState.last_id).where(SalesRollupState.name == ROLLUP_STATE).scalar_subquery()
+    new_sales = SalesRecord.id > db.func.coalesce(last_id, 0)
+
+    day = sale_day()
+    new_revenue = db.func.sum(SalesRecord.product_price * SalesRecord.quantity)
+    new_units = db.cast(db.func.sum(SalesRecord.quantity), db.Integer)
+
+    # The sales without category are stored with an empty one
+    new_category = db.func.coalesce(SalesRecord.product_category, "")
+    by_category = db.union_all(
+        db.select(SalesDailyCategory.day, SalesDailyCategory.category, SalesDailyCategory.revenue),
+        db.select(day, new_category, new_revenue).where(new_sales).group_by(day, new_category)
+    ).subquery()
+
+    by_product = db.union_all(
+        db.select(SalesDailyProduct.product_id, SalesDailyProduct.units),
+        db.select(SalesRecord.product_id, new_units).where(new_sales).group_by(SalesRecord.product_id)
+    ).subquery()
+
+    revenue = db.func.sum(by_category.c.revenue).label("revenue")
+    category = db.func.nullif(by_category.c.category, "").label("category")
+    units = db.func.sum(by_product.c.units).label("units")
+
+    revenue_by_day = db.session.execute(db.select(by_category.c.day, revenue).group_by(
+        by_category.c.day).order_by(by_category.c.day)).all()
+
+    revenue_by_category = db.session.execute(db.select(category, revenue).group_by(
+        by_category.c.category).order_by(by_category.c.category)).all()
+
+    top_products = db.session.execute(db.select(by_product.c.product_id, units).group_by(
+        by_product.c.product_id).order_by(units.desc(), by_product.c.product_id).limit(TOP_PRODUCTS)).all()
+
+    return {
+        "revenue_by_day": [tuple(row) for row in revenue_by_day],
+        "revenue_by_category": [tuple(row) for row in revenue_by_category],
+        "top_products": [tuple(row) for row in top_products]
+    }
+
+
+def render_report(aggregates: dict) -> bytes:
+    """
+    Draw the three charts of the sales report and return the PNG
+    A ``Figure`` is used directly instead of ``pyplot``, so no figure is kept in the pyplot registry
+    (it's freed with the function) and concurrent requests don't share the pyplot current figure
+    """
+
+    fig = Figure(figsize=(10, 10))
+    axs = fig.subplots(3, 1)
+
+    # Sales by day
+    days = [day for day, _ in aggregates["revenue_by_day"]]
+    axs[0].plot(days, [revenue for _, revenue in aggregates["revenue_by_day"]], "o-", label="Sale by time")
+    axs[0].set_title("Sales history")
+    axs[0].set_xlabel("Sale date")
+    axs[0].set_ylabel("Sale value")
+
+    # Sales by category
+    axs[1].bar([str(category) for category, _ in aggregates["revenue_by_category"]],
+               [revenue for _, revenue in aggregates["revenue_by_category"]])
+    axs[1].set_title("Sales revenue by category")
+
+    # Best selling games
+    axs[2].bar([str(product_id) for product_id, _ in aggregates["top_products"]],
+               [units for _, units in aggregates["top_products"]])
+    axs[2].set_title("best selling games")
+
+    fig.tight_layout()
+    fig.suptitle("Sales report", fontsize=16, y=1.05)
+
+    image = BytesIO()
+    fig.savefig(image, format="png")
+    return image.getvalue()
@@ -0,0 +1,170 @@
+import atexit
+import threading
+import time
+
+import flask
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+
+from alpha_store.models import db, SalesRecord, SalesDailyCategory, SalesDailyProduct, SalesRollupState
+
+# Name of the high-water mark row in ``sales_rollup_state``
+ROLLUP_STATE = "sales_daily"
+
+
+def sale_day():
+    """``date()`` truncates the timestamp to its day"""
+    return db.func.date(SalesRecord.sale_date, type_=db.Date)
+
+
+def _upsert(table, keys: list, select):
+    """``INSERT ... SELECT`` that adds the revenue and units to the rows that already exist"""
+
+    statement = postgresql.insert(table).from_select([*keys, "revenue", "units"], select)
+    return statement.on_conflict_do_update(
+        index_elements=keys,
+        set_={
+            "revenue": table.c.revenue + statement.excluded.revenue,
+            "units": table.c.units + statement.excluded.units
+        }
+    )
+
+
+class SalesRollup:
+
+    """
+    Keep the ``sales_daily_category`` and ``sales_daily_product`` rollups up to date with ``sales_record``
+
+    ``sales_rollup_state`` stores the last ``sales_record.id`` already added to the rollups. Each compaction
+    aggregates only the sales after it (a range scan on the primary key) and adds them to the rollups with
+    an upsert, then moves the mark, all in one transaction: a failed compaction leaves both untouched.
+
+    The ids are given on insert but the rows are visible on commit, so a transaction still inserting sales
+    could commit an id below the new mark. So the compaction locks ``sales_record`` in ``SHARE`` mode:
+    it waits for the transactions inserting sales and blocks new inserts until it commits, which is
+    short since only the new sales are aggregated. The state row is locked too, so the compactions of
+    several workers don't add the same sales twice.
+
+    Only the background worker compacts, every ``interval`` seconds (not in test mode). The report never does,
+    it adds the sales after the mark with a GROUP BY that doesn't take any lock (see ``sales_aggregates``).
+    """
+
+    def __init__(self, app: flask.Flask, interval: float = 60) -> None:
+        self.app = app
+        self.interval = interval
+
+        self._worker = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+        self.last_id = 0
+        self.compactions = 0
+        self.compacted = 0
+        self.failed_compactions = 0
+        self.last_compaction_seconds = 0.0
+        self.max_compaction_seconds = 0.0
+
+        self._ensure_worker()
+
+    def _ensure_worker(self) -> None:
+        """Like the sales ingestor, the worker is started on first use, so it also runs in forked processes"""
+
+        if not self.interval or (self._worker is not None and self._worker.is_alive()):
+            return
+
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._stopping.clear()
+                self._worker = threading.Thread(target=self._run, name="sales-rollup", daemon=True)
+                self._worker.start()
+
+    def _run(self) -> None:
+
+        while not self._stopping.wait(self.interval):
+            try:
+                self.compact()
+            except Exception as error:
+                self.app.logger.error(f"Failed to compact the sales rollups: {error}")
+
+    def compact(self) -> int:
+        """Add the sales inserted since the last compaction to the rollups, return the number of sales added"""
+
+        self._ensure_worker()
+        started = time.perf_counter()
+
+        try:
+            with self._lock, self.app.app_context(), db.engine.begin() as connection:
+                connection.execute(text(f"LOCK TABLE {SalesRecord.__tablename__} IN SHARE MODE"))
+
+                state = SalesRollupState.__table__
+                connection.execute(postgresql.insert(state).values(name=ROLLUP_STATE, last_id=0).on_conflict_do_nothing())
+                last_id = connection.execute(
+                    db.select(state.c.last_id).where(state.c.name == ROLLUP_STATE).with_for_update()).scalar_one()
+
+                new_sales = SalesRecord.id > last_id
+                upper, count = connection.execute(
+                    db.select(db.func.max(SalesRecord.id), db.func.count()).where(new_sales)).one()
+
+                if count:
+                    window = db.and_(new_sales, SalesRecord.id <= upper)
+                    day = sale_day()
+                    category = db.func.coalesce(SalesRecord.product_category, "")
+                    revenue = db.func.sum(SalesRecord.product_price * SalesRecord.quantity)
+                    units = db.func.sum(SalesRecord.quantity)
+
+                    connection.execute(_upsert(
+                        SalesDailyCategory.__table__, ["day", "category"],
+                        db.select(day, category, revenue, units).where(window).group_by(day, category)
+                    ))
+                    connection.execute(_upsert(
+                        SalesDailyProduct.__table__, ["day", "product_id"],
+                        db.select(day, SalesRecord.product_id, revenue, units).where(window).group_by(
+                            day, SalesRecord.product_id)
+                    ))
+                    connection.execute(state.update().where(state.c.name == ROLLUP_STATE).values(
+                        last_id=upper, updated_at=db.func.now()))
+                    last_id = upper
+        except Exception:
+            self.failed_compactions += 1
+            raise
+
+        elapsed = time.perf_counter() - started
+        self.last_id = last_id
+        self.compactions += 1
+        self.compacted += count
+        self.last_compaction_seconds = elapsed
+        self.max_compaction_seconds = max(self.max_compaction_seconds, elapsed)
+        return count
+
+    def close(self) -> None:
+
+        self._stopping.set()
+        if self._worker is not None:
+            self._worker.join()
+
+    def stats(self) -> dict:
+        return {
+            "interval": self.interval,
+            "last_id": self.last_id,
+            "compactions": self.compactions,
+            "compacted": self.compacted,
+            "failed_compactions": self.failed_compactions,
+            "last_compaction_ms": round(self.last_compaction_seconds * 1000, 3),
+            "max_compaction_ms": round(self.max_compaction_seconds * 1000, 3),
+            "worker_alive": self._worker is not None and self._worker.is_alive()
+        }
+
+
+def configure(app: flask.Flask) -> None:
+    """Create ``app.sales_rollup``, using the ``ANALYTICS`` section of config file"""
+
+    cfg = app.config["cfg"]
+
+    # In test mode the rollups are only compacted when the tests call ``compact``
+    interval = 0 if app.testing else cfg.getfloat("ANALYTICS", "rollup_interval", fallback=60)
+    app.sales_rollup = SalesRollup(app, interval=interval)
+
+    if interval:
+        atexit.register(app.sales_rollup.close)
+
+    app.logger.info("Sales rollups configured")
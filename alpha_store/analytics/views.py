@@ -1,8 +1,5 @@
-from flask import Blueprint, Flask
-import pandas as pd
-import matplotlib.pyplot as plt
-from alpha_store.models import SalesRecord
-from io import BytesIO
+from flask import Blueprint, Flask, current_app
+from alpha_store.analytics.report import sales_aggregates, render_report
 import base64
 
 analytics = Blueprint("analytics", __name__, url_prefix="/apis/v1/analytics")
@@ -22,44 +19,38 @@ def index():
     },
 
 
-@analytics.route("/report", methods=["GET"])
-def report():
-
-    # Get the data from the database
-
-    data = SalesRecord.query.all()
-    # Create a dataframe with the data
-    df = pd.DataFrame([record.to_dict() for record in data])
-
-    fig, axs = plt.subplots(3, 1, figsize=(10, 10))
-
-    # Plot the data
-    # sale by day
-    df.groupby("sale_date")["product_price"].sum().plot(
-        ax=axs[0], label="Sale by time", style="o-")
-
-    axs[0].set_title("Sales history")
-    axs[0].set_xlabel("Sale date")
-    axs[0].set_ylabel("Sale value")
+@analytics.route("/ingest_stats", methods=["GET"])
+def ingest_stats():
+    """Queue depth and flush latency of the sales ingestion"""
 
-    # Sales by category
-    df.groupby("product_category")["product_price"].sum().plot(
-        kind="bar", ax=axs[1])
+    return {
+        "message": "Ingestion stats",
+        "status_code": 200,
+        **current_app.sales_ingestor.stats()
+    }, 200
 
-    axs[1].set_title("Sales revenue by category")
 
-    # best selling games
-    df.groupby("product_id").size().sort_values(
-        ascending=False).head(10).plot(kind="bar", ax=axs[2])
+@analytics.route("/rollup_stats", methods=["GET"])
+def rollup_stats():
+    """High-water mark and compaction times of the sales rollups"""
 
-    axs[2].set_title("best selling games")
+    return {
+        "message": "Rollup stats",
+        "status_code": 200,
+        **current_app.sales_rollup.stats()
+    }, 200
 
-    fig.tight_layout()
-    fig.suptitle("Sales report", fontsize=16, y=1.05)
 
-    image = BytesIO()
-    plt.savefig(image, format="png")
-    image.seek(0)
-    image_base64 = base64.b64encode(image.read()).decode('utf-8')
+@analytics.route("/report", methods=["GET"])
+def report():
+    """
+    Sales report with the revenue by day, the revenue by category and the best selling games
+    The aggregates are read from the rollups and the sales not compacted yet (see ``alpha_store.analytics.report``),
+    only the charts are drawn here. The compaction is left to the background worker, so the report never
+    takes the ``sales_record`` lock and never blocks the checkouts
+    """
+
+    image = render_report(sales_aggregates())
+    image_base64 = base64.b64encode(image).decode('utf-8')
 
     return f'<img src="data:image/png;base64,{image_base64}"/>'
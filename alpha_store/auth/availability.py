@@ -0,0 +1,176 @@
+import hashlib
+import math
+from typing import Iterable
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import object_session
+
+from alpha_store.models import db, User
+from alpha_store.rebuild import PeriodicRebuild
+from alpha_store.tools import app_attribute
+from alpha_store.transactions import after_commit
+
+# Columns of ``users`` that can be checked
+AVAILABILITY_FIELDS = ("username", "email")
+
+
+class BloomFilter:
+
+    """
+    Compact set sketch: ``value in bloom`` is ``False`` only if the value was never added,
+    and ``True`` for all the added values plus a fraction (about ``error_rate``) of the others
+
+    It's sized for ``capacity`` values, the bit array and the number of hashes follow the usual formulas:
+    ``bits = -capacity * ln(error_rate) / ln(2)^2`` and ``hashes = bits / capacity * ln(2)``.
+    The positions come from a single blake2b digest, split in two 64 bits hashes (double hashing).
+    """
+
+    def __init__(self, capacity: int = 100000, error_rate: float = 0.01) -> None:
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+
+        self.size = max(int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.size / self.capacity * math.log(2))), 1)
+        self.count = 0
+
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value: str) -> Iterable[int]:
+
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, value: str) -> None:
+
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def estimated_false_positive_rate(self) -> float:
+        """False positive rate expected with the current fill, ``(bits set / size) ^ hashes``"""
+
+        bits_set = sum(bin(byte).count("1") for byte in self._bits)
+        return (bits_set / self.size) ** self.hashes
+
+    def memory_bytes(self) -> int:
+        return len(self._bits)
+
+
+class UserAvailability(PeriodicRebuild):
+
+    """
+    Check if a username or an email is still available, for the live check of the signup form
+
+    A Bloom filter per field answers first. A value that is not in it is available, without touching the database.
+    When the value is in it (taken, or a false positive), the database has the last word.
+
+    The filters follow the ``users`` table: the users committed by this process are added right after the commit
+    and the filters are rebuilt every ``rebuild_interval`` seconds (see ``PeriodicRebuild``). The users written by
+    other processes (other workers, ``extra.py``, plain SQL) are only seen by a rebuild, so for up to
+    ``rebuild_interval`` seconds they can be reported as available. The check is only advisory: the unique
+    indexes still reject the registration, that reports the taken field (see ``UserSchema.make_user``).
+
+    Values can't be removed from a Bloom filter, so deleted users, old usernames and rolled back registrations stay
+    in it until the next rebuild, they just become false positives answered by the database.
+    When the number of values exceeds the capacity, the filters are rebuilt with twice the capacity.
+    """
+
+    def __init__(self, capacity: int = 100000, error_rate: float = 0.01, rebuild_interval: float = 60) -> None:
+        super().__init__(rebuild_interval)
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        self._filters = {}
+
+        self.checks = 0
+        self.definite_negatives = 0
+        self.false_positives = 0
+
+    def is_stale(self) -> bool:
+        """Also ``True`` when the filters are over capacity, the false positive rate grows quickly past it"""
+
+        return super().is_stale() or self._filters["username"].count > self.capacity
+
+    def _new(self) -> "UserAvailability":
+        return UserAvailability(self.capacity, self.error_rate)
+
+    def _load_rows(self) -> Iterable[tuple]:
+
+        # The filters are sized before the users are read, so the rows are streamed instead of kept in memory
+        users = db.session.query(db.func.count(User.id)).scalar()
+        while users > self.capacity:
+            self.capacity *= 2
+
+        return db.session.query(User.username, User.email).yield_per(1000)
+
+    def _load(self, rows: Iterable[tuple]) -> None:
+
+        self._filters = {field: BloomFilter(self.capacity, self.error_rate) for field in AVAILABILITY_FIELDS}
+        for row in rows:
+            self._add(*row)
+
+    def _swap(self, fresh: "UserAvailability") -> None:
+        self.capacity = fresh.capacity
+        self._filters = fresh._filters
+
+    def _add(self, username: str, email: str) -> None:
+        for field, value in zip(AVAILABILITY_FIELDS, (username, email)):
+            self._filters[field].add(value)
+
+    def is_available(self, field: str, value: str) -> bool:
+
+        self.ensure_built()
+        self.checks += 1
+
+        if value not in self._filters[field]:
+            self.definite_negatives += 1
+            return True
+
+        taken = db.session.query(db.session.query(User.id).filter(
+            getattr(User, field) == value).exists()).scalar()
+        if not taken:
+            self.false_positives += 1
+        return not taken
+
+    def stats(self) -> dict:
+
+        available = self.definite_negatives + self.false_positives
+        return {
+            **super().stats(),
+            "capacity": self.capacity,
+            "checks": self.checks,
+            "definite_negatives": self.definite_negatives,
+            "false_positives": self.false_positives,
+            # Fraction of the available values that the filters reported as taken
+            "observed_false_positive_rate": self.false_positives / available if available else 0.0,
+            "filters": {
+                field: {
+                    "values": bloom.count,
+                    "bits": bloom.size,
+                    "hashes": bloom.hashes,
+                    "memory_bytes": bloom.memory_bytes(),
+                    "estimated_false_positive_rate": bloom.estimated_false_positive_rate()
+                } for field, bloom in self._filters.items()
+            }
+        }
+
+
+@event.listens_for(User, "after_insert")
+def _add_user_availability(mapper, connection, user: User) -> None:
+
+    availability = app_attribute("user_availability")
+    if availability is not None:
+        after_commit(object_session(user), availability.add, user.username, user.email)
+
+
+@event.listens_for(User, "after_update")
+def _update_user_availability(mapper, connection, user: User) -> None:
+
+    # Most updates (like a password rehash) don't touch the checked fields
+    state = inspect(user)
+    if any(state.attrs[field].history.has_changes() for field in AVAILABILITY_FIELDS):
+        _add_user_availability(mapper, connection, user)
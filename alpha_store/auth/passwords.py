@@ -0,0 +1,152 @@
+import atexit
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable
+
+import flask
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+
+def full_method(method: str) -> str:
+    """
+    Return the hash method with all its parameters, as werkzeug writes it at the start of the hashes
+    ``pbkdf2`` and ``pbkdf2:sha256`` are stored as ``pbkdf2:sha256:260000`` (the default iterations)
+    """
+
+    if method != "pbkdf2" and not method.startswith("pbkdf2:"):
+        return method
+
+    hash_name, _, iterations = method[7:].partition(":")
+    return f"pbkdf2:{hash_name or 'sha256'}:{iterations or DEFAULT_PBKDF2_ITERATIONS}"
+
+
+class PasswordHasher:
+
+    """
+    Hash and verify passwords in a bounded process pool
+
+    The werkzeug hashes (pbkdf2) are CPU bound and hold the GIL while they run, so a burst of logins
+    stalls every other request of the same process. Here they run in ``workers`` separate processes instead.
+
+    At most ``max_pending`` operations can be running or queued. A caller waits at most ``timeout`` seconds for
+    one of these slots and then ``timeout`` seconds for the result, otherwise ``TimeoutError`` is raised,
+    so the view can answer right away instead of piling up requests.
+
+    With ``workers=0`` (always used in test mode) the hashes are computed in the calling thread.
+    ``method`` is the werkzeug hash method with all its cost parameters, like ``pbkdf2:sha256:260000``
+    (the werkzeug 2.2 default, used by the existing hashes). scrypt is only available from werkzeug 2.3.
+    A method without some of its parameters (like ``pbkdf2:sha256``) gets the werkzeug defaults.
+    Hashes made with another method are updated by ``needs_rehash``.
+    """
+
+    def __init__(self, method: str = "pbkdf2:sha256:260000", workers: int = 2, timeout: float = 5,
+                 max_pending: int = 64) -> None:
+        self.method = full_method(method)
+        self.workers = workers
+        self.timeout = timeout
+        self.max_pending = max_pending
+
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max_pending) if max_pending > 0 else None
+        self._lock = threading.Lock()
+
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    # ``spawn`` instead of ``fork``, forking a process that already runs threads (the WSGI
+                    # server ones) can copy locks held by other threads and deadlock the children
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def _run(self, function: Callable, *args):
+
+        if self.workers <= 0:
+            return function(*args)
+
+        if self._slots is None or not self._slots.acquire(timeout=self.timeout):
+            self.rejected += 1
+            raise TimeoutError("Too many password operations waiting")
+
+        try:
+            future = self._get_executor().submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        # The slot is only given back when the operation really ends, even if the caller gave up waiting
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            result = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            self.timeouts += 1
+            raise TimeoutError("Password operation timed out") from None
+
+        self.completed += 1
+        return result
+
+    def hash(self, password: str) -> str:
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash: str, password: str) -> bool:
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash: str) -> bool:
+        """Check if the hash was made with other method or cost parameters than the configured ones"""
+
+        return pwhash.split("$", 1)[0] != self.method
+
+    def start(self) -> None:
+        """
+        Start the worker processes now, otherwise they are started by the first operations,
+        that can exceed the timeout while the new processes import their modules
+        """
+
+        if self.workers > 0:
+            executor = self._get_executor()
+            for future in [executor.submit(int) for _ in range(self.workers)]:
+                future.result()
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "method": self.method,
+            "workers": self.workers,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts
+        }
+
+
+def configure(app: flask.Flask) -> None:
+    """Create ``app.password_hasher``, using the ``AUTH`` section of config file"""
+
+    cfg = app.config["cfg"]
+
+    # In test mode the passwords are hashed inline, the tests don't need to start any process
+    workers = 0 if app.testing else cfg.getint("AUTH", "password_hash_workers", fallback=2)
+
+    app.password_hasher = PasswordHasher(
+        method=cfg.get("AUTH", "password_hash_method", fallback="pbkdf2:sha256:260000"),
+        workers=workers,
+        timeout=cfg.getfloat("AUTH", "password_hash_timeout", fallback=5),
+        max_pending=cfg.getint("AUTH", "password_hash_max_pending", fallback=64)
+    )
+
+    if workers > 0:
+        atexit.register(app.password_hasher.shutdown)
+
+    app.logger.info(f"Password hasher configured ({app.password_hasher.method}, {workers} workers)")
@@ -1,5 +1,9 @@
-from marshmallow import fields, ValidationError, post_load, pre_load, validate, Schema, validates
-from alpha_store.models import User, Cart
+from marshmallow import fields, ValidationError, post_load, validate, Schema, validates
+from sqlalchemy.exc import IntegrityError
+from alpha_store.models import db, User, Cart
+
+# Unique columns of ``users`` checked by the registration, in the order the errors are reported
+UNIQUE_FIELDS = ("username", "email")
 
 
 class UserSchema(Schema):
@@ -12,19 +16,6 @@ class UserSchema(Schema):
         required=True, load_only=True, validate=validate.Length(min=8))
     joined_at = fields.DateTime(dump_only=True)
 
-    @validates("email")
-    def validate_email(self, email, **kwargs):
-        usr = User.get_user_by_email(email)
-
-        if usr:
-            raise ValidationError("Email already exists")
-
-    @validates("username")
-    def validate_username(self, username, **kwargs):
-        usr = User.get_user_by_username(username)
-        if usr:
-            raise ValidationError("Username already exists")
-
     @validates("password")
     def validate_password(self, password, **kwargs):
 
@@ -45,10 +36,62 @@ class UserSchema(Schema):
 
     @post_load
     def make_user(self, data, **kwargs):
+        """
+        Create the user and its cart in a single transaction
+        The uniqueness of the email and username isn't checked with SELECTs before the insert, the unique indexes
+        do it: on a violation, the taken fields are looked up with one query and reported in ``UNIQUE_FIELDS`` order,
+        so the error doesn't depend on which index the database checked first
+        """
+
         usr = User(**data)
-        usr.save()
-        # Create a cart for the user
-        usr.cart = Cart(user_id=usr.id)
-        usr.cart.save()
+        usr.cart = Cart()
+        db.session.add(usr)
+
+        try:
+            db.session.commit()
+        except IntegrityError as exc:
+            db.session.rollback()
+
+            taken = _taken_fields(data["username"], data["email"])
+            if not taken:
+                raise
+            raise ValidationError({field: [_taken_message(field)] for field in taken}) from exc
 
         return usr
+
+    def handle_error(self, error: ValidationError, data, **kwargs):
+        """
+        Add the taken username/email to the errors of an invalid input, in the fields order
+        So a taken username is still reported before a weak password, like when the validators
+        checked them with SELECTs. The database is only queried when the input is already invalid,
+        the errors raised by ``make_user`` already have the taken fields
+        """
+
+        if not isinstance(data, dict):
+            return
+
+        messages = error.normalized_messages()
+        if not any(_taken_message(field) in messages.get(field, ()) for field in UNIQUE_FIELDS):
+            for field in _taken_fields(data.get("username"), data.get("email")):
+                # Like the old validators, a field that is already invalid isn't checked
+                messages.setdefault(field, [_taken_message(field)])
+
+        ordered = {name: messages[name] for name in self.declared_fields if name in messages}
+        ordered.update((name, value) for name, value in messages.items() if name not in ordered)
+        raise ValidationError(ordered, data=error.data, valid_data=error.valid_data) from error
+
+
+def _taken_message(field: str) -> str:
+    return f"{field.capitalize()} already exists"
+
+
+def _taken_fields(username, email) -> list:
+    """Return the ``UNIQUE_FIELDS`` already used by another user, in the order they are reported"""
+
+    values = {"username": username, "email": email}
+    conditions = [getattr(User, field) == value for field, value in values.items() if isinstance(value, str)]
+    if not conditions:
+        return []
+
+    rows = db.session.query(User.username, User.email).filter(db.or_(*conditions)).all()
+    return [field for field in UNIQUE_FIELDS if any(getattr(row, field) == values[field] for row in rows)]
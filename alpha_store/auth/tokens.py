@@ -0,0 +1,99 @@
+import hashlib
+import secrets
+import threading
+import time
+from typing import Optional
+
+import flask
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+
+from alpha_store.models import login_manager, user_from_identity
+
+
+class TokenManager:
+
+    """
+    Signed, expiring auth tokens, an alternative to the cookie session of Flask-Login
+
+    The token carries the user ``id`` and ``username`` and a random token id, signed with the app secret key
+    (HMAC-SHA256), so it's verified without any database or shared state: any API worker with the same secret
+    key accepts it. The ``User`` of the request is rebuilt from the token, so the views that only need the
+    user id (cart, orders) don't query the ``users`` table at all.
+
+    Logout revokes the token id until the token expires. The revocation list lives in the process memory,
+    so with many workers a revoked token is still accepted by the other ones until it expires: keep
+    ``token_max_age`` short. Password changes or deleted users don't invalidate the tokens either.
+    """
+
+    def __init__(self, secret_key: str, max_age: int = 900) -> None:
+        self.max_age = max_age
+        self._serializer = URLSafeTimedSerializer(
+            secret_key, salt="auth-token", signer_kwargs={"digest_method": hashlib.sha256})
+
+        self._revoked = {}  # token id -> expiration time
+        self._lock = threading.Lock()
+
+    def issue(self, user) -> str:
+        return self._serializer.dumps({"id": user.id, "username": user.username, "jti": secrets.token_urlsafe(8)})
+
+    def verify(self, token: str) -> Optional[dict]:
+        """Return the token payload, or ``None`` if the token is invalid, expired or revoked"""
+
+        try:
+            payload, issued_at = self._serializer.loads(token, max_age=self.max_age, return_timestamp=True)
+        except (SignatureExpired, BadSignature):
+            return None
+
+        if payload.get("jti") in self._revoked:
+            return None
+
+        payload["expires_at"] = issued_at.timestamp() + self.max_age
+        return payload
+
+    def revoke(self, token_id: str, expires_at: float) -> None:
+
+        with self._lock:
+            now = time.time()
+            # Expired tokens are refused anyway, so they don't need to stay in the list
+            for expired in [jti for jti, expiration in self._revoked.items() if expiration < now]:
+                del self._revoked[expired]
+
+            self._revoked[token_id] = expires_at
+
+    def stats(self) -> dict:
+        return {"max_age": self.max_age, "revoked": len(self._revoked)}
+
+
+@login_manager.request_loader
+def load_user_from_token(request: flask.Request):
+    """
+    Authenticate the requests with a ``Authorization: Bearer <token>`` header, when the token mode is enabled
+    It's only called by Flask-Login when the request has no cookie session
+    """
+
+    manager = getattr(flask.current_app, "token_manager", None)
+    if manager is None:
+        return None
+
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+
+    payload = manager.verify(token.strip())
+    if payload is None:
+        return None
+
+    # Kept for the logout, that revokes the token
+    flask.g.auth_token = payload
+    return user_from_identity({"id": payload["id"], "username": payload["username"]})
+
+
+def configure(app: flask.Flask) -> None:
+    """Create ``app.token_manager`` if ``token_auth`` is enabled in the ``AUTH`` section of config file"""
+
+    cfg = app.config["cfg"]
+
+    app.token_manager = None
+    if cfg.getboolean("AUTH", "token_auth", fallback=False):
+        app.token_manager = TokenManager(app.secret_key, max_age=cfg.getint("AUTH", "token_max_age", fallback=900))
+        app.logger.info("Token authentication enabled")
@@ -1,14 +1,24 @@
-from flask import Blueprint, request, jsonify, make_response, Flask, current_app
+from flask import Blueprint, request, make_response, Flask, current_app, g
 from flask_login import login_user, logout_user, login_required, current_user
 from alpha_store.auth.serializer import UserSchema
-from alpha_store.models import User
+from alpha_store.auth.availability import UserAvailability, AVAILABILITY_FIELDS
+from alpha_store.models import User, invalidate_user_cache
+from alpha_store.tools import encode_cursor, decode_cursor
 from marshmallow import ValidationError
+from datetime import datetime
 
 auth = Blueprint("auth", __name__, url_prefix="/apis/v1/user")
 
 
 def configure(app: Flask) -> None:
 
+    cfg = app.config["cfg"]
+    app.user_availability = UserAvailability(
+        capacity=cfg.getint("AUTH", "availability_capacity", fallback=100000),
+        error_rate=cfg.getfloat("AUTH", "availability_error_rate", fallback=0.01),
+        rebuild_interval=cfg.getfloat("AUTH", "availability_rebuild_interval", fallback=60)
+    )
+
     app.register_blueprint(auth)
     app.logger.info("Auth configured")
 
@@ -41,7 +51,7 @@ def register():
         'password': 'validpassword'
     }
 
-    The password is hashed using the werkzeug.security.generate_password_hash method and
+    The password is hashed by ``app.password_hasher`` (werkzeug hash, in a process pool) and
     must be at least 8 characters long, contain at least one uppercase letter, one lowercase letter, one number and one special character.
 
 
@@ -60,9 +70,10 @@ def register():
     try:
 
         user_schema = UserSchema()
-        user = user_schema.load(json_data)
+        user_schema.load(json_data)
 
-        current_app.logger.debug(f"User {user.username} created successfully")
+        # The username comes from the input, reading it from the created user would reload the expired instance
+        current_app.logger.debug(f"User {json_data['username']} created successfully")
 
         # Return the data
         return {
@@ -80,6 +91,61 @@ def register():
             "status_code": 400,
         }, 400
 
+    except TimeoutError as exc:
+        current_app.logger.warning(f"Register rejected, the password hasher is busy: {exc}")
+        return _password_hasher_busy()
+
+
+def _password_hasher_busy():
+    """Response of the endpoints that hash passwords when the hasher pool is full or timed out"""
+
+    response = make_response({
+        "message": "Server busy, try again later",
+        "status_code": 503,
+    }, 503)
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+@auth.route("/availability", methods=["GET"])
+def availability():
+    """
+    Check if a ``username`` and/or an ``email`` (query parameters) are still available, for the signup form
+    An in-memory Bloom filter answers first, the values missing from it are available without querying the database.
+    The users written by other processes are seen when the filter is rebuilt, every ``availability_rebuild_interval``
+    seconds (``AUTH`` section of config file).
+
+    :return: A JSON response with the availability of each given field, like ``{"username": true}``
+    """
+
+    values = {field: request.args[field] for field in AVAILABILITY_FIELDS if request.args.get(field)}
+    if not values:
+        return {
+            "message": "No username or email provided",
+            "status_code": 400,
+        }, 400
+
+    return {
+        "message": "Availability checked",
+        "status_code": 200,
+        "available": {field: current_app.user_availability.is_available(field, value)
+                      for field, value in values.items()}
+    }, 200
+
+
+@auth.route("/availability/stats", methods=["GET"])
+def availability_stats():
+    """
+    False positive rate and memory of the Bloom filters used by ``availability``
+    """
+
+    current_app.user_availability.ensure_built()
+    return {
+        "message": "Availability stats",
+        "status_code": 200,
+        "availability": current_app.user_availability.stats()
+    }, 200
+
 
 @auth.route("/login", methods=["POST"])
 def login():
@@ -109,10 +175,23 @@ def login():
         usr = User.get_user_by_email(email)
 
         if usr and usr.check_password(password):
+            # Update the hash when the configured hash method or cost changed
+            usr.rehash_password(password)
             login_user(usr)
+
+            # In token mode, the response has a signed token to be sent in the ``Authorization`` header
+            tokens = {}
+            if current_app.token_manager is not None:
+                tokens = {
+                    "token": current_app.token_manager.issue(usr),
+                    "token_type": "Bearer",
+                    "expires_in": current_app.token_manager.max_age
+                }
+
             return {
                 "message": "Logged in successfully",
                 "status_code": 200,
+                **tokens
             }, 200
 
         return {
@@ -120,6 +199,10 @@ def login():
             "status_code": 401,
         }, 401
 
+    except TimeoutError as exc:
+        current_app.logger.warning(f"Login rejected, the password hasher is busy: {exc}")
+        return _password_hasher_busy()
+
     except (KeyError, TypeError) as exc:
         current_app.logger.debug(
             f"Input data error with loggin attempt: {exc}")
@@ -135,8 +218,14 @@ def logout():
     """
     This endpoint handles the user logout.
     The logout_user function from Flask-Login is used to log the user out. It clears the user login status in the session.
+    The user identity is removed from the user cache too, and the token is revoked when the request used one.
     """
 
+    token = g.pop("auth_token", None)
+    if token is not None:
+        current_app.token_manager.revoke(token["jti"], token["expires_at"])
+
+    invalidate_user_cache(current_user.id)
     logout_user()
     return {
         "message": "Logged out successfully",
@@ -144,46 +233,88 @@ def logout():
     }, 200
 
 
+@auth.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    """
+    Hit/miss counters of the user identity cache used by ``load_user``
+    """
+
+    return {
+        "message": "Cache stats",
+        "status_code": 200,
+        "user_cache": current_app.user_cache.stats()
+    }, 200
+
+
 @auth.route("/cart", methods=["GET"])
 @login_required
 def get_cart():
     """
     This endpoint handles the user cart retrieval. 
-    It will call ``current_user.get_cart`` method to retrieve the user cart.
-    Also, the shipping_cost and total_price is calculated and returned in the response.
-    Note: The shipping cost is 10 for each product, but if the total shipping cost is greater than or equals to 250, it will be free. 
+    It will call ``current_user.get_cart`` method to retrieve the user cart, with the lines and the totals
+    computed by the database in a single query.
+    Note: The shipping cost is 10 for each product, but if the total shipping cost is greater than 250, it will be free
+    (see ``alpha_store.pricing``, the same rule is used by the checkout).
 
     :return: A JSON response containing the status code, the cart id, the products, the total price, the shipping cost and the total items
     """
 
     user_cart = current_user.get_cart()
 
-    # calculate the total price of the cart
-    total_price = 0
-    shipping_cost = 0
-    for product in user_cart.get("products", []):
-        total_price += product["price"]
-        shipping_cost += 10
-
-    shipping_cost = shipping_cost if shipping_cost <= 250 else 0
-    total_price += shipping_cost
-
     return {
         "message": "Cart retrieved successfully",
         "status_code": 200,
         "cart_id": user_cart["cart_id"],
         "products": user_cart["products"],
-        "total_price": total_price,
-        "shipping_cost": shipping_cost,
-        "total_items": len(user_cart["products"]),
+        "total_price": user_cart["subtotal"] + user_cart["shipping_cost"],
+        "shipping_cost": user_cart["shipping_cost"],
+        "total_items": user_cart["total_items"],
     }, 200
 
 
+def _max_quantity() -> int:
+    """Max units of a product in the cart, ``cart_max_quantity`` (``AUTH`` section of config file)"""
+
+    return current_app.config["cfg"].getint("AUTH", "cart_max_quantity", fallback=100)
+
+
+def _get_quantity() -> int:
+    """
+    Read the optional ``quantity`` query parameter of the cart endpoints
+    It must be a positive integer, not bigger than ``_max_quantity``
+    """
+
+    # ``type=int`` would turn an invalid value into the default, so it's parsed here
+    quantity = request.args.get("quantity", "1")
+    if not (quantity.isascii() and quantity.isdigit()) or int(quantity) < 1:
+        raise ValueError("Invalid quantity")
+
+    quantity = int(quantity)
+    max_quantity = _max_quantity()
+    if quantity > max_quantity:
+        raise ValueError(f"Invalid quantity, the max is {max_quantity}")
+    return quantity
+
+
 @auth.route("/cart/add-to-cart/<int:product_id>", methods=["POST"])
 @login_required
 def add_to_cart(product_id):
+    """
+    This endpoint adds a product to the user cart.
+    The optional ``quantity`` query parameter sets how many units are added (1 by default).
+    Adding a product that is already in the cart increments its quantity, up to ``cart_max_quantity``.
+    """
+
+    try:
+        quantity = _get_quantity()
+    except ValueError as exc:
+        return {
+            "message": str(exc),
+            "status_code": 400,
+        }, 400
+
     try:
-        current_user.add_to_cart(product_id)
+        current_user.add_to_cart(product_id, quantity, max_quantity=_max_quantity())
         return {
             "message": "Product added to cart successfully",
             "status_code": 200,
@@ -206,10 +337,20 @@ def remove_from_cart(product_id):
     This endpoint handles the product removal from the user cart.
     It will call ``current_user.remove_from_cart`` method to remove the product from the user cart.
     If the product is not found or not in the cart, a 404 Not Found status code is returned.
+    The optional ``quantity`` query parameter sets how many units are removed (1 by default),
+    the product leaves the cart when no units are left.
 
     """
     try:
-        current_user.remove_from_cart(product_id)
+        quantity = _get_quantity()
+    except ValueError as exc:
+        return {
+            "message": str(exc),
+            "status_code": 400,
+        }, 400
+
+    try:
+        current_user.remove_from_cart(product_id, quantity)
         return {
             "message": "Product removed from cart successfully",
             "status_code": 200,
@@ -255,17 +396,50 @@ def checkout():
 @login_required
 def get_orders():
     """
-        Fetches the user orders.
-        It will call ``current_user.get_orders`` method to retrieve the user orders.
-        :return: A JSON response containing the status code, the orders
+        Fetches the user orders, the newest first.
+        It will call ``current_user.get_orders`` method to retrieve a page of the user orders.
+        - ``limit``: orders per page, ``orders_page_size`` of config file by default (up to ``orders_max_page_size``)
+        - ``cursor``: the ``next_cursor`` returned by the previous page, ``null`` when there are no more orders
+        - ``summary``: if true, only the order headers are returned, without the products
+        :return: A JSON response containing the status code, the orders and the next cursor
     """
 
-    orders = current_user.get_orders()
+    cfg = current_app.config["cfg"]
+    page_size = cfg.getint("AUTH", "orders_page_size", fallback=20)
+    max_page_size = cfg.getint("AUTH", "orders_max_page_size", fallback=100)
+
+    limit = request.args.get("limit", page_size, type=int)
+    limit = min(max(limit, 1), max_page_size)
+    summary = request.args.get("summary", "false", type=str).lower() == "true"
+    cursor = request.args.get("cursor", None, type=str)
+
+    after = None
+    if cursor:
+        try:
+            position = decode_cursor(cursor)
+            after = (datetime.fromisoformat(position["added_at"]), int(position["id"]))
+        except (ValueError, KeyError, TypeError) as exc:
+            current_app.logger.debug(f"Invalid cursor {cursor}: {exc}")
+            return {
+                "message": "Invalid cursor",
+                "status_code": 400,
+            }, 400
+
+    # One more order is fetched to know if there is a next page, without a trailing empty page
+    orders = current_user.get_orders(limit=limit + 1, after=after, summary=summary)
+    has_next_page = len(orders) > limit
+    orders = orders[:limit]
+
+    next_cursor = None
+    if has_next_page:
+        last_order = orders[-1]
+        next_cursor = encode_cursor({"added_at": last_order["added_at"].isoformat(), "id": last_order["id"]})
 
     return {
         "message": "Orders retrieved successfully",
         "status_code": 200,
         "orders": orders,
+        "next_cursor": next_cursor,
     }, 200
 
 
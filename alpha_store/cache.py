@@ -0,0 +1,162 @@
+import datetime
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable, Optional
+
+import flask
+
+# Sentinel returned by ``LRUCache.get`` when the key is not cached (or expired)
+# ``None`` can't be used here, since it is a valid cached value (negative caching)
+MISSING = object()
+
+
+class LRUCache:
+
+    """
+    A thread safe, size bounded cache with LRU eviction and TTL expiration
+    ``None`` values are cached too (negative caching), but they expire after ``negative_ttl`` seconds,
+    so a missing row that is inserted later by another process becomes visible quickly
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300, negative_ttl: float = 30) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        """Return the cached value for ``key`` or ``MISSING``"""
+
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return MISSING
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+
+        ttl = self.negative_ttl if value is None else self.ttl
+        if self.maxsize <= 0 or ttl <= 0:
+            return
+
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / requests if requests else 0.0
+        }
+
+
+class ProductCache:
+
+    """
+    Read-through cache of products, keyed by id and by name
+    The cached values are detached ``Products`` instances (or ``None`` for products that don't exist).
+    The read-through logic lives in ``Products.get_by_id``/``Products.get_by_name``, this class only stores
+    the values and handles the invalidation
+
+    Since it is notified of every product write (after its commit), it also keeps the catalog ``version``
+    (a change counter) and the ``last_modified`` time, used as HTTP validators by the catalog views.
+    ``json_by_id`` holds the already encoded JSON of each product (see ``alpha_store.serialization``)
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300, negative_ttl: float = 30) -> None:
+        self.by_id = LRUCache(maxsize, ttl, negative_ttl)
+        self.by_name = LRUCache(maxsize, ttl, negative_ttl)
+        self.json_by_id = LRUCache(maxsize, ttl, negative_ttl)
+
+        self.version = 0
+        self.last_modified = datetime.datetime.now(datetime.timezone.utc)
+
+    def _bump_version(self) -> None:
+        self.version += 1
+        self.last_modified = datetime.datetime.now(datetime.timezone.utc)
+
+    def invalidate(self, product_id: Optional[int], names: Iterable[str] = ()) -> None:
+        """Drop a product from the cache. All the names it had (old and new ones) must be given"""
+
+        self._bump_version()
+
+        if product_id is not None:
+            self.by_id.delete(product_id)
+            self.json_by_id.delete(product_id)
+
+        for name in names:
+            self.by_name.delete(name)
+
+    def clear(self) -> None:
+        self._bump_version()
+        self.by_id.clear()
+        self.by_name.clear()
+        self.json_by_id.clear()
+
+    def stats(self) -> dict:
+        return {
+            "by_id": self.by_id.stats(),
+            "by_name": self.by_name.stats(),
+            "json_by_id": self.json_by_id.stats()
+        }
+
+
+def configure(app: flask.Flask) -> None:
+    """
+    Create the app caches using the ``CACHE`` section of config file
+    Each app has its own caches, so different apps (like the ones created in tests) never share stale data
+    """
+
+    cfg = app.config["cfg"]
+
+    app.product_cache = ProductCache(
+        maxsize=cfg.getint("CACHE", "product_cache_size", fallback=1024),
+        ttl=cfg.getfloat("CACHE", "product_cache_ttl", fallback=300),
+        negative_ttl=cfg.getfloat("CACHE", "product_cache_negative_ttl", fallback=30)
+    )
+
+    # Identity of the logged users, used by ``load_user``. Missing users are never cached (``negative_ttl=0``)
+    app.user_cache = LRUCache(
+        maxsize=cfg.getint("CACHE", "user_cache_size", fallback=4096),
+        ttl=cfg.getfloat("CACHE", "user_cache_ttl", fallback=60),
+        negative_ttl=0
+    )
+
+    app.logger.info("Caches configured")
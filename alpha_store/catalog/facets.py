@@ -0,0 +1,253 @@
+import bisect
+from datetime import datetime
+from typing import Iterable, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from alpha_store.models import db, Products
+from alpha_store.rebuild import PeriodicRebuild
+from alpha_store.tools import app_attribute
+from alpha_store.transactions import after_commit
+
+# The range filters keep the bitset of the first N sorted values every ``PREFIX_STEP`` values (cumulative bitsets).
+# A prefix bitset per value would answer a range with a single XOR, but it takes ``products ^ 2 / 8`` bytes
+PREFIX_STEP = 256
+
+
+def _range_bounds(values: list, low, high) -> tuple:
+    """Return the ``[start, end)`` positions of the values between ``low`` and ``high`` (inclusive) in a sorted list"""
+
+    start = 0 if low is None else bisect.bisect_left(values, (low, -1))
+    end = len(values) if high is None else bisect.bisect_right(values, (high, float("inf")))
+    return start, end
+
+
+def as_datetime(value) -> datetime:
+    """
+    The release date can be assigned as an ISO string (the database does the conversion), so it's converted here
+    The timezone is dropped, like the database does for ``DateTime`` columns without timezone
+    """
+
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return value.replace(tzinfo=None)
+
+
+class FacetEngine(PeriodicRebuild):
+
+    """
+    Precomputed facet counts over the products table
+
+    Every product gets a slot (a bit position) and the engine keeps:
+    - a bitset (python int) per category and per price bucket
+    - a sorted array of ``(value, slot)`` for price, score and release date, used for range filters,
+      with the cumulative bitsets of the array every ``PREFIX_STEP`` values
+
+    A filter is answered by AND-ing bitsets, and each facet count is the popcount of the filter bitset
+    AND the facet bitset, so a filter plus all its facet counts is answered without touching the database.
+    Like the search index, the products committed by this process are applied right after the commit and
+    the engine is rebuilt every ``rebuild_interval`` seconds (see ``PeriodicRebuild``).
+    So the counts can lag behind the filtered results of the same response for up to ``rebuild_interval``.
+    """
+
+    def __init__(self, price_buckets: Iterable[float] = (0, 25, 50, 100, 250), rebuild_interval: float = 60) -> None:
+        super().__init__(rebuild_interval)
+        self.price_buckets = sorted(price_buckets)
+
+        self._slots = {}  # product id -> slot
+        self._free_slots = []
+        self._live = 0  # bitset of the used slots
+        self._documents = {}  # slot -> (category, price, score, release_date)
+
+        self._category_bits = {}
+        self._price_bucket_bits = [0] * len(self.price_buckets)
+        self._sorted = {"price": [], "score": [], "release_date": []}
+
+        # Cumulative bitsets of ``_sorted``, computed on the first range filter after a write
+        self._prefix_bits = {}
+
+    def price_bucket_label(self, bucket: int) -> str:
+        low = self.price_buckets[bucket]
+        if bucket + 1 < len(self.price_buckets):
+            return f"{low:g}-{self.price_buckets[bucket + 1]:g}"
+        return f"{low:g}+"
+
+    def _price_bucket(self, price: float) -> int:
+        return max(bisect.bisect_right(self.price_buckets, price) - 1, 0)
+
+    def _new(self) -> "FacetEngine":
+        return FacetEngine(self.price_buckets)
+
+    def _load_rows(self) -> Iterable[tuple]:
+        return db.session.query(Products.id, Products.category, Products.price, Products.score, Products.release_date)
+
+    def _load(self, rows: Iterable[tuple]) -> None:
+
+        # The arrays are sorted once at the end, instead of an insort per product
+        for row in rows:
+            self._add(*row, keep_sorted=False)
+
+        for values in self._sorted.values():
+            values.sort()
+
+    def _swap(self, fresh: "FacetEngine") -> None:
+        self._slots = fresh._slots
+        self._free_slots = fresh._free_slots
+        self._documents = fresh._documents
+        self._category_bits = fresh._category_bits
+        self._live = fresh._live
+        self._price_bucket_bits = fresh._price_bucket_bits
+        self._sorted = fresh._sorted
+        self._prefix_bits = {}
+
+    def _add(self, product_id, category, price, score, release_date, keep_sorted: bool = True) -> None:
+
+        self._remove(product_id)
+
+        slot = self._free_slots.pop() if self._free_slots else len(self._slots)
+        bit = 1 << slot
+
+        self._slots[product_id] = slot
+        self._documents[slot] = (category, price, score, release_date)
+        self._live |= bit
+        self._category_bits[category] = self._category_bits.get(category, 0) | bit
+        self._price_bucket_bits[self._price_bucket(price)] |= bit
+
+        for column, value in (("price", price), ("score", score), ("release_date", release_date)):
+            if keep_sorted:
+                bisect.insort(self._sorted[column], (value, slot))
+            else:
+                self._sorted[column].append((value, slot))
+        self._prefix_bits = {}
+
+    def _remove(self, product_id: int) -> None:
+
+        slot = self._slots.pop(product_id, None)
+        if slot is None:
+            return
+
+        category, price, score, release_date = self._documents.pop(slot)
+        mask = ~(1 << slot)
+
+        self._live &= mask
+        self._category_bits[category] &= mask
+        if not self._category_bits[category]:
+            del self._category_bits[category]
+        self._price_bucket_bits[self._price_bucket(price)] &= mask
+
+        for column, value in (("price", price), ("score", score), ("release_date", release_date)):
+            values = self._sorted[column]
+            del values[bisect.bisect_left(values, (value, slot))]
+
+        self._free_slots.append(slot)
+        self._prefix_bits = {}
+
+    def _slot_bytes(self) -> bytearray:
+        return bytearray((len(self._slots) + len(self._free_slots)) // 8 + 1)
+
+    def _column_prefix_bits(self, column: str) -> list:
+        """Bitsets of the first ``i * PREFIX_STEP`` slots of the sorted ``column``, for every ``i``"""
+
+        prefixes = self._prefix_bits.get(column)
+        if prefixes is not None:
+            return prefixes
+
+        # Setting the bits in a bytearray and converting it once per step is much cheaper than OR-ing ints
+        bits = self._slot_bytes()
+        prefixes = [0]
+        for position, (_, slot) in enumerate(self._sorted[column], 1):
+            bits[slot >> 3] |= 1 << (slot & 7)
+            if position % PREFIX_STEP == 0:
+                prefixes.append(int.from_bytes(bits, "little"))
+
+        self._prefix_bits[column] = prefixes
+        return prefixes
+
+    def _prefix(self, column: str, end: int) -> int:
+        """Bitset of the slots of the first ``end`` sorted values of ``column``"""
+
+        step = end // PREFIX_STEP
+        prefix = self._column_prefix_bits(column)[step]
+        if end == step * PREFIX_STEP:
+            return prefix
+
+        bits = self._slot_bytes()
+        for _, slot in self._sorted[column][step * PREFIX_STEP:end]:
+            bits[slot >> 3] |= 1 << (slot & 7)
+        return prefix | int.from_bytes(bits, "little")
+
+    def _range_bits(self, column: str, low, high) -> int:
+        """Bitset of the slots with ``low <= column <= high``"""
+
+        values = self._sorted[column]
+        start, end = _range_bounds(values, low, high)
+
+        if start == 0 and end == len(values):
+            return self._live
+
+        # The first ``start`` values are a subset of the first ``end`` ones
+        return self._prefix(column, end) ^ self._prefix(column, start)
+
+    def facets(self, category: Optional[str] = None, min_price: Optional[float] = None,
+               max_price: Optional[float] = None, min_score: Optional[float] = None,
+               max_score: Optional[float] = None, released_after: Optional[datetime] = None,
+               released_before: Optional[datetime] = None) -> dict:
+        """
+        Count the products matching the filters, per category and per price bucket
+        Like usual faceted search, each facet ignores its own filter: the category counts
+        don't apply the ``category`` filter, so the client can show the other options to the user.
+        """
+
+        with self._lock:
+            base = self._live
+            if min_score is not None or max_score is not None:
+                base &= self._range_bits("score", min_score, max_score)
+            if released_after is not None or released_before is not None:
+                base &= self._range_bits("release_date", released_after, released_before)
+
+            price_bits = self._live
+            if min_price is not None or max_price is not None:
+                price_bits = self._range_bits("price", min_price, max_price)
+
+            category_bits = self._category_bits.get(category, 0) if category is not None else self._live
+
+            without_category = base & price_bits
+            without_price = base & category_bits
+
+            return {
+                "total": (without_category & category_bits).bit_count(),
+                "category": {
+                    name: count for name, bits in sorted(self._category_bits.items())
+                    if (count := (without_category & bits).bit_count())
+                },
+                "price": {
+                    self.price_bucket_label(bucket): (without_price & bits).bit_count()
+                    for bucket, bits in enumerate(self._price_bucket_bits)
+                }
+            }
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "products": len(self._slots),
+            "categories": len(self._category_bits)
+        }
+
+
+@event.listens_for(Products, "after_insert")
+@event.listens_for(Products, "after_update")
+def _add_product_facets(mapper, connection, product: Products) -> None:
+
+    engine = app_attribute("facet_engine")
+    if engine is not None:
+        after_commit(object_session(product), engine.add, product.id, product.category, product.price,
+                     product.score, as_datetime(product.release_date))
+
+
+@event.listens_for(Products, "after_delete")
+def _remove_product_facets(mapper, connection, product: Products) -> None:
+
+    engine = app_attribute("facet_engine")
+    if engine is not None:
+        after_commit(object_session(product), engine.remove, product.id)
@@ -0,0 +1,93 @@
+import datetime
+import functools
+import hashlib
+import os
+import time
+from typing import Callable, Optional
+
+from flask import current_app, request, make_response, Response
+
+# Changes every time the process starts, so validators issued before a restart
+# (when writes from other processes could have happened) are never accepted again
+_BOOT_ID = f"{os.getpid()}-{time.time_ns()}"
+
+
+def _ttl_window() -> Optional[int]:
+    """Index of the current TTL window of the product cache, ``None`` when the cache is disabled"""
+
+    ttl = current_app.product_cache.by_id.ttl
+    return int(time.time() // ttl) if ttl > 0 else None
+
+
+def catalog_etag() -> str:
+    """
+    ETag of the current request, derived from the catalog version kept by the product cache
+
+    The version is only bumped by writes committed in this process (after the commit), so the current TTL window
+    of the product cache is part of the tag too. With that, a write done by another process (like a bulk import)
+    is seen by the validators after at most ``product_cache_ttl`` seconds, the same staleness the product cache
+    already has.
+    """
+
+    product_cache = current_app.product_cache
+    window = _ttl_window()
+    window = time.time_ns() if window is None else window
+
+    key = f"{_BOOT_ID}:{product_cache.version}:{window}:{request.full_path}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def catalog_last_modified() -> datetime.datetime:
+    """
+    Last-Modified of the catalog, bounded by the same TTL window of ``catalog_etag``
+    It is the time of the last write committed in this process, but never older than the start of the current
+    window, so an ``If-Modified-Since`` sent before the window started doesn't match after a write of another process
+    """
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    window = _ttl_window()
+    if window is None:
+        return now.replace(microsecond=0)
+
+    window_start = datetime.datetime.fromtimestamp(
+        window * current_app.product_cache.by_id.ttl, datetime.timezone.utc)
+    return max(current_app.product_cache.last_modified, window_start).replace(microsecond=0)
+
+
+def conditional_get(view: Callable) -> Callable:
+    """
+    Decorator that adds ``ETag``, ``Last-Modified`` and ``Cache-Control`` to the successful responses of a view
+    When the client sends a matching ``If-None-Match`` (or ``If-Modified-Since``), the view isn't called at all:
+    a ``304 Not Modified`` is returned without querying or serializing anything.
+    The ``Cache-Control`` max-age is set by ``cache_max_age`` in the ``CATALOG`` section of config file.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+
+        # The validators are computed before running the view. If a write happens meanwhile,
+        # the response has an older tag than its content, so the client just fetches it again later
+        etag = catalog_etag()
+        last_modified = catalog_last_modified()
+        max_age = current_app.config["cfg"].getint("CATALOG", "cache_max_age", fallback=60)
+
+        not_modified = False
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        elif request.if_modified_since:
+            not_modified = last_modified <= request.if_modified_since
+
+        if not_modified:
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        return response
+
+    return wrapper
@@ -0,0 +1,214 @@
+import re
+import sys
+import unicodedata
+from typing import Iterable
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from alpha_store.models import db, Products
+from alpha_store.rebuild import PeriodicRebuild
+from alpha_store.tools import app_attribute
+from alpha_store.transactions import after_commit
+
+# Points given for each query token, according to how it matched a product name
+EXACT_MATCH = 3
+PREFIX_MATCH = 2
+SUBSTRING_MATCH = 1
+
+
+def normalize(text: str) -> str:
+    """Lower case the text and remove the accents, so ``Pokémon`` matches ``pokemon``"""
+
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+def tokenize(text: str) -> list:
+    return re.findall(r"\w+", normalize(text))
+
+
+def trigrams(token: str) -> set:
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+
+class ProductSearchIndex(PeriodicRebuild):
+
+    """
+    In-memory inverted index over the product names
+
+    Three posting maps are kept, all of them pointing to sets of product ids:
+    - ``tokens``: whole words, for exact matches
+    - ``prefixes``: every prefix (up to ``max_prefix_length`` chars) of every word, for prefix matches and autocomplete
+    - ``trigrams``: every 3 chars sequence of every word, for substring matches
+
+    The index follows the ``products`` table: the products committed by this process are applied right after
+    the commit and the whole index is rebuilt every ``rebuild_interval`` seconds (see ``PeriodicRebuild``).
+    """
+
+    def __init__(self, max_prefix_length: int = 10, rebuild_interval: float = 60) -> None:
+        super().__init__(rebuild_interval)
+        self.max_prefix_length = max_prefix_length
+
+        self._documents = {}  # product id -> (name, score, tokens)
+        self._tokens = {}
+        self._prefixes = {}
+        self._trigrams = {}
+
+    def _new(self) -> "ProductSearchIndex":
+        return ProductSearchIndex(self.max_prefix_length)
+
+    def _load_rows(self) -> Iterable[tuple]:
+        return db.session.query(Products.id, Products.name, Products.score)
+
+    def _swap(self, fresh: "ProductSearchIndex") -> None:
+        self._documents = fresh._documents
+        self._tokens = fresh._tokens
+        self._prefixes = fresh._prefixes
+        self._trigrams = fresh._trigrams
+
+    def _add(self, product_id: int, name: str, score: float) -> None:
+
+        self._remove(product_id)
+
+        tokens = tuple(dict.fromkeys(tokenize(name)))
+        self._documents[product_id] = (name, score, tokens)
+
+        for token in tokens:
+            self._tokens.setdefault(token, set()).add(product_id)
+            for size in range(1, min(len(token), self.max_prefix_length) + 1):
+                self._prefixes.setdefault(token[:size], set()).add(product_id)
+            for trigram in trigrams(token):
+                self._trigrams.setdefault(trigram, set()).add(product_id)
+
+    def _remove(self, product_id: int) -> None:
+
+        document = self._documents.pop(product_id, None)
+        if document is None:
+            return
+
+        for token in document[2]:
+            self._discard(self._tokens, token, product_id)
+            for size in range(1, min(len(token), self.max_prefix_length) + 1):
+                self._discard(self._prefixes, token[:size], product_id)
+            for trigram in trigrams(token):
+                self._discard(self._trigrams, trigram, product_id)
+
+    @staticmethod
+    def _discard(postings: dict, key: str, product_id: int) -> None:
+        ids = postings.get(key)
+        if ids is not None:
+            ids.discard(product_id)
+            if not ids:
+                del postings[key]
+
+    def _match_token(self, token: str) -> dict:
+        """Return a dict mapping each product id that matches ``token`` to the match points"""
+
+        matches = {}
+
+        # Substring matches, the trigrams give the candidates that are verified later
+        if len(token) >= 3:
+            candidates = None
+            for trigram in trigrams(token):
+                ids = self._trigrams.get(trigram, set())
+                candidates = ids if candidates is None else candidates & ids
+                if not candidates:
+                    break
+
+            for product_id in candidates or ():
+                if any(token in word for word in self._documents[product_id][2]):
+                    matches[product_id] = SUBSTRING_MATCH
+
+        # Prefix matches. Prefixes longer than ``max_prefix_length`` aren't indexed, so they are verified
+        for product_id in self._prefixes.get(token[:self.max_prefix_length], ()):
+            if len(token) <= self.max_prefix_length or \
+                    any(word.startswith(token) for word in self._documents[product_id][2]):
+                matches[product_id] = PREFIX_MATCH
+
+        for product_id in self._tokens.get(token, ()):
+            matches[product_id] = EXACT_MATCH
+
+        return matches
+
+    def search(self, query: str, limit: int = 10, sort_by: str = "relevance") -> list:
+        """
+        Return the ids of the products whose name matches every word of ``query``
+        ``sort_by`` can be ``relevance`` (exact word > prefix > substring, then score) or ``score``
+        """
+
+        query_tokens = list(dict.fromkeys(tokenize(query)))
+        if not query_tokens:
+            return []
+
+        with self._lock:
+            ranks = None
+            for token in query_tokens:
+                matches = self._match_token(token)
+                if ranks is None:
+                    ranks = matches
+                else:
+                    ranks = {product_id: rank + matches[product_id]
+                             for product_id, rank in ranks.items() if product_id in matches}
+                if not ranks:
+                    return []
+
+            documents = self._documents
+            if sort_by == "score":
+                ordered = sorted(ranks, key=lambda product_id: (
+                    -documents[product_id][1], -ranks[product_id], product_id))
+            else:
+                ordered = sorted(ranks, key=lambda product_id: (
+                    -ranks[product_id], -documents[product_id][1], product_id))
+
+            return ordered[:limit]
+
+    def autocomplete(self, prefix: str, limit: int = 10) -> list:
+        """Return the names of the best products that match ``prefix``, for typeahead"""
+
+        with self._lock:
+            names = (self._documents[product_id][0]
+                     for product_id in self.search(prefix, limit=limit * 2))
+            return list(dict.fromkeys(names))[:limit]
+
+    def memory_bytes(self) -> int:
+        """Rough estimation of the memory used by the index structures"""
+
+        with self._lock:
+            total = sys.getsizeof(self._documents)
+            for document in self._documents.values():
+                total += sys.getsizeof(document) + sys.getsizeof(document[0]) + sys.getsizeof(document[2])
+
+            for postings in (self._tokens, self._prefixes, self._trigrams):
+                total += sys.getsizeof(postings)
+                for key, ids in postings.items():
+                    total += sys.getsizeof(key) + sys.getsizeof(ids)
+
+            return total
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "documents": len(self._documents),
+            "tokens": len(self._tokens),
+            "prefixes": len(self._prefixes),
+            "trigrams": len(self._trigrams),
+            "memory_bytes": self.memory_bytes()
+        }
+
+
+@event.listens_for(Products, "after_insert")
+@event.listens_for(Products, "after_update")
+def _index_product(mapper, connection, product: Products) -> None:
+
+    index = app_attribute("search_index")
+    if index is not None:
+        after_commit(object_session(product), index.add, product.id, product.name, product.score)
+
+
+@event.listens_for(Products, "after_delete")
+def _unindex_product(mapper, connection, product: Products) -> None:
+
+    index = app_attribute("search_index")
+    if index is not None:
+        after_commit(object_session(product), index.remove, product.id)
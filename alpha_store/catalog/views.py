@@ -1,13 +1,40 @@
-from flask import Blueprint, request, current_app, Flask, jsonify
-from alpha_store.models import Products
-from collections import OrderedDict
-import pandas as pd
+from flask import Blueprint, request, current_app, Flask, Response, stream_with_context
+from sqlalchemy import tuple_, literal, select
+from alpha_store.models import db, Products
+from alpha_store.catalog.search import ProductSearchIndex
+from alpha_store.catalog.facets import FacetEngine, as_datetime
+from alpha_store.catalog.http_cache import conditional_get
+from alpha_store.serialization import dumps, encoded_product, spliced_json_response
+from alpha_store.tools import encode_cursor, decode_cursor
+import time
+import zlib
 
 catalog = Blueprint("catalog", __name__, url_prefix="/apis/v1/catalog")
 
+# Listing queries select these columns instead of ``Products`` entities, so each row can be turned
+# into the response dict directly, skipping the ORM instance and the identity map.
+# The table columns are the same keys returned by ``Products.to_dict``
+PRODUCT_COLUMNS = tuple(Products.__table__.columns)
+
+# Python types accepted for the sort value stored in a ``get_products`` cursor
+CURSOR_VALUE_TYPES = {
+    "name": (str,),
+    "price": (int, float),
+    "score": (int, float),
+}
+
 
 def configure(app: Flask) -> None:
 
+    app.search_index = ProductSearchIndex(
+        max_prefix_length=app.config["cfg"].getint("CATALOG", "search_max_prefix_length", fallback=10),
+        rebuild_interval=app.config["cfg"].getfloat("CATALOG", "search_rebuild_interval", fallback=60))
+
+    price_buckets = app.config["cfg"].get("CATALOG", "price_buckets", fallback="0,25,50,100,250")
+    app.facet_engine = FacetEngine(
+        price_buckets=[float(bucket) for bucket in price_buckets.split(",")],
+        rebuild_interval=app.config["cfg"].getfloat("CATALOG", "facets_rebuild_interval", fallback=60))
+
     app.register_blueprint(catalog)
     app.logger.info("Catalog configured")
 
@@ -20,17 +47,30 @@ def index():
     }, 200
 
 
+@catalog.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    """
+    Hit/miss counters of the product cache used by ``get_products_by_id`` and ``get_products_by_name``
+    """
+
+    return {
+        "message": "Cache stats",
+        "status_code": 200,
+        "product_cache": current_app.product_cache.stats()
+    }, 200
+
+
 @catalog.route("/get_products_by_id/<int:product_id>", methods=["GET"])
+@conditional_get
 def get_products_by_id(product_id):
 
-    product = Products.query.filter_by(id=product_id).first()
+    product = Products.get_by_id(product_id)
 
     if product:
-        return {
+        return spliced_json_response({
             "message": "Product found",
             "status_code": 200,
-            "product": product.to_dict()
-        }, 200
+        }, 200, product=encoded_product(product))
 
     return {
         "message": "Product not found",
@@ -40,16 +80,16 @@ def get_products_by_id(product_id):
 
 
 @catalog.route("/get_products_by_name/<string:product_name>", methods=["GET"])
+@conditional_get
 def get_products_by_name(product_name):
 
-    product = Products.query.filter_by(name=product_name).first()
+    product = Products.get_by_name(product_name)
 
     if product:
-        return {
+        return spliced_json_response({
             "message": "Product found",
             "status_code": 200,
-            "product": product.to_dict()
-        }, 200
+        }, 200, product=encoded_product(product))
 
     return {
         "message": "Product not found",
@@ -58,26 +98,222 @@ def get_products_by_name(product_name):
     }, 404
 
 
+@catalog.route("/get_products_by_ids", methods=["GET"])
+@conditional_get
+def get_products_by_ids():
+    """
+    Fetch many products in a single request, like ``/get_products_by_ids?ids=1,2,3``
+    The products are returned in the same order of ``ids`` (duplicates are ignored) and the ids
+    that don't exist are listed in ``missing_ids``. All products are loaded with a single query
+    (or none at all, if they are cached).
+    The max number of ids per request is set by ``max_batch_size`` in the ``CATALOG`` section of config file.
+    """
+
+    raw_ids = request.args.get("ids", "", type=str)
+    max_batch_size = current_app.config["cfg"].getint("CATALOG", "max_batch_size", fallback=100)
+
+    try:
+        # dict.fromkeys removes the duplicates keeping the input order
+        product_ids = list(dict.fromkeys(
+            int(product_id) for product_id in raw_ids.split(",") if product_id.strip()))
+    except ValueError:
+        return {
+            "message": f"Invalid ids: {raw_ids}",
+            "status_code": 400,
+        }, 400
+
+    if not product_ids:
+        return {
+            "message": "No ids provided",
+            "status_code": 400,
+        }, 400
+
+    if len(product_ids) > max_batch_size:
+        return {
+            "message": f"Too many ids, the max batch size is {max_batch_size}",
+            "status_code": 400,
+        }, 400
+
+    found = Products.get_many_by_id(product_ids)
+
+    return spliced_json_response({
+        "message": "Products found" if found else "No products found",
+        "status_code": 200,
+        "missing_ids": [product_id for product_id in product_ids if product_id not in found]
+    }, 200, products=[encoded_product(found[product_id]) for product_id in product_ids if product_id in found])
+
+
+@catalog.route("/search", methods=["GET"])
+def search():
+    """
+    Search the products by name, like ``/search?q=super mar``
+    Every word of ``q`` must match a word of the product name, exactly, as a prefix or as a substring.
+    The results are ranked by relevance (exact > prefix > substring), or by the product score when ``sort_by=score``.
+    The search runs against an in-memory index (see ``alpha_store.catalog.search``), the database
+    is only used to load the returned products, that are usually cached, and to rebuild the index
+    every ``search_rebuild_interval`` seconds (``CATALOG`` section of config file).
+    """
+
+    query = request.args.get("q", "", type=str).strip()
+    limit = request.args.get("limit", 10, type=int)
+    limit = limit if limit < 10 else 10
+    sort_by = request.args.get("sort_by", "relevance", type=str).lower()
+
+    if not query:
+        return {
+            "message": "No query provided",
+            "status_code": 400,
+        }, 400
+
+    if limit < 1:
+        return {
+            "message": "Invalid limit: it must be >= 1",
+            "status_code": 400,
+        }, 400
+
+    if sort_by not in ("relevance", "score"):
+        return {
+            "message": f"Invalid sort_by field: {sort_by}",
+            "status_code": 400,
+        }, 400
+
+    index = current_app.search_index
+    index.ensure_built()
+
+    started = time.perf_counter()
+    product_ids = index.search(query, limit=limit, sort_by=sort_by)
+    took_ms = (time.perf_counter() - started) * 1000
+
+    found = Products.get_many_by_id(product_ids)
+
+    return spliced_json_response({
+        "message": "Products found" if found else "No products found",
+        "status_code": 200,
+        "took_ms": round(took_ms, 3)
+    }, 200, products=[encoded_product(found[product_id]) for product_id in product_ids if product_id in found])
+
+
+@catalog.route("/search/autocomplete", methods=["GET"])
+def autocomplete():
+    """
+    Suggest product names for a typeahead, like ``/search/autocomplete?q=zel``
+    It only uses the search index, so it only touches the database when the index is (re)built
+    """
+
+    query = request.args.get("q", "", type=str).strip()
+    limit = request.args.get("limit", 5, type=int)
+    limit = limit if limit < 10 else 10
+
+    if limit < 1:
+        return {
+            "message": "Invalid limit: it must be >= 1",
+            "status_code": 400,
+        }, 400
+
+    index = current_app.search_index
+    index.ensure_built()
+
+    return {
+        "message": "Suggestions found",
+        "status_code": 200,
+        "suggestions": index.autocomplete(query, limit=limit) if query else []
+    }, 200
+
+
+@catalog.route("/search/stats", methods=["GET"])
+def search_stats():
+    """Size of the search index, how long it took to build and how much memory it uses"""
+
+    index = current_app.search_index
+    index.ensure_built()
+
+    return {
+        "message": "Search index stats",
+        "status_code": 200,
+        "search_index": index.stats()
+    }, 200
+
+
+def _get_product_filters() -> dict:
+    """
+    Read the ``get_products`` filters from the query string
+    Raises ``ValueError`` with the name of the invalid parameter
+    """
+
+    parsers = {
+        "category": str,
+        "min_price": float,
+        "max_price": float,
+        "min_score": float,
+        "max_score": float,
+        "released_after": as_datetime,
+        "released_before": as_datetime,
+    }
+
+    filters = {}
+    for name, parser in parsers.items():
+        value = request.args.get(name, None, type=str)
+        if value is None or value == "":
+            continue
+        try:
+            filters[name] = parser(value)
+        except (ValueError, TypeError) as exc:
+            raise ValueError(name) from exc
+
+    return filters
+
+
+def _filter_products(query, filters: dict):
+    """Apply the filters from ``_get_product_filters`` to a products query"""
+
+    conditions = {
+        "category": lambda value: Products.category == value,
+        "min_price": lambda value: Products.price >= value,
+        "max_price": lambda value: Products.price <= value,
+        "min_score": lambda value: Products.score >= value,
+        "max_score": lambda value: Products.score <= value,
+        "released_after": lambda value: Products.release_date >= value,
+        "released_before": lambda value: Products.release_date <= value,
+    }
+
+    for name, value in filters.items():
+        query = query.filter(conditions[name](value))
+    return query
+
+
 @catalog.route("/get_products", methods=["GET"])
+@conditional_get
 def get_all_products():
+    """
+    List the products, sorted by ``sort_by`` (name, price or score) and ``sort_type`` (asc or desc).
+    The sorting is done by the database, using the product id as tiebreaker, so the order is global and stable.
+
+    Two pagination modes are supported:
+    - ``start``/``limit``: the classic offset pagination. Deep offsets are expensive, since the database
+      needs to scan and discard every row before ``start``.
+    - ``cursor``/``limit``: keyset pagination. The ``next_cursor`` returned by the previous page is sent back
+      and the database seeks directly to the next row, so any page costs the same as the first one.
+
+    ``next_cursor`` is returned in both modes (even when no product is found) and is ``null`` on the last page.
+    Negative ``start`` or ``limit`` values are rejected with a 400.
+
+    The products can be filtered by ``category``, ``min_price``/``max_price``, ``min_score``/``max_score`` and
+    ``released_after``/``released_before`` (ISO dates). With ``facets=true``, the response also has the number of
+    products per category and per price bucket matching the filters. These counts come from the precomputed
+    ``FacetEngine``, so no extra GROUP BY query is done. The engine is rebuilt every ``facets_rebuild_interval``
+    seconds (``CATALOG`` section of config file), so the counts may lag behind writes done by other processes.
+    """
 
     start = request.args.get("start", 0, type=int)
     limit = request.args.get("limit", 10, type=int)
     limit = limit if limit < 10 else 10  # Limit the max number of products to 10
+    cursor = request.args.get("cursor", None, type=str)
 
-    products = Products.query.order_by(
-        Products.id).slice(start, start + limit).all()
-
-    if not products:
+    if start < 0 or limit < 1:
         return {
-            "message": "No products found",
-            "status_code": 200,
-            "products": []
-        }, 200
-
-    # To create the filters, Pandas is the easiest way but it can be expensive
-    # Just using some manipulations with SQLAlchemy and python built-in's, we can get the same result
-    # However, since Pandas is a ``Desirable requirement`` for this position, I'll use it
+            "message": "Invalid pagination: start must be >= 0 and limit must be >= 1",
+            "status_code": 400,
+        }, 400
 
     # Get the filters from the query string
     sort_by = request.args.get("sort_by", 'name', type=str).lower()
@@ -98,21 +334,133 @@ def get_all_products():
             "status_code": 400,
         }, 400
 
-    # Convert the sort_type to boolean
-    sort_type = sort_type == "asc"
+    try:
+        filters = _get_product_filters()
+    except ValueError as exc:
+        return {
+            "message": f"Invalid filter: {exc}",
+            "status_code": 400,
+        }, 400
 
-    # Sort the products
-    if sort_by:
-        products = pd.DataFrame(product.to_dict() for product in products)
-        products.sort_values(by=sort_by, inplace=True,
-                             ascending=sort_type)
+    with_facets = request.args.get("facets", "false", type=str).lower() in ("true", "1")
+
+    sort_column = getattr(Products, sort_by)
+    ascending = sort_type == "asc"
+
+    # The id is used as tiebreaker, so rows with the same sort value always come in the same order
+    # and the pair (sort value, id) can be used as the keyset position
+    query = db.session.query(*PRODUCT_COLUMNS)
+    if ascending:
+        query = query.order_by(sort_column.asc(), Products.id.asc())
+    else:
+        query = query.order_by(sort_column.desc(), Products.id.desc())
+
+    query = _filter_products(query, filters)
+
+    if cursor:
+        try:
+            position = decode_cursor(cursor)
+            if (position.get("sort_by"), position.get("sort_type")) != (sort_by, sort_type):
+                raise ValueError("Cursor was generated for another sort order")
+            last_value, last_id = position["value"], position["id"]
+
+            # A forged cursor could carry any JSON value, only the type of the sort column (and an int id)
+            # can reach the query. ``bool`` is a subclass of ``int``, so it's rejected explicitly
+            if isinstance(last_value, bool) or not isinstance(last_value, CURSOR_VALUE_TYPES[sort_by]):
+                raise ValueError(f"Invalid cursor value for {sort_by}: {last_value!r}")
+            if isinstance(last_id, bool) or not isinstance(last_id, int):
+                raise ValueError(f"Invalid cursor id: {last_id!r}")
+        except (ValueError, KeyError, TypeError) as exc:
+            current_app.logger.debug(f"Invalid cursor {cursor}: {exc}")
+            return {
+                "message": "Invalid cursor",
+                "status_code": 400,
+            }, 400
+
+        # Row value comparison: (sort_column, id) > (last_value, last_id)
+        # It can be satisfied by an index on (sort_column, id) without scanning the previous pages
+        keyset = tuple_(sort_column, Products.id)
+        if ascending:
+            query = query.filter(keyset > tuple_(literal(last_value), literal(last_id)))
+        else:
+            query = query.filter(keyset < tuple_(literal(last_value), literal(last_id)))
+    else:
+        query = query.offset(start)
+
+    # One extra row tells if there is a next page, so the last page never gets a ``next_cursor``
+    products = query.limit(limit + 1).all()
+    has_next_page = len(products) > limit
+    products = products[:limit]
+
+    facets = {}
+    if with_facets:
+        current_app.facet_engine.ensure_built()
+        facets["facets"] = current_app.facet_engine.facets(**filters)
 
-        products = products.to_dict(orient="records")
+    if not products:
+        return {
+            "message": "No products found",
+            "status_code": 200,
+            "products": [],
+            "next_cursor": None,
+            **facets
+        }, 200
 
-    return {
+    next_cursor = None
+    if has_next_page:
+        last_product = products[-1]
+        next_cursor = encode_cursor({
+            "sort_by": sort_by,
+            "sort_type": sort_type,
+            "value": getattr(last_product, sort_by),
+            "id": last_product.id
+        })
+
+    return spliced_json_response({
         "message": "Products found",
         "status_code": 200,
-        "products": products
-    }, 200
-
-
+        "next_cursor": next_cursor,
+        **facets
+    }, 200, products=[encoded_product(product) for product in products])
+
+
+@catalog.route("/export", methods=["GET"])
+def export():
+    """
+    Stream the whole catalog as newline delimited JSON (one product per line), ordered by id.
+    The rows are fetched with ``yield_per``, so the database driver streams them in batches of ``export_batch_size``
+    (``CATALOG`` section of config file) and the memory stays flat regardless of the catalog size.
+
+    Query parameters:
+    - ``after_id``: resume an interrupted export, sending the last id received
+    - ``gzip``: when ``true``, the stream is gzip compressed (``Content-Encoding: gzip``)
+    """
+
+    after_id = request.args.get("after_id", 0, type=int)
+    compress = request.args.get("gzip", "false", type=str).lower() in ("true", "1")
+    batch_size = current_app.config["cfg"].getint("CATALOG", "export_batch_size", fallback=500)
+
+    def generate_lines():
+        statement = select(*PRODUCT_COLUMNS).where(Products.id > after_id).order_by(
+            Products.id).execution_options(yield_per=batch_size)
+
+        # Each partition is a batch of ``batch_size`` rows, sent as a single chunk
+        for rows in db.session.execute(statement).partitions():
+            yield b"".join(dumps(row._asdict()) + b"\n" for row in rows)
+
+    def generate_gzip():
+        compressor = zlib.compressobj(wbits=31)  # 31 = gzip container
+        for chunk in generate_lines():
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    response = Response(
+        stream_with_context(generate_gzip() if compress else generate_lines()),
+        mimetype="application/x-ndjson")
+
+    if compress:
+        response.headers["Content-Encoding"] = "gzip"
+
+    return response
@@ -0,0 +1,158 @@
+import gzip
+import hashlib
+import zlib
+from typing import Iterable, Optional
+
+import flask
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+from alpha_store.cache import LRUCache, MISSING
+
+# brotli is optional, only gzip and deflate are offered when it isn't installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content types that are already compressed, compressing them again only wastes CPU
+SKIPPED_CONTENT_TYPES = (
+    "image/", "video/", "audio/", "font/woff",
+    "application/zip", "application/gzip", "application/x-gzip", "application/pdf", "application/octet-stream",
+)
+
+
+class CompressionMiddleware:
+
+    """
+    WSGI middleware that compresses the responses with brotli, gzip or deflate, following ``Accept-Encoding``
+
+    Only responses with a known ``Content-Length`` of at least ``min_size`` bytes are compressed, so streamed
+    responses (like the catalog export, that does its own compression) pass through untouched, as well as
+    responses that already have a ``Content-Encoding`` or a compressed content type.
+    ``Vary: Accept-Encoding`` is added to every response that could be compressed, even when it isn't (HEAD
+    requests or clients that don't accept any of the encodings).
+
+    The compressed bytes are kept in a small LRU cache keyed by the body digest, so cacheable payloads that
+    are served many times (catalog pages, rendered reports) are compressed only once.
+    Responses with ``Cache-Control: private`` or ``no-store`` are never kept in the cache.
+    """
+
+    def __init__(self, app, min_size: int = 1024, level: int = 6, cache_size: int = 256,
+                 cache_ttl: float = 300, enable_brotli: bool = True) -> None:
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+
+        self.encodings = ["gzip", "deflate"]
+        if enable_brotli and brotli is not None:
+            self.encodings.insert(0, "br")
+
+    def _choose_encoding(self, accept_encoding: str) -> Optional[str]:
+        """Return the preferred encoding accepted by the client, the server preference breaks the ties"""
+
+        accepted = parse_accept_header(accept_encoding)
+        best, best_quality = None, 0
+        for encoding in self.encodings:
+            quality = accepted[encoding]
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def _compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=min(self.level, 11))
+        if encoding == "gzip":
+            return gzip.compress(body, compresslevel=self.level, mtime=0)
+        return zlib.compress(body, self.level)
+
+    def _should_compress(self, status: str, headers: Headers) -> bool:
+
+        if status[:3] in ("204", "206", "304") or "Content-Encoding" in headers:
+            return False
+
+        if "no-transform" in headers.get("Cache-Control", ""):
+            return False
+
+        content_type = headers.get("Content-Type", "")
+        if content_type.startswith(SKIPPED_CONTENT_TYPES):
+            return False
+
+        content_length = headers.get("Content-Length", type=int)
+        return content_length is not None and content_length >= self.min_size
+
+    def __call__(self, environ: dict, start_response) -> Iterable[bytes]:
+
+        captured = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            captured.update(status=status, headers=Headers(headers), exc_info=exc_info)
+            # The write callable is never used by flask, but buffer it anyway to follow the WSGI spec
+            return captured.setdefault("written", []).append
+
+        app_iter = self.app(environ, capture_start_response)
+        status, headers = captured["status"], captured["headers"]
+
+        if not self._should_compress(status, headers):
+            start_response(status, headers.to_wsgi_list(), captured["exc_info"])
+            return app_iter
+
+        # The representation depends on ``Accept-Encoding`` even when this client gets the identity body,
+        # otherwise a shared cache could serve the identity body to gzip clients (and the reverse)
+        if "accept-encoding" not in headers.get("Vary", "").lower():
+            headers.add("Vary", "Accept-Encoding")
+
+        # A HEAD response has no body to compress, its ``Content-Length`` is the one of the identity body
+        encoding = self._choose_encoding(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        if encoding is None or environ.get("REQUEST_METHOD") == "HEAD":
+            start_response(status, headers.to_wsgi_list(), captured["exc_info"])
+            return app_iter
+
+        try:
+            body = b"".join(captured.get("written", [])) + b"".join(app_iter)
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+
+        cache_control = headers.get("Cache-Control", "")
+        cacheable = "private" not in cache_control and "no-store" not in cache_control
+
+        key = (encoding, hashlib.blake2b(body, digest_size=16).digest())
+        compressed = self.cache.get(key) if cacheable else MISSING
+        if compressed is MISSING:
+            compressed = self._compress(body, encoding)
+            if cacheable:
+                self.cache.set(key, compressed)
+
+        headers["Content-Encoding"] = encoding
+        headers["Content-Length"] = str(len(compressed))
+
+        # The compressed body is another representation, so a strong validator must become weak
+        etag = headers.get("ETag")
+        if etag and not etag.startswith("W/"):
+            headers["ETag"] = f"W/{etag}"
+
+        start_response(status, headers.to_wsgi_list(), captured["exc_info"])
+        return [compressed]
+
+
+def configure(app: flask.Flask) -> None:
+    """Wrap the app with ``CompressionMiddleware``, using the ``COMPRESSION`` section of config file"""
+
+    cfg = app.config["cfg"]
+
+    if not cfg.getboolean("COMPRESSION", "enabled", fallback=True):
+        app.logger.info("Response compression disabled")
+        return
+
+    app.wsgi_app = CompressionMiddleware(
+        app.wsgi_app,
+        min_size=cfg.getint("COMPRESSION", "min_size", fallback=1024),
+        level=cfg.getint("COMPRESSION", "level", fallback=6),
+        cache_size=cfg.getint("COMPRESSION", "cache_size", fallback=256),
+        cache_ttl=cfg.getfloat("COMPRESSION", "cache_ttl", fallback=300),
+        enable_brotli=cfg.getboolean("COMPRESSION", "brotli", fallback=True)
+    )
+
+    app.logger.info("Response compression configured")
@@ -1,7 +1,14 @@
 import flask
 
 from alpha_store import tools
+from alpha_store.cache import configure as configure_caches
+from alpha_store.serialization import configure as configure_json
+from alpha_store.compression import configure as configure_compression
 from alpha_store.models import configure as configure_auth_models
+from alpha_store.auth.passwords import configure as configure_password_hasher
+from alpha_store.auth.tokens import configure as configure_tokens
+from alpha_store.analytics.ingest import configure as configure_sales_ingest
+from alpha_store.analytics.rollup import configure as configure_sales_rollup
 from alpha_store.auth.views import configure as configure_auth_views
 from alpha_store.catalog.views import configure as configure_catalog_views
 from alpha_store.analytics.views import configure as configure_analytics_views
@@ -22,14 +29,27 @@ def create_app(test_mode: Optional[bool] = False) -> flask.Flask:
     tools.load_config(app)
     tools.setup_loguru(app)
 
+    # Configure the JSON provider, used by every response
+    configure_json(app)
+
+    # Configure caches, before models and views, since both of them use it
+    configure_caches(app)
+
     # Configure models
     configure_auth_models(app)
+    configure_password_hasher(app)
+    configure_tokens(app)
+    configure_sales_ingest(app)
+    configure_sales_rollup(app)
 
     # Configure views
     configure_auth_views(app)
     configure_catalog_views(app)
     configure_analytics_views(app)
 
+    # Compress the responses, it wraps the whole wsgi app
+    configure_compression(app)
+
     app.logger.info("App started")
 
     return app
@@ -2,6 +2,15 @@ import flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event, inspect, literal, tuple_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import make_transient_to_detached, object_session, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+
+from alpha_store.cache import MISSING
+from alpha_store.pricing import shipping_cost
+from alpha_store.tools import app_attribute
+from alpha_store.transactions import after_commit
 
 from typing import Union, Optional
 
@@ -57,17 +66,67 @@ def configure(app: flask.Flask) -> None:
     app.logger.info("Auth models configured")
 
 
+# Columns kept by the user identity cache. The password hash is left out on purpose,
+# it's loaded from the database only when it's accessed (at login, for example)
+USER_IDENTITY_COLUMNS = ("id", "username", "email", "joined_at")
+
+
 @login_manager.user_loader
 def load_user(user_id: Union[int, str]) -> Optional["User"]:
-    return User.query.get(int(user_id))
+    """
+    Called on every request of a logged user, so the user identity is cached to skip the ``users`` query
+    The cached identity is turned back into a ``User`` attached to the current session, without any query
+    """
+
+    user_id = int(user_id)
+    cache = app_attribute("user_cache")
+
+    identity = cache.get(user_id) if cache is not None else MISSING
+    if identity is not MISSING:
+        return user_from_identity(dict(zip(USER_IDENTITY_COLUMNS, identity)))
+
+    user = db.session.get(User, user_id)
+    if cache is not None and user is not None:
+        cache.set(user_id, tuple(getattr(user, column) for column in USER_IDENTITY_COLUMNS))
+    return user
+
+
+def user_from_identity(identity: dict) -> "User":
+    """
+    Turn some known columns of a user (at least the ``id``) into a ``User`` attached to the session, without a query
+    The other columns are loaded from the database only if they are accessed
+    """
+
+    # An instance already in the session is more recent than the given identity
+    key = inspect(User).identity_key_from_primary_key((identity["id"],))
+    user = db.session.identity_map.get(key)
+    if user is not None:
+        return user
+
+    # ``new_instance`` skips ``User.__init__``, that would hash the password again
+    user = User.__mapper__.class_manager.new_instance()
+    for column, value in identity.items():
+        set_committed_value(user, column, value)
+
+    make_transient_to_detached(user)
+    db.session.add(user)
+    return user
+
+
+def invalidate_user_cache(user_id: int) -> None:
+    cache = app_attribute("user_cache")
+    if cache is not None:
+        cache.delete(user_id)
 
 
 # Association table for many to many relationship
+# Each (cart, product) pair has a single row, adding the same product again increments its quantity
 cart_products_association = db.Table(
     'cart_product', db.Model.metadata,
-    db.Column('cart_id', db.Integer, db.ForeignKey('cart.id')),
+    db.Column('cart_id', db.Integer, db.ForeignKey('cart.id'), primary_key=True),
     db.Column('product_id', db.Integer,
-              db.ForeignKey('products.id'))
+              db.ForeignKey('products.id'), primary_key=True),
+    db.Column('quantity', db.Integer, nullable=False, default=1, server_default="1")
 )
 
 order_products_association = db.Table(
@@ -106,10 +165,35 @@ class User(db.Model, UserMixin):
         self.hash_password()
 
     def hash_password(self) -> None:
-        self.password = generate_password_hash(self.password)
+        """Hash the password with ``app.password_hasher``, may raise ``TimeoutError`` when it's overloaded"""
+
+        hasher = app_attribute("password_hasher")
+        if hasher is None:
+            self.password = generate_password_hash(self.password)
+        else:
+            self.password = hasher.hash(self.password)
 
     def check_password(self, password: str) -> bool:
-        return check_password_hash(self.password, password)
+
+        hasher = app_attribute("password_hasher")
+        if hasher is None:
+            return check_password_hash(self.password, password)
+        return hasher.verify(self.password, password)
+
+    def rehash_password(self, password: str) -> bool:
+        """
+        Hash the password again if it was hashed with other method or cost than the configured ones
+        Must be called with the plain password, right after a successful ``check_password``
+        Returns ``True`` if the hash was updated
+        """
+
+        hasher = app_attribute("password_hasher")
+        if hasher is None or not hasher.needs_rehash(self.password):
+            return False
+
+        self.password = hasher.hash(password)
+        db.session.commit()
+        return True
 
     def save(self) -> None:
         db.session.add(self)
@@ -126,88 +210,184 @@ class User(db.Model, UserMixin):
             "joined_at": self.joined_at
         }
 
-    def add_to_cart(self, product_id: int):
+    def add_to_cart(self, product_id: int, quantity: int = 1, max_quantity: Optional[int] = None):
         """
         Search for given product id and add it to the user cart if it exists
         This method is called by the ``apis/v1/users/cart/add-to-cart`` endpoint
+
+        The cart products are never loaded: the product is added with a single ``INSERT ... SELECT`` on ``cart_product``,
+        that also works as the existence check (nothing is inserted when the product doesn't exist).
+        If the product is already in the cart, the ``ON CONFLICT`` clause increments its quantity atomically,
+        up to ``max_quantity`` when it's given. So the cost of adding a product doesn't depend on the cart size.
         """
-        product = Products.query.filter_by(id=product_id).first()
-        if not product:
-            raise ValueError("Product not found")
+
+        if quantity < 1:
+            raise ValueError("Invalid quantity")
 
         if not self.cart:
             self.cart = Cart()
             self.cart.save()
 
-        self.cart.products.append(product)
+        statement = postgresql.insert(cart_products_association).from_select(
+            ["cart_id", "product_id", "quantity"],
+            db.select(db.literal(self.cart.id), Products.id, db.literal(quantity)).where(Products.id == product_id)
+        )
+        total = cart_products_association.c.quantity + statement.excluded.quantity
+        if max_quantity is not None:
+            total = db.func.least(total, max_quantity)
+
+        statement = statement.on_conflict_do_update(
+            index_elements=["cart_id", "product_id"],
+            set_={"quantity": total}
+        )
+
+        if db.session.execute(statement).rowcount == 0:
+            db.session.rollback()
+            raise ValueError("Product not found")
+
         db.session.commit()
 
     def get_cart(self) -> dict:
-        if not self.cart:
+        """
+        Return the cart lines and its totals (subtotal, total items and shipping cost)
+        Everything comes from a single query (see ``_cart_lines_statement``)
+        """
+
+        rows = db.session.execute(_cart_lines_statement(self.id)).all()
+
+        if not rows:
             self.cart = Cart()
             self.cart.save()
+            return self.get_cart()
+
+        product_columns = [column.key for column in Products.__table__.columns]
+        products = [
+            dict({column: getattr(row, column) for column in product_columns}, quantity=row.quantity)
+            for row in rows if row.quantity is not None
+        ]
+        total_items = int(rows[0].total_items)
 
         return {
-            "cart_id": self.cart.id,
-            "added_at": self.cart.added_at,
-            "products": [product.to_dict() for product in self.cart.products]
+            "cart_id": rows[0].cart_id,
+            "added_at": rows[0].cart_added_at,
+            "products": products,
+            "subtotal": rows[0].subtotal,
+            "total_items": total_items,
+            "shipping_cost": shipping_cost(total_items)
         }
 
-    def remove_from_cart(self, product_id: int):
+    def remove_from_cart(self, product_id: int, quantity: int = 1):
+        """
+        Remove ``quantity`` units of the given product from the user cart
+        The quantity is decremented in place when there are more units than that, otherwise the cart line is deleted.
+        The number of affected rows tells if the product was in the cart, so the cart products are never loaded
+        """
 
-        product = Products.query.filter_by(id=product_id).first()
-        if not product:
-            raise ValueError("Product not found")
+        if quantity < 1:
+            raise ValueError("Invalid quantity")
 
         if not self.cart:
-            self.cart = Cart()
-            self.cart.save()
-
-        # check if product is in cart
-        if product not in self.cart.products:
             raise ValueError("Product not in cart")
 
-        self.cart.products.remove(product)
+        line = db.and_(
+            cart_products_association.c.cart_id == self.cart.id,
+            cart_products_association.c.product_id == product_id
+        )
+
+        decrement = cart_products_association.update().where(
+            line, cart_products_association.c.quantity > quantity
+        ).values(quantity=cart_products_association.c.quantity - quantity)
+
+        if db.session.execute(decrement).rowcount == 0:
+            if db.session.execute(cart_products_association.delete().where(line)).rowcount == 0:
+                db.session.rollback()
+                raise ValueError("Product not in cart")
+
         db.session.commit()
 
     def checkout(self):
+        """
+        Turn the user cart into an order, in a single transaction and without loading any ORM object:
+        1. the cart lines are deleted with ``DELETE ... RETURNING``, joined with their products in the same statement,
+           that also computes the order totals (window functions over the deleted lines, so they come in every row)
+        2. the order is inserted and its products and items are bulk inserted (executemany)
+        3. the sales records are handed to ``app.sales_ingestor``
+        Everything is committed once at the end, so the number of round trips doesn't depend on the cart size
+
+        The order is built from the rows actually deleted, so the lines are claimed atomically: a concurrent
+        checkout of the same cart gets no rows, and a concurrent ``add-to-cart`` either commits before
+        the delete (and its quantity is charged) or waits for it and creates a new line for the next checkout
+        """
 
-        if not self.cart:
+        claimed = cart_products_association.delete().where(
+            cart_products_association.c.cart_id.in_(db.select(Cart.id).where(Cart.user_id == self.id))
+        ).returning(
+            cart_products_association.c.product_id, cart_products_association.c.quantity
+        ).cte("claimed")
+
+        rows = db.session.execute(
+            db.select(
+                claimed.c.quantity,
+                db.func.sum(Products.price * claimed.c.quantity).over().label("subtotal"),
+                db.func.sum(claimed.c.quantity).over().label("total_items"),
+                *Products.__table__.columns
+            ).join_from(
+                claimed, Products, Products.id == claimed.c.product_id
+            ).order_by(Products.id)
+        ).all()
+
+        if not rows:
+            db.session.rollback()
             raise ValueError("Cart is empty")
 
-        order = Order(user_id=self.id, total_price=0, shipping_cost=0)
-        order.save()
+        order = Order(user_id=self.id, total_price=rows[0].subtotal,
+                      shipping_cost=shipping_cost(int(rows[0].total_items)))
+        db.session.add(order)
+        db.session.flush()
+
+        db.session.execute(
+            order_products_association.insert(),
+            [{"order_id": order.id, "product_id": row.id} for row in rows]
+        )
+
+        # Snapshot of the lines as they were sold, the order history is served from it
+        db.session.execute(
+            OrderItem.__table__.insert(),
+            [{"order_id": order.id, "product_id": row.id, "name": row.name, "unit_price": row.price,
+              "category": row.category, "quantity": row.quantity} for row in rows]
+        )
+
+        # Register the order in ``SalesRecord`` table
+        # This table don't stores any user information, just the product id, price and quantity
+        # Each cart line is a record, so the number of records doesn't depend on the quantities
+        # The sales ingestor writes them after the commit, off the request path (or right now, in sync mode)
+        flask.current_app.sales_ingestor.record(
+            [{"product_id": row.id, "product_price": row.price, "product_category": row.category,
+              "quantity": row.quantity} for row in rows]
+        )
 
-        total_price = 0
-        shipping_cost = 0
+        db.session.commit()
 
-        for product in self.cart.products:
-            total_price += product.price
-            shipping_cost += 10
-            order.products.append(product)
+    def get_orders(self, limit: int = 20, after: Optional[tuple] = None, summary: bool = False) -> list:
+        """
+        Return a page of the user orders as dicts, the newest first
+        ``after`` is the ``(added_at, id)`` of the last order of the previous page, the next page is found
+        with a row value comparison, served by the ``(user_id, added_at, id)`` index.
+        The items of the whole page are loaded with one extra query, or not at all when ``summary`` is true
+        """
 
-        order.total_price = total_price
-        order.shipping_cost = shipping_cost if shipping_cost <= 250 else 0
+        query = Order.query.filter(Order.user_id == self.id)
 
-        db.session.delete(self.cart)
-        db.session.commit()
+        if after is not None:
+            added_at, order_id = after
+            query = query.filter(tuple_(Order.added_at, Order.id) <
+                                 tuple_(literal(added_at, Order.added_at.type), literal(order_id)))
 
-        # Everything went well, then register the order in ``SalesRecord`` table
-        # This table don't stores any user information, just the product id and price
-        recorded_sales = []
-        for product in order.products:
-            recorded_sales.append(SalesRecord(
-                product_id=product.id,
-                product_price=product.price,
-                product_category=product.category
-            ))
-
-        db.session.bulk_save_objects(recorded_sales)
-        db.session.commit()
-
-    def get_orders(self) -> list:
+        if not summary:
+            query = query.options(selectinload(Order.items))
 
-        return [order.to_dict() for order in self.orders]
+        orders = query.order_by(Order.added_at.desc(), Order.id.desc()).limit(limit).all()
+        return [order.to_dict(include_products=not summary) for order in orders]
 
     @classmethod
     def get_user_by_email(cls, email: str) -> Optional["User"]:
@@ -218,6 +398,29 @@ class User(db.Model, UserMixin):
         return cls.query.filter_by(username=username).first()
 
 
+def _cart_lines_statement(user_id: int):
+    """
+    Select the user cart with its lines and products, one row per line
+    The cart is outer joined, so an empty cart still returns a row (with the line columns as ``NULL``)
+    and a user without cart returns no rows. ``subtotal`` and ``total_items`` are computed by the database
+    with window functions over the same rows, so they come in every row
+    """
+
+    line_total = Products.price * cart_products_association.c.quantity
+    return db.select(
+        Cart.id.label("cart_id"),
+        Cart.added_at.label("cart_added_at"),
+        cart_products_association.c.quantity,
+        db.func.coalesce(db.func.sum(line_total).over(), 0).label("subtotal"),
+        db.func.coalesce(db.func.sum(cart_products_association.c.quantity).over(), 0).label("total_items"),
+        *Products.__table__.columns
+    ).select_from(Cart).outerjoin(
+        cart_products_association, cart_products_association.c.cart_id == Cart.id
+    ).outerjoin(
+        Products, Products.id == cart_products_association.c.product_id
+    ).where(Cart.user_id == user_id).order_by(Products.id)
+
+
 class Cart(db.Model):
 
     __tablename__ = "cart"
@@ -226,13 +429,16 @@ class Cart(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     added_at = db.Column(db.DateTime, default=db.func.now())
     products = db.relationship(
-        "Products", secondary=cart_products_association, backref="carts")
+        "Products", secondary=cart_products_association, backref="carts", viewonly=True)
+
+    # The cart lines, with the quantity of each product. Deleting the cart deletes its lines
+    items = db.relationship("CartItem", backref="cart", cascade="all, delete-orphan")
 
     def to_dict(self) -> dict:
         return {
             "id": self.id,
             "user_id": self.user_id,
-            "quantity": self.quantity,
+            "quantity": sum(item.quantity for item in self.items),
             "added_at": self.added_at
         }
 
@@ -244,6 +450,22 @@ class Cart(db.Model):
         db.session.commit()
 
 
+class CartItem(db.Model):
+
+    """
+    A cart line: a product and how many units of it are in the cart
+    It is mapped to the ``cart_product`` association table, so it can be used with the ORM
+    while the cart mutations keep using direct statements on the table
+    """
+
+    __table__ = cart_products_association
+
+    product = db.relationship("Products")
+
+    def __repr__(self) -> str:
+        return f"<CartItem cart_id={self.cart_id} product_id={self.product_id} quantity={self.quantity}>"
+
+
 class Products(db.Model):
 
     __tablename__ = "products"
@@ -278,6 +500,117 @@ class Products(db.Model):
         db.session.add(self)
         db.session.commit()
 
+    @classmethod
+    def get_by_id(cls, product_id: int) -> Optional["Products"]:
+        """
+        Read-through lookup using the app product cache
+        The returned product is detached from the session, use ``db.session.merge(product, load=False)``
+        before using it in relationships
+        """
+
+        cache = app_attribute("product_cache")
+        if cache is not None:
+            product = cache.by_id.get(product_id)
+            if product is not MISSING:
+                return product
+
+        product = _detached_copy(cls.query.filter_by(id=product_id).first())
+
+        if cache is not None:
+            cache.by_id.set(product_id, product)
+        return product
+
+    @classmethod
+    def get_by_name(cls, name: str) -> Optional["Products"]:
+        """Same as ``get_by_id``, but looking for the first product with the given name"""
+
+        cache = app_attribute("product_cache")
+        if cache is not None:
+            product = cache.by_name.get(name)
+            if product is not MISSING:
+                return product
+
+        product = _detached_copy(cls.query.filter_by(name=name).first())
+
+        if cache is not None:
+            cache.by_name.set(name, product)
+        return product
+
+    @classmethod
+    def get_many_by_id(cls, product_ids: list) -> dict:
+        """
+        Batch version of ``get_by_id``
+        The products that aren't cached are loaded with a single ``WHERE id IN (...)`` query.
+        Returns a dict mapping each found id to its (detached) product, missing ids are not included
+        """
+
+        cache = app_attribute("product_cache")
+        found = {}
+        to_load = []
+
+        for product_id in product_ids:
+            product = cache.by_id.get(product_id) if cache is not None else MISSING
+            if product is MISSING:
+                to_load.append(product_id)
+            elif product is not None:
+                found[product_id] = product
+
+        if to_load:
+            loaded = {product.id: _detached_copy(product)
+                      for product in cls.query.filter(cls.id.in_(to_load)).all()}
+
+            for product_id in to_load:
+                product = loaded.get(product_id)
+                if cache is not None:
+                    cache.by_id.set(product_id, product)
+                if product is not None:
+                    found[product_id] = product
+
+        return found
+
+
+def _detached_copy(product: Optional[Products]) -> Optional[Products]:
+    """
+    Copy the loaded columns of a product to a new detached instance
+    The cached copy never shares state with the session that loaded it, so it can be safely used by other requests
+    """
+
+    if product is None:
+        return None
+
+    copy = Products(**{column.key: getattr(product, column.key)
+                    for column in Products.__table__.columns})
+    make_transient_to_detached(copy)
+    return copy
+
+
+# The caches are only invalidated after the commit: invalidating at flush time would let a concurrent
+# request cache the old committed row again, and keep it for the whole TTL.
+# They are invalidated after a rollback too, the flushed rows could have been cached by the same session
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_user_cache(mapper, connection, user: User) -> None:
+
+    cache = app_attribute("user_cache")
+    if cache is not None:
+        after_commit(object_session(user), cache.delete, user.id, on_rollback=True)
+
+
+@event.listens_for(Products, "after_insert")
+@event.listens_for(Products, "after_update")
+@event.listens_for(Products, "after_delete")
+def _invalidate_product_cache(mapper, connection, product: Products) -> None:
+
+    cache = app_attribute("product_cache")
+    if cache is None:
+        return
+
+    # When the name changes, the old name must be invalidated too
+    history = inspect(product).attrs.name.history
+    names = {product.name, *history.deleted}
+    after_commit(object_session(product), cache.invalidate, product.id, names, on_rollback=True)
+
 
 class Order(db.Model):
 
@@ -292,29 +625,70 @@ class Order(db.Model):
     products = db.relationship(
         "Products", secondary=order_products_association, backref="orders")
 
+    # The lines as they were sold, the products can change (or be deleted) after the checkout
+    items = db.relationship("OrderItem", order_by="OrderItem.product_id")
+
+    # Order history pages of a user, newest first
+    __table_args__ = (
+        db.Index("ix_orders_user_id_added_at", "user_id", "added_at", "id"),
+    )
+
     def save(self):
         db.session.add(self)
         db.session.commit()
 
-    def to_dict(self) -> dict:
-        return {
+    def to_dict(self, include_products: bool = True) -> dict:
+        order = {
             "id": self.id,
             "user_id": self.user_id,
             "added_at": self.added_at,
             "total_price": self.total_price,
             "shipping_cost": self.shipping_cost,
-            "products": [product.to_dict() for product in self.products]
         }
+        if include_products:
+            order["products"] = [item.to_dict() for item in self.items]
+        return order
 
     def __repr__(self) -> str:
         return f"<Order user_id={self.user_id}>"
 
 
+class OrderItem(db.Model):
+
+    """
+    A line of an order, with the product name, price and category copied at checkout time
+    So the order history shows the price paid and doesn't need to join the ``products`` table.
+    Like in ``SalesRecord``, the ``product_id`` is not a foreign key, because the product can be deleted
+    """
+
+    __tablename__ = "order_items"
+
+    # The primary key starts with ``order_id``, so the items of an order are read with a single range scan
+    order_id = db.Column(db.Integer, db.ForeignKey("orders.id"), primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    unit_price = db.Column(db.Float, nullable=False)
+    category = db.Column(db.String(64), nullable=True)
+    quantity = db.Column(db.Integer, nullable=False, default=1)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.product_id,
+            "name": self.name,
+            "price": self.unit_price,
+            "category": self.category,
+            "quantity": self.quantity
+        }
+
+    def __repr__(self) -> str:
+        return f"<OrderItem order_id={self.order_id}, product_id={self.product_id}>"
+
+
 class SalesRecord(db.Model):
 
     """
     This table will record all completes sale in this application and will be used in analytics package
-    It just stores the product id and price, no user information is stored
+    It just stores the product id, unit price and quantity sold, no user information is stored
     Also, the ``product_id`` is not a foreign key, because the product can be deleted from the database
     """
 
@@ -324,6 +698,7 @@ class SalesRecord(db.Model):
     product_id = db.Column(db.Integer, nullable=False)
     product_price = db.Column(db.Float, nullable=False)
     product_category = db.Column(db.String(64), nullable=True)
+    quantity = db.Column(db.Integer, nullable=False, default=1, server_default="1")
     sale_date = db.Column(db.DateTime, default=db.func.now())
 
     def save(self):
@@ -336,8 +711,53 @@ class SalesRecord(db.Model):
             "product_id": self.product_id,
             "product_price": self.product_price,
             "product_category": self.product_category,
+            "quantity": self.quantity,
             "sale_date": self.sale_date
         }
 
     def __repr__(self) -> str:
         return f"<SalesRecord product_id={self.product_id}>"
+
+
+class SalesDailyCategory(db.Model):
+
+    """
+    Rollup of ``SalesRecord`` by day and category, maintained by ``alpha_store.analytics.rollup``
+    The sales without category are stored with an empty ``category``, since it's part of the primary key
+    """
+
+    __tablename__ = "sales_daily_category"
+
+    day = db.Column(db.Date, primary_key=True)
+    category = db.Column(db.String(64), primary_key=True, default="")
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return f"<SalesDailyCategory day={self.day} category={self.category}>"
+
+
+class SalesDailyProduct(db.Model):
+
+    """Rollup of ``SalesRecord`` by day and product, maintained by ``alpha_store.analytics.rollup``"""
+
+    __tablename__ = "sales_daily_product"
+
+    day = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return f"<SalesDailyProduct day={self.day} product_id={self.product_id}>"
+
+
+class SalesRollupState(db.Model):
+
+    """High-water mark of the rollups: the last ``sales_record.id`` already added to them"""
+
+    __tablename__ = "sales_rollup_state"
+
+    name = db.Column(db.String(32), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=db.func.now(), onupdate=db.func.now())
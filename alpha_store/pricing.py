@@ -0,0 +1,13 @@
+# Pricing rules shared by the cart summary and the checkout, so both always agree
+
+SHIPPING_COST_PER_ITEM = 10
+FREE_SHIPPING_ABOVE = 250
+
+
+def shipping_cost(total_items: int) -> float:
+    """
+    The shipping cost is 10 for each item in the cart, but it is free when it would be above 250
+    """
+
+    cost = SHIPPING_COST_PER_ITEM * total_items
+    return cost if cost <= FREE_SHIPPING_ABOVE else 0
@@ -0,0 +1,127 @@
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+
+class PeriodicRebuild:
+
+    """
+    Base of the in-memory structures built from a table, like the search index, the facets and the
+    availability filters
+
+    The structure is built from the database on first use, the rows committed by this process are applied
+    right after the commit (see ``alpha_store.transactions``) and it is rebuilt every ``rebuild_interval``
+    seconds, since the writes of other processes (other workers, ``extra.py``, plain SQL) are only seen by
+    a rebuild. The rebuild loads the rows without holding the lock, so the readers keep using the current
+    structure meanwhile, and the writes received during the rebuild are applied again to the new structure
+    before it replaces the current one.
+
+    Subclasses implement:
+    - ``_new()``: an empty instance with the same settings, that the rebuild fills
+    - ``_load_rows()``: the rows of the table, as given to ``build``
+    - ``_add(*values)`` and ``_remove(key)``: add (or replace) and remove a row, called holding the lock
+    - ``_swap(fresh)``: take the structures of a filled instance, called holding the lock
+    ``_load(rows)`` adds the rows one by one, it can be overridden to fill the structure in bulk.
+    """
+
+    def __init__(self, rebuild_interval: float = 60) -> None:
+        self.rebuild_interval = rebuild_interval
+
+        self.built = False
+        self.built_at = 0.0
+        self.build_seconds = 0.0
+        self._lock = threading.RLock()
+
+        # Only one rebuild at a time. ``_changes`` collects the writes received while it runs
+        self._build_lock = threading.Lock()
+        self._changes = None
+
+    def build(self, rows: Iterable[tuple]) -> None:
+        """Build the structure from scratch, with the rows returned by ``_load_rows``"""
+
+        started = time.perf_counter()
+
+        with self._lock:
+            self._changes = []
+
+        try:
+            fresh = self._new()
+            fresh._load(rows)
+
+            with self._lock:
+                for method, args in self._changes:
+                    getattr(fresh, method)(*args)
+
+                self._swap(fresh)
+                self.built = True
+                self.built_at = time.monotonic()
+                self.build_seconds = time.perf_counter() - started
+        finally:
+            with self._lock:
+                self._changes = None
+
+    def is_stale(self) -> bool:
+        """``True`` when the structure was never built or its last build is older than ``rebuild_interval``"""
+
+        return not self.built or (self.rebuild_interval > 0 and
+                                  time.monotonic() - self.built_at >= self.rebuild_interval)
+
+    def ensure_built(self, load_rows: Optional[Callable[[], Iterable[tuple]]] = None) -> None:
+        """
+        Build the structure from the database if it wasn't built yet, or rebuild it when it is stale
+        Only the first build makes the other requests wait, a stale structure keeps being used while it is rebuilt
+        """
+
+        if not self.is_stale():
+            return
+
+        if not self._build_lock.acquire(blocking=not self.built):
+            return
+
+        try:
+            if self.is_stale():
+                self.build((load_rows or self._load_rows)())
+        finally:
+            self._build_lock.release()
+
+    def add(self, *values) -> None:
+        """Add or replace a row, with the values of ``_add``"""
+        self._write("_add", values)
+
+    def remove(self, key) -> None:
+        self._write("_remove", (key,))
+
+    def _write(self, method: str, args: tuple) -> None:
+
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((method, args))
+            # A structure that wasn't built yet will read the row from the database when it is built
+            if self.built:
+                getattr(self, method)(*args)
+
+    def _load(self, rows: Iterable[tuple]) -> None:
+        for row in rows:
+            self._add(*row)
+
+    def _new(self) -> "PeriodicRebuild":
+        raise NotImplementedError
+
+    def _load_rows(self) -> Iterable[tuple]:
+        raise NotImplementedError
+
+    def _add(self, *values) -> None:
+        raise NotImplementedError
+
+    def _remove(self, key) -> None:
+        raise NotImplementedError
+
+    def _swap(self, fresh: "PeriodicRebuild") -> None:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {
+            "built": self.built,
+            "age_seconds": round(time.monotonic() - self.built_at, 3) if self.built else None,
+            "build_ms": round(self.build_seconds * 1000, 3)
+        }
@@ -0,0 +1,135 @@
+import json
+from typing import Any, Union
+
+import flask
+from flask import current_app, Response
+from flask.json.provider import DefaultJSONProvider
+
+from alpha_store.cache import MISSING
+
+# orjson is optional, the standard library ``json`` is used when it isn't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+COMPACT_SEPARATORS = (",", ":")
+
+
+class OrjsonProvider(DefaultJSONProvider):
+
+    """
+    JSON provider backed by ``orjson``, several times faster than the standard library encoder
+    The output is the same of ``DefaultJSONProvider`` (sorted keys, datetimes as HTTP dates), but always compact
+    and with non ASCII characters encoded as UTF-8 instead of escaped.
+    Calls with options that orjson doesn't support (like ``indent``, used in debug mode) and values it can't
+    encode (like integers bigger than 64 bits) fall back to the standard library.
+
+    Floats keep the same value but not always the same text: plain decimals (like ``59.99``) are written the same,
+    while the exponent form differs (orjson writes ``1e16`` and ``1e-7``, the standard library ``1e+16`` and
+    ``1e-07``). NaN and Infinity don't fall back: orjson encodes them as ``null`` (valid JSON), while the standard
+    library writes ``NaN``/``Infinity``, so non-finite floats don't round-trip with this provider.
+    """
+
+    def _options(self) -> int:
+        # Datetimes and dataclasses are passed to ``default``, so they are encoded exactly like Flask does
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return options
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+
+        separators = kwargs.get("separators", COMPACT_SEPARATORS)
+        if set(kwargs) - {"separators"} or tuple(separators) != COMPACT_SEPARATORS:
+            return super().dumps(obj, **kwargs)
+
+        try:
+            return orjson.dumps(obj, default=self.default, option=self._options()).decode("utf-8")
+        except (orjson.JSONEncodeError, TypeError):
+            return super().dumps(obj, separators=COMPACT_SEPARATORS)
+
+    def loads(self, s: Union[str, bytes], **kwargs: Any) -> Any:
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+JSON_PROVIDERS = {
+    "default": DefaultJSONProvider,
+    "orjson": OrjsonProvider,
+}
+
+
+def configure(app: flask.Flask) -> None:
+    """
+    Set the app JSON provider using ``provider`` in the ``JSON`` section of config file
+    It can be ``default`` (standard library), ``orjson`` or ``auto`` (orjson when it is installed)
+    """
+
+    name = app.config["cfg"].get("JSON", "provider", fallback="auto").lower()
+
+    if name == "auto":
+        name = "orjson" if orjson is not None else "default"
+
+    if name not in JSON_PROVIDERS:
+        raise ValueError(f"Invalid JSON provider: {name}")
+
+    if name == "orjson" and orjson is None:
+        app.logger.warning("orjson is not installed, using the default JSON provider")
+        name = "default"
+
+    app.json_provider_class = JSON_PROVIDERS[name]
+    app.json = app.json_provider_class(app)
+
+    app.logger.info(f"JSON provider configured: {name}")
+
+
+def dumps(obj: Any) -> bytes:
+    """Encode ``obj`` with the app JSON provider, in the compact form used by the responses"""
+
+    return current_app.json.dumps(obj, separators=COMPACT_SEPARATORS).encode("utf-8")
+
+
+def encoded_product(product) -> bytes:
+    """
+    Return the JSON of a product (a ``Products`` instance or a row with the products columns), encoded once
+    and then reused from the ``json_by_id`` cache of the product cache until the product changes.
+    It skips the ``to_dict`` call and the JSON encoding (datetime conversions included) on hot reads
+    """
+
+    cache = current_app.product_cache.json_by_id
+    encoded = cache.get(product.id)
+
+    if encoded is MISSING:
+        payload = product.to_dict() if hasattr(product, "to_dict") else product._asdict()
+        encoded = dumps(payload)
+        cache.set(product.id, encoded)
+
+    return encoded
+
+
+def spliced_json_response(payload: dict, status_code: int = 200, **raw: Union[bytes, list]) -> Response:
+    """
+    Build a JSON response from ``payload`` plus already encoded values, without decoding them again
+    Each keyword argument is added to the response object: ``bytes`` values are inserted as they are,
+    and lists of ``bytes`` are inserted as a JSON array.
+
+    Example:
+    ``spliced_json_response({"message": "Products found"}, 200, products=[b'{"id":1}', b'{"id":2}'])``
+    produces ``{"message":"Products found","products":[{"id":1},{"id":2}]}``
+    """
+
+    # The payload is encoded with the app provider and the raw values go right before its closing brace
+    body = dumps(payload)
+    parts = [body[:-1]]
+    separator = b"," if payload else b""
+
+    for key, value in raw.items():
+        if isinstance(value, list):
+            value = b"[" + b",".join(value) + b"]"
+        parts.append(separator + json.dumps(key).encode("utf-8") + b":" + value)
+        separator = b","
+
+    parts.append(b"}\n")
+    return current_app.response_class(b"".join(parts), status=status_code, mimetype="application/json")
@@ -1,5 +1,7 @@
 import configparser
-from typing import Optional
+import base64
+import json
+from typing import Any, Optional
 import os
 import flask
 import loguru
@@ -36,4 +38,42 @@ def setup_loguru(app: flask.Flask) -> None:
     )
 
     if not app.testing: # If app is running in test mode, dont add stdout logger
-        app.logger.add(sys.stdout, level="DEBUG", format="{time} | {level} | {message} | {file}:{line}")
\ No newline at end of file
+        app.logger.add(sys.stdout, level="DEBUG", format="{time} | {level} | {message} | {file}:{line}")
+
+def encode_cursor(payload: dict) -> str:
+    """
+    Encode a keyset pagination position as an opaque, url-safe string
+    Clients should treat it as a black box and just send it back to get the next page
+    """
+
+    raw = json.dumps(payload, separators=(",", ":"), default=str).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> dict:
+    """
+    Decode a cursor generated by ``encode_cursor``
+    Raises ``ValueError`` if the cursor was tampered or is not a valid cursor
+    """
+
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except (ValueError, TypeError) as exc:
+        raise ValueError(f"Invalid cursor: {cursor}") from exc
+
+    if not isinstance(payload, dict):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+    return payload
+
+
+def app_attribute(name: str) -> Any:
+    """
+    Return ``current_app.<name>``, like ``app.product_cache``, or ``None`` outside of an app context
+    or when the app doesn't have it. Used by the model events, that also run in scripts without app
+    """
+
+    if flask.has_app_context():
+        return getattr(flask.current_app, name, None)
+    return None
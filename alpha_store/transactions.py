@@ -0,0 +1,42 @@
+from typing import Callable
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Key of ``Session.info`` where the callbacks queued by a transaction wait for its end
+AFTER_COMMIT_KEY = "after_commit"
+
+
+def after_commit(session: Session, callback: Callable, *args, on_rollback: bool = False) -> None:
+    """
+    Call ``callback(*args)`` right after the transaction of ``session`` commits, like the in-memory structures
+    that follow the rows written by this process (caches, search index, facets...).
+    The mapper events run at flush time, when the outcome of the transaction is still unknown, so they queue
+    their work here. The arguments are read when the callback is queued, the commit expires the instances.
+
+    The callback is discarded when the transaction is rolled back, or called anyway with ``on_rollback``
+    (the cache invalidations, since the flushed rows could have been cached by the same session)
+    """
+
+    session.info.setdefault(AFTER_COMMIT_KEY, []).append((callback, args, on_rollback))
+
+
+def _run_callbacks(session: Session, rolled_back: bool) -> None:
+
+    for callback, args, on_rollback in session.info.pop(AFTER_COMMIT_KEY, ()):
+        if on_rollback or not rolled_back:
+            callback(*args)
+
+
+@event.listens_for(Session, "after_commit")
+def _run_committed_callbacks(session: Session) -> None:
+    _run_callbacks(session, rolled_back=False)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _run_rolled_back_callbacks(session: Session, previous_transaction) -> None:
+
+    # ``after_rollback`` is not fired when the transaction didn't execute any statement yet,
+    # and the rollback of a savepoint keeps the callbacks for the end of the outer transaction
+    if not previous_transaction.nested:
+        _run_callbacks(session, rolled_back=True)
@@ -0,0 +1,91 @@
+"""
+Micro-benchmark of the per request cost of building a sorted ``get_products`` page
+
+Compares the old path (``to_dict`` -> pandas DataFrame -> ``sort_values`` -> ``to_dict(orient="records")``)
+with the current one, where the database sorts and each selected row becomes the response dict.
+No database is needed, the rows are built in memory.
+
+Usage: python benchmarks/bench_catalog_sort.py
+"""
+
+import datetime
+import os
+import random
+import subprocess
+import sys
+import timeit
+from operator import itemgetter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from alpha_store.models import Products  # noqa: E402
+
+PAGE_SIZE = 10
+REPEAT = 2000
+COLUMNS = [column.key for column in Products.__table__.columns]
+
+
+def make_page(size: int) -> list:
+    products = []
+    for index in range(size):
+        products.append(Products(
+            id=index,
+            name=f"Product {random.randint(0, 10_000)}",
+            description="Lorem ipsum dolor sit amet, consectetur adipiscing elit.",
+            price=round(random.uniform(1, 300), 2),
+            category=random.choice(["Action", "RPG", "Sports"]),
+            release_date=datetime.datetime(2020, 1, 1),
+            added_at=datetime.datetime(2023, 1, 1),
+            image_url="https://example.com/image.png",
+            score=random.randint(1, 100)
+        ))
+    return products
+
+
+def pandas_path(products: list) -> list:
+    import pandas as pd
+
+    frame = pd.DataFrame(product.to_dict() for product in products)
+    frame.sort_values(by="price", inplace=True, ascending=True)
+    return frame.to_dict(orient="records")
+
+
+def key_function_path(products: list) -> list:
+    return sorted((product.to_dict() for product in products), key=itemgetter("price"))
+
+
+def projection_path(rows: list) -> list:
+    # The rows come sorted from the database, like ``db.session.query(*PRODUCT_COLUMNS)`` does
+    return [dict(zip(COLUMNS, row)) for row in rows]
+
+
+def import_time(module: str) -> float:
+    code = f"import time; started = time.perf_counter(); import {module}; print(time.perf_counter() - started)"
+    return float(subprocess.check_output([sys.executable, "-c", code]))
+
+
+def main() -> None:
+
+    products = make_page(PAGE_SIZE)
+    rows = sorted(([getattr(product, column) for column in COLUMNS] for product in products),
+                  key=itemgetter(COLUMNS.index("price")))
+
+    # Warm up the pandas import, so it is not measured in the first run
+    pandas_path(products)
+
+    results = {
+        "pandas DataFrame sort": timeit.timeit(lambda: pandas_path(products), number=REPEAT),
+        "key function sort": timeit.timeit(lambda: key_function_path(products), number=REPEAT),
+        "sql sort + row projection": timeit.timeit(lambda: projection_path(rows), number=REPEAT),
+    }
+
+    baseline = results["pandas DataFrame sort"]
+    print(f"Page of {PAGE_SIZE} products, {REPEAT} runs")
+    for name, total in results.items():
+        print(f"{name:>28}: {total / REPEAT * 1e6:9.1f} us/request ({baseline / total:6.1f}x)")
+
+    print(f"{'pandas import (cold start)':>28}: {import_time('pandas') * 1e3:9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
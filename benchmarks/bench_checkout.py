@@ -0,0 +1,106 @@
+"""
+Benchmark of ``User.checkout`` for carts with 1, 50 and 500 items
+
+The current single transaction checkout is compared with the previous flow (three commits, products appended
+to the order one by one and sales records built from the ORM objects), reproduced in ``legacy_checkout``.
+The number of statements sent to the database is counted too.
+
+It uses the ``MOCK_DATABASE`` of config file (the same database of the tests), all tables are dropped at the end.
+
+Usage: python benchmarks/bench_checkout.py
+"""
+
+import os
+import sys
+import time
+from datetime import datetime
+
+from sqlalchemy import event
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from alpha_store.main import create_app  # noqa: E402
+from alpha_store.models import db, User, Products, Cart, CartItem, Order, SalesRecord  # noqa: E402
+from alpha_store.pricing import shipping_cost  # noqa: E402
+
+SIZES = (1, 50, 500)
+REPEAT = 5
+
+
+def legacy_checkout(user: User) -> None:
+    """The checkout flow before the bulk pipeline, adapted to the cart quantities"""
+
+    order = Order(user_id=user.id, total_price=0, shipping_cost=0)
+    order.save()
+
+    total_price = 0
+    total_items = 0
+    for item in user.cart.items:
+        total_price += item.product.price * item.quantity
+        total_items += item.quantity
+        order.products.append(item.product)
+
+    order.total_price = total_price
+    order.shipping_cost = shipping_cost(total_items)
+
+    db.session.query(CartItem).filter_by(cart_id=user.cart.id).delete()
+    db.session.commit()
+
+    recorded_sales = [SalesRecord(product_id=product.id, product_price=product.price,
+                                  product_category=product.category) for product in order.products]
+    db.session.bulk_save_objects(recorded_sales)
+    db.session.commit()
+
+
+def fill_cart(user: User, products: list) -> None:
+    db.session.execute(CartItem.__table__.insert(), [
+        {"cart_id": user.cart.id, "product_id": product_id, "quantity": 1} for product_id in products])
+    db.session.commit()
+
+
+def main() -> None:
+
+    app = create_app(test_mode=True)
+
+    with app.app_context():
+        db.create_all()
+
+        statements = []
+        event.listen(db.engine, "before_cursor_execute", lambda *args: statements.append(1))
+
+        try:
+            db.session.add_all([Products(
+                name=f"Product {index}", description="Lorem ipsum", price=10 + index % 50, category="Action",
+                release_date=datetime(2020, 1, 1), image_url="https://example.com/image.png", score=50
+            ) for index in range(max(SIZES))])
+            db.session.commit()
+            product_ids = [product_id for product_id, in db.session.query(Products.id)]
+
+            user = User(username="benchmark", email="benchmark@mail.com", password="Benchmark12@")
+            user.cart = Cart()
+            user.save()
+
+            for size in SIZES:
+                for name, checkout in (("legacy", legacy_checkout), ("bulk", User.checkout)):
+                    elapsed = 0.0
+                    executed = 0
+
+                    for _ in range(REPEAT):
+                        fill_cart(user, product_ids[:size])
+                        db.session.expire_all()
+                        statements.clear()
+
+                        started = time.perf_counter()
+                        checkout(user)
+                        elapsed += time.perf_counter() - started
+                        executed += len(statements)
+
+                    print(f"{size:>4} items | {name:>6}: {elapsed / REPEAT * 1e3:8.2f} ms/checkout, "
+                          f"{executed / REPEAT:6.0f} statements/checkout")
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark of the encode throughput of the JSON providers (see ``alpha_store.serialization``)
+
+The payload is an order history, like the one returned by ``/apis/v1/user/orders``,
+with datetimes and floats in every order and product.
+
+Usage: python benchmarks/bench_json_provider.py
+"""
+
+import datetime
+import os
+import sys
+import timeit
+
+import flask
+from flask.json.provider import DefaultJSONProvider
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from alpha_store.serialization import OrjsonProvider, orjson  # noqa: E402
+
+ORDERS = 200
+PRODUCTS_PER_ORDER = 5
+
+
+def make_orders() -> dict:
+    product = {
+        "id": 1,
+        "name": "Test Product",
+        "description": "Lorem ipsum dolor sit amet, consectetur adipiscing elit.",
+        "price": 59.99,
+        "category": "Action",
+        "release_date": datetime.datetime(2017, 10, 27, 3, 0),
+        "added_at": datetime.datetime(2023, 2, 12, 2, 30),
+        "image_url": "https://example.com/image.png",
+        "score": 87.5
+    }
+
+    orders = [{
+        "id": index,
+        "user_id": 1,
+        "added_at": datetime.datetime(2023, 3, 1, 10, index % 60),
+        "total_price": 299.95,
+        "shipping_cost": 50.0,
+        "products": [dict(product, id=product_id) for product_id in range(PRODUCTS_PER_ORDER)]
+    } for index in range(ORDERS)]
+
+    return {"message": "Orders retrieved successfully", "status_code": 200, "orders": orders}
+
+
+def main() -> None:
+
+    if orjson is None:
+        print("orjson is not installed, only the default provider is available")
+        return
+
+    app = flask.Flask(__name__)
+    payload = make_orders()
+    size = len(DefaultJSONProvider(app).dumps(payload, separators=(",", ":")))
+
+    print(f"Payload: {ORDERS} orders with {PRODUCTS_PER_ORDER} products each ({size / 1024:.0f} KiB)")
+    for name, provider in (("default", DefaultJSONProvider(app)), ("orjson", OrjsonProvider(app))):
+        number = 50
+        seconds = timeit.timeit(lambda: provider.dumps(payload, separators=(",", ":")), number=number) / number
+        print(f"{name:>8}: {seconds * 1e3:8.2f} ms/encode, {size / seconds / 2 ** 20:8.1f} MiB/s")
+
+
+if __name__ == "__main__":
+    main()
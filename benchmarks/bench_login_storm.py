@@ -0,0 +1,150 @@
+"""
+Load test: latency of a catalog endpoint during a storm of logins
+
+A client requests ``/apis/v1/catalog/get_products_by_id/1`` in a loop, first alone and then while ``STORM_CLIENTS``
+other clients keep logging in. It is done with the password hashes computed inline (like before the password
+hasher pool) and in the process pool, and the p50/p99 latencies of the catalog requests are compared.
+
+The app is served by waitress with 4 threads (its default), or by the werkzeug threaded server if waitress
+isn't installed. The server used is printed first, so the results always say which one they come from.
+It uses the ``MOCK_DATABASE`` of config file, all tables are dropped at the end.
+
+Usage: python benchmarks/bench_login_storm.py
+"""
+
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from alpha_store.main import create_app  # noqa: E402
+from alpha_store.auth.passwords import PasswordHasher  # noqa: E402
+from alpha_store.models import db, User, Products  # noqa: E402
+
+try:
+    from waitress.server import create_server
+except ImportError:
+    create_server = None
+
+DURATION = 5  # seconds of each phase
+STORM_CLIENTS = 16
+HASH_METHOD = "pbkdf2:sha256:260000"
+EMAIL, PASSWORD = "benchmark@mail.com", "Benchmark12@"
+
+
+def serve(app):
+    """Start the app in a background thread, returns the base url and a function that stops the server"""
+
+    print(f"server: {'waitress (4 threads)' if create_server is not None else 'werkzeug (threaded)'}, "
+          f"hash method: {HASH_METHOD}")
+
+    if create_server is not None:
+        server = create_server(app, host="127.0.0.1", port=0, threads=4)
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        return f"http://127.0.0.1:{server.effective_port}", server.close
+
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return f"http://127.0.0.1:{server.server_port}", server.shutdown
+
+
+def request(url: str, payload: dict = None) -> int:
+
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=30) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+def probe(base_url: str, stop: threading.Event, latencies: list) -> None:
+    while not stop.is_set():
+        started = time.perf_counter()
+        request(f"{base_url}/apis/v1/catalog/get_products_by_id/1")
+        latencies.append(time.perf_counter() - started)
+
+
+def login_storm(base_url: str, stop: threading.Event, statuses: list) -> None:
+    while not stop.is_set():
+        statuses.append(request(f"{base_url}/apis/v1/user/login", {"email": EMAIL, "password": PASSWORD}))
+
+
+def run_phase(base_url: str, storm: bool) -> tuple:
+
+    stop = threading.Event()
+    latencies, statuses = [], []
+
+    threads = [threading.Thread(target=probe, args=(base_url, stop, latencies))]
+    if storm:
+        threads += [threading.Thread(target=login_storm, args=(base_url, stop, statuses))
+                    for _ in range(STORM_CLIENTS)]
+
+    for thread in threads:
+        thread.start()
+    time.sleep(DURATION)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return latencies, statuses
+
+
+def report(name: str, latencies: list, statuses: list) -> None:
+
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies) * 1e3
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1e3
+    logins = sum(status == 200 for status in statuses)
+    rejected = sum(status == 503 for status in statuses)
+
+    print(f"{name:>22}: catalog p50 {p50:7.2f} ms, p99 {p99:8.2f} ms | "
+          f"logins {logins / DURATION:6.1f}/s, rejected {rejected / DURATION:6.1f}/s")
+
+
+def main() -> None:
+
+    app = create_app(test_mode=True)
+
+    with app.app_context():
+        db.create_all()
+
+        try:
+            app.password_hasher = PasswordHasher(method=HASH_METHOD, workers=0)
+            user = User(username="benchmark", email=EMAIL, password=PASSWORD)
+            user.save()
+            Products(name="Product", description="Lorem ipsum", price=10, category="Action",
+                     release_date=datetime(2020, 1, 1), image_url="https://example.com/image.png", score=50).save()
+
+            base_url, shutdown = serve(app)
+
+            for name, workers in (("inline", 0), ("process pool", 2)):
+                app.password_hasher = PasswordHasher(method=HASH_METHOD, workers=workers, timeout=2, max_pending=8)
+                app.password_hasher.start()
+
+                report(f"{name}, no logins", *run_phase(base_url, storm=False))
+                report(f"{name}, login storm", *run_phase(base_url, storm=True))
+                app.password_hasher.shutdown()
+
+            shutdown()
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Benchmark of the product list serialization
+
+Compares the ``to_dict`` + ``jsonify`` path with the pre-serialized path, where the JSON of each product
+comes from the product cache and is spliced in the response (``alpha_store.serialization``).
+No database is needed, the products are built in memory.
+
+Usage: python benchmarks/bench_product_json.py
+"""
+
+import datetime
+import os
+import sys
+import timeit
+
+import flask
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from alpha_store.cache import ProductCache  # noqa: E402
+from alpha_store.models import Products  # noqa: E402
+from alpha_store.serialization import encoded_product, spliced_json_response  # noqa: E402
+
+SIZES = (10, 100, 1000)
+
+
+def make_products(size: int) -> list:
+    return [Products(
+        id=index,
+        name=f"Product {index}",
+        description="Lorem ipsum dolor sit amet, consectetur adipiscing elit.",
+        price=19.99 + index,
+        category="Action",
+        release_date=datetime.datetime(2020, 1, 1),
+        added_at=datetime.datetime(2023, 1, 1, 12, 30),
+        image_url="https://example.com/image.png",
+        score=87.5
+    ) for index in range(size)]
+
+
+def to_dict_path(products: list) -> flask.Response:
+    return flask.jsonify({
+        "message": "Products found",
+        "status_code": 200,
+        "products": [product.to_dict() for product in products]
+    })
+
+
+def pre_serialized_path(products: list) -> flask.Response:
+    return spliced_json_response({
+        "message": "Products found",
+        "status_code": 200,
+    }, 200, products=[encoded_product(product) for product in products])
+
+
+def main() -> None:
+
+    app = flask.Flask(__name__)
+    app.product_cache = ProductCache(maxsize=max(SIZES))
+
+    with app.app_context():
+        for size in SIZES:
+            products = make_products(size)
+            number = max(10_000 // size, 20)
+
+            # Warm up the cache, like on a hot read
+            pre_serialized_path(products)
+
+            baseline = timeit.timeit(lambda: to_dict_path(products), number=number) / number
+            cached = timeit.timeit(lambda: pre_serialized_path(products), number=number) / number
+
+            print(f"{size:>5} products: to_dict + jsonify {baseline * 1e6:10.1f} us | "
+                  f"pre-serialized {cached * 1e6:10.1f} us | {baseline / cached:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""cart product quantity
+
+Revision ID: 5a1f3c2d9e47
+Revises: 162418348d12
+Create Date: 2026-10-16 10:12:41.512310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a1f3c2d9e47'
+down_revision = '162418348d12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('cart_product', sa.Column('quantity', sa.Integer(), server_default='1', nullable=False))
+
+    # Collapse the duplicated (cart_id, product_id) rows into a single row with the quantity
+    op.execute("DELETE FROM cart_product WHERE cart_id IS NULL OR product_id IS NULL")
+    op.execute(
+        "CREATE TEMPORARY TABLE cart_product_collapsed AS "
+        "SELECT cart_id, product_id, SUM(quantity) AS quantity FROM cart_product GROUP BY cart_id, product_id"
+    )
+    op.execute("DELETE FROM cart_product")
+    op.execute(
+        "INSERT INTO cart_product (cart_id, product_id, quantity) "
+        "SELECT cart_id, product_id, quantity FROM cart_product_collapsed"
+    )
+    op.execute("DROP TABLE cart_product_collapsed")
+
+    op.alter_column('cart_product', 'cart_id', existing_type=sa.Integer(), nullable=False)
+    op.alter_column('cart_product', 'product_id', existing_type=sa.Integer(), nullable=False)
+    op.create_primary_key('cart_product_pkey', 'cart_product', ['cart_id', 'product_id'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('cart_product_pkey', 'cart_product', type_='primary')
+    op.alter_column('cart_product', 'product_id', existing_type=sa.Integer(), nullable=True)
+    op.alter_column('cart_product', 'cart_id', existing_type=sa.Integer(), nullable=True)
+
+    # Expand each line back to one row per unit
+    op.execute(
+        "INSERT INTO cart_product (cart_id, product_id, quantity) "
+        "SELECT cart_id, product_id, 1 FROM cart_product, generate_series(2, cart_product.quantity)"
+    )
+    op.drop_column('cart_product', 'quantity')
@@ -0,0 +1,24 @@
+"""orders user added_at index
+
+Revision ID: 8d2e6b4f1a93
+Revises: 5a1f3c2d9e47
+Create Date: 2026-10-16 14:05:12.842117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2e6b4f1a93'
+down_revision = '5a1f3c2d9e47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_orders_user_id_added_at', 'orders', ['user_id', 'added_at', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_orders_user_id_added_at', table_name='orders')
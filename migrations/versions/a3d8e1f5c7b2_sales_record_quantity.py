@@ -0,0 +1,31 @@
+"""sales record quantity
+
+Revision ID: a3d8e1f5c7b2
+Revises: f7a2c9d31b64
+Create Date: 2026-10-16 20:41:09.127554
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3d8e1f5c7b2'
+down_revision = 'f7a2c9d31b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # The existing records have one row per unit sold, so they are single units
+    op.add_column('sales_record', sa.Column('quantity', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade() -> None:
+    # Expand each record back to one row per unit
+    op.execute(
+        "INSERT INTO sales_record (product_id, product_price, product_category, sale_date, quantity) "
+        "SELECT product_id, product_price, product_category, sale_date, 1 "
+        "FROM sales_record, generate_series(2, sales_record.quantity)"
+    )
+    op.drop_column('sales_record', 'quantity')
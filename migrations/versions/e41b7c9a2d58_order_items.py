@@ -0,0 +1,45 @@
+"""order items
+
+Revision ID: e41b7c9a2d58
+Revises: 8d2e6b4f1a93
+Create Date: 2026-10-16 15:21:47.305916
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e41b7c9a2d58'
+down_revision = '8d2e6b4f1a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('order_items',
+    sa.Column('order_id', sa.Integer(), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('unit_price', sa.Float(), nullable=False),
+    sa.Column('category', sa.String(length=64), nullable=True),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['order_id'], ['orders.id'], ),
+    sa.PrimaryKeyConstraint('order_id', 'product_id')
+    )
+
+    # Backfill the existing orders. The price paid was never stored, so the current product
+    # price is the best snapshot available. Orders created before the cart quantities have
+    # one ``order_product`` row per unit, so the quantity is the number of rows.
+    # Products deleted since then can't be recovered and are skipped.
+    op.execute(
+        "INSERT INTO order_items (order_id, product_id, name, unit_price, category, quantity) "
+        "SELECT order_product.order_id, products.id, products.name, products.price, products.category, COUNT(*) "
+        "FROM order_product JOIN products ON products.id = order_product.product_id "
+        "WHERE order_product.order_id IS NOT NULL "
+        "GROUP BY order_product.order_id, products.id, products.name, products.price, products.category"
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('order_items')
@@ -0,0 +1,46 @@
+"""sales rollups
+
+Revision ID: f7a2c9d31b64
+Revises: e41b7c9a2d58
+Create Date: 2026-10-16 18:04:12.518376
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7a2c9d31b64'
+down_revision = 'e41b7c9a2d58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('sales_daily_category',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('category', sa.String(length=64), nullable=False),
+    sa.Column('revenue', sa.Float(), nullable=False),
+    sa.Column('units', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('day', 'category')
+    )
+    op.create_table('sales_daily_product',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('revenue', sa.Float(), nullable=False),
+    sa.Column('units', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('day', 'product_id')
+    )
+    # No backfill: the high-water mark starts at 0, so the first compaction adds the existing sales
+    op.create_table('sales_rollup_state',
+    sa.Column('name', sa.String(length=32), nullable=False),
+    sa.Column('last_id', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('sales_rollup_state')
+    op.drop_table('sales_daily_product')
+    op.drop_table('sales_daily_category')
@@ -1,7 +1,9 @@
+from contextlib import contextmanager
 from unittest import TestCase
+from sqlalchemy import event
 from alpha_store.main import create_app
 from alpha_store.models import User, Products
-from typing import Optional
+from typing import Iterator, Optional
 
 
 class TestBase(TestCase):
@@ -81,3 +83,18 @@ class TestBase(TestCase):
                            price=price, score=score, image_url=image_url, category=category, release_date=release_date)
         product.save()
         return product
+
+    @contextmanager
+    def capture_statements(self) -> Iterator[list]:
+        """Collect the SQL statements sent to the database inside the ``with`` block, in the yielded list"""
+
+        statements = []
+
+        def listener(conn, cursor, statement, *args) -> None:
+            statements.append(statement)
+
+        event.listen(self.app.db.engine, "before_cursor_execute", listener)
+        try:
+            yield statements
+        finally:
+            event.remove(self.app.db.engine, "before_cursor_execute", listener)
@@ -0,0 +1,224 @@
+import datetime
+import json
+import os
+import tempfile
+import unittest
+
+from parameterized import parameterized
+
+from auth_tests_base import TestBase
+from alpha_store.analytics.ingest import SalesIngestor, fcntl
+from alpha_store.analytics.report import sales_aggregates
+from alpha_store.models import db, SalesRecord, SalesDailyCategory, SalesRollupState
+
+SALE = {"product_id": 1, "product_price": 10.0, "product_category": "Test Category"}
+
+
+class TestSalesIngestion(TestBase):
+
+    def setUp(self):
+        super().setUp()
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.spill_file = os.path.join(directory.name, "sales_spill.ndjson")
+
+    def async_ingestor(self) -> SalesIngestor:
+        # A big batch and interval, so the worker never flushes by itself during the test
+        ingestor = SalesIngestor(self.app, batch_size=100, flush_interval=60, spill_file=self.spill_file)
+        self.addCleanup(ingestor.close)
+        return ingestor
+
+    def read_spill_file(self, ingestor: SalesIngestor) -> list:
+        with open(ingestor.spill_path, "r", encoding="utf-8") as file:
+            return [json.loads(line) for line in file]
+
+    def write_spill_file(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(json.dumps({**SALE, "sale_date": "2023-02-12T02:30:22"}) + "\n")
+            # Line cut by a crash
+            file.write('{"product_id": 1, "product_pri')
+
+    def test_ingest_stats_in_test_mode(self):
+        """Test if the app uses the sync mode when testing"""
+
+        response = self.client.get("/apis/v1/analytics/ingest_stats")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["mode"], "sync")
+        self.assertEqual(response.json["queue_depth"], 0)
+
+    def test_sync_mode_inserts_in_the_caller_transaction(self):
+
+        self.app.sales_ingestor.record([SALE])
+        db.session.rollback()
+        self.assertEqual(SalesRecord.query.count(), 0)
+
+        self.app.sales_ingestor.record([SALE])
+        db.session.commit()
+        self.assertEqual(SalesRecord.query.count(), 1)
+
+    def test_sales_are_enqueued_on_commit_and_flushed(self):
+
+        ingestor = self.async_ingestor()
+
+        ingestor.record([SALE, SALE])
+        self.assertEqual(ingestor.stats()["queue_depth"], 0)
+
+        db.session.commit()
+        self.assertEqual(ingestor.stats()["queue_depth"], 2)
+        self.assertEqual(len(self.read_spill_file(ingestor)), 2)
+        self.assertTrue(self.read_spill_file(ingestor)[0]["sale_date"].endswith("+00:00"))
+        self.assertEqual(SalesRecord.query.count(), 0)
+
+        self.assertTrue(ingestor.flush())
+
+        stats = ingestor.stats()
+        self.assertEqual(stats["queue_depth"], 0)
+        self.assertEqual(stats["flushed"], 2)
+        self.assertEqual(stats["flushes"], 1)
+        self.assertEqual(self.read_spill_file(ingestor), [])
+        self.assertEqual(SalesRecord.query.filter_by(product_id=1).count(), 2)
+
+    def test_rolled_back_sales_are_discarded(self):
+
+        ingestor = self.async_ingestor()
+
+        ingestor.record([SALE])
+        db.session.rollback()
+        db.session.commit()
+
+        self.assertEqual(ingestor.stats()["queue_depth"], 0)
+        self.assertEqual(ingestor.stats()["enqueued"], 0)
+
+    def test_spill_file_is_replayed(self):
+        """Test if the sales left by a previous version (a single spill file) are loaded and flushed"""
+
+        self.write_spill_file(self.spill_file)
+
+        ingestor = self.async_ingestor()
+        self.assertEqual(ingestor.stats()["replayed"], 1)
+        self.assertFalse(os.path.exists(self.spill_file))
+
+        ingestor.close()
+
+        self.assertEqual(SalesRecord.query.count(), 1)
+        self.assertFalse(os.path.exists(ingestor.spill_path))
+
+    @unittest.skipIf(fcntl is None, "fcntl is not available")
+    def test_only_spill_files_of_dead_processes_are_replayed(self):
+        """Test if the spill file of a running process (its lock is held) is left untouched"""
+
+        dead, alive = f"{self.spill_file}.999999991", f"{self.spill_file}.999999992"
+        self.write_spill_file(dead)
+        self.write_spill_file(alive)
+
+        with open(f"{alive}.lock", "w", encoding="utf-8") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            ingestor = self.async_ingestor()
+            self.assertEqual(ingestor.stats()["replayed"], 1)
+            self.assertFalse(os.path.exists(dead))
+            self.assertTrue(os.path.exists(alive))
+            self.assertEqual(len(self.read_spill_file(ingestor)), 1)
+
+            ingestor.close()
+
+        self.assertEqual(SalesRecord.query.count(), 1)
+
+
+class TestSalesReport(TestBase):
+
+    DAY = datetime.datetime(2023, 2, 12, 10, 30)
+
+    def mock_sales(self, sales: list = None) -> None:
+        day = self.DAY
+        sales = sales or [
+            (1, 10.0, "Action", day),
+            (1, 10.0, "Action", day + datetime.timedelta(hours=5)),
+            (2, 20.0, "RPG", day),
+            (3, 5.0, "RPG", day + datetime.timedelta(days=1)),
+            (1, 10.0, "Action", day + datetime.timedelta(days=1)),
+        ]
+        db.session.execute(SalesRecord.__table__.insert(), [
+            {"product_id": product_id, "product_price": price, "product_category": category, "sale_date": sale_date}
+            for product_id, price, category, sale_date in sales])
+        db.session.commit()
+
+    def test_sales_aggregates(self):
+
+        self.mock_sales()
+        self.assertEqual(self.app.sales_rollup.compact(), 5)
+        aggregates = sales_aggregates()
+
+        self.assertEqual(aggregates["revenue_by_day"], [
+            (datetime.date(2023, 2, 12), 40.0), (datetime.date(2023, 2, 13), 15.0)])
+        self.assertEqual(aggregates["revenue_by_category"], [("Action", 30.0), ("RPG", 25.0)])
+        self.assertEqual(aggregates["top_products"], [(1, 3), (2, 1), (3, 1)])
+
+    def test_sales_aggregates_include_the_sales_not_compacted(self):
+        """Test if the sales after the high-water mark are added to the rollups, without compacting them"""
+
+        self.mock_sales()
+        self.app.sales_rollup.compact()
+        self.mock_sales([(2, 20.0, "RPG", self.DAY), (4, 7.0, None, self.DAY)])
+
+        aggregates = sales_aggregates()
+        self.assertEqual(aggregates["revenue_by_day"], [
+            (datetime.date(2023, 2, 12), 67.0), (datetime.date(2023, 2, 13), 15.0)])
+        self.assertEqual(aggregates["revenue_by_category"], [(None, 7.0), ("Action", 30.0), ("RPG", 45.0)])
+        self.assertEqual(aggregates["top_products"], [(1, 3), (2, 2), (3, 1), (4, 1)])
+
+        # The report doesn't compact either
+        self.assertEqual(self.client.get("/apis/v1/analytics/report").status_code, 200)
+        self.assertEqual(self.app.sales_rollup.stats()["compactions"], 1)
+
+    @parameterized.expand([
+        ("with_sales", True),
+        ("without_sales", False),
+    ])
+    def test_report(self, _, with_sales):
+
+        if with_sales:
+            self.mock_sales()
+
+        response = self.client.get("/apis/v1/analytics/report")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.get_data(as_text=True).startswith('<img src="data:image/png;base64,'))
+
+    def test_rollups_are_compacted_incrementally(self):
+
+        self.mock_sales()
+        self.app.sales_rollup.compact()
+        self.assertEqual(self.app.sales_rollup.compact(), 0)
+
+        # A sale in a day already rolled up, and one without category
+        self.mock_sales([(2, 20.0, "RPG", self.DAY), (4, 7.0, None, self.DAY)])
+        self.assertEqual(self.app.sales_rollup.compact(), 2)
+
+        aggregates = sales_aggregates()
+        self.assertEqual(aggregates["revenue_by_day"], [
+            (datetime.date(2023, 2, 12), 67.0), (datetime.date(2023, 2, 13), 15.0)])
+        self.assertEqual(aggregates["revenue_by_category"], [(None, 7.0), ("Action", 30.0), ("RPG", 45.0)])
+        self.assertEqual(aggregates["top_products"], [(1, 3), (2, 2), (3, 1), (4, 1)])
+
+        self.assertEqual(SalesDailyCategory.query.count(), 5)
+        self.assertEqual(SalesRollupState.query.one().last_id, SalesRecord.query.count())
+
+        stats = self.client.get("/apis/v1/analytics/rollup_stats").json
+        self.assertEqual(stats["compactions"], 3)
+        self.assertEqual(stats["compacted"], 7)
+
+    def test_rollups_count_the_quantity(self):
+        """Test if a sales record of many units adds its quantity to the units and revenue"""
+
+        db.session.execute(SalesRecord.__table__.insert(), [
+            {"product_id": 1, "product_price": 10.0, "product_category": "Action", "quantity": 3,
+             "sale_date": self.DAY}])
+        db.session.commit()
+
+        self.assertEqual(self.app.sales_rollup.compact(), 1)
+        aggregates = sales_aggregates()
+        self.assertEqual(aggregates["revenue_by_day"], [(datetime.date(2023, 2, 12), 30.0)])
+        self.assertEqual(aggregates["top_products"], [(1, 3)])
@@ -1,5 +1,15 @@
 from auth_tests_base import TestBase
 from parameterized import parameterized
+from alpha_store.tools import encode_cursor
+from alpha_store.models import Products
+from alpha_store.catalog.search import ProductSearchIndex
+from alpha_store.catalog.facets import FacetEngine, PREFIX_STEP
+from datetime import datetime
+from unittest.mock import patch
+import time
+import gzip
+import json
+import zlib
 
 
 class TestCatalog(TestBase):
@@ -83,7 +93,7 @@ class TestCatalog(TestBase):
         response = self.client.get("/apis/v1/catalog/get_products")
         self.assertEqual(response.status_code, 200)
         self.assertEqual(
-            response.json, {"message": "No products found", "status_code": 200, "products": []})
+            response.json, {"message": "No products found", "status_code": 200, "products": [], "next_cursor": None})
 
     # Parameter Format:
     # (test_name, (sort_by, sort_type, product_data), expected_return_position)
@@ -153,3 +163,507 @@ class TestCatalog(TestBase):
         self.assertEqual(response.status_code, 400)
         self.assertEqual(
             response.json, {"message": "Invalid sort_type field: invalid", "status_code": 400})
+
+    def test_get_products_sort_is_global(self):
+        """
+        Test if the sorting is applied to the whole catalog, not only to the returned page
+        """
+
+        for price in range(20, 0, -1):
+            self.mock_product(name=f"Product {price}", price=price)
+
+        response = self.client.get(
+            "/apis/v1/catalog/get_products?sort_by=price&sort_type=asc&limit=5")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([product["price"] for product in response.json["products"]], [1, 2, 3, 4, 5])
+
+    @parameterized.expand([
+        ("name_asc", "name", "asc"),
+        ("price_desc", "price", "desc"),
+        ("score_asc", "score", "asc"),
+    ])
+    def test_get_products_with_cursor(self, _, sort_by, sort_type):
+        """
+        Test if following the ``next_cursor`` walks through the whole catalog without repeating products
+        """
+
+        # Repeated prices and scores, so the id tiebreaker is exercised
+        for index in range(12):
+            self.mock_product(name=f"Product {index:02d}", price=index % 3 + 1, score=index % 4 + 1)
+
+        seen = []
+        cursor = None
+        while True:
+            url = f"/apis/v1/catalog/get_products?sort_by={sort_by}&sort_type={sort_type}&limit=5"
+            if cursor:
+                url += f"&cursor={cursor}"
+
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+            seen.extend(response.json["products"])
+            cursor = response.json.get("next_cursor")
+            if not cursor:
+                break
+
+        expected = sorted(seen, key=lambda product: (product[sort_by], product["id"]),
+                          reverse=sort_type == "desc")
+
+        self.assertEqual(len(seen), 12)
+        self.assertEqual(len({product["id"] for product in seen}), 12)
+        self.assertEqual([product["id"] for product in seen], [product["id"] for product in expected])
+
+    def test_get_products_with_invalid_cursor(self):
+        """
+        Test the get_products route when the cursor can't be decoded or belongs to another sort order
+        """
+
+        self.mock_product()
+        self.mock_product(name="Another product")
+
+        response = self.client.get("/apis/v1/catalog/get_products?cursor=invalid")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"message": "Invalid cursor", "status_code": 400})
+
+        cursor = self.client.get(
+            "/apis/v1/catalog/get_products?sort_by=name&limit=1").json["next_cursor"]
+        response = self.client.get(
+            f"/apis/v1/catalog/get_products?sort_by=price&limit=1&cursor={cursor}")
+        self.assertEqual(response.status_code, 400)
+
+        # Well formed cursor, but the value doesn't have the type of the sort column
+        forged = encode_cursor({"sort_by": "price", "sort_type": "asc", "value": {"a": 1}, "id": 1})
+        response = self.client.get(f"/apis/v1/catalog/get_products?sort_by=price&cursor={forged}")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"message": "Invalid cursor", "status_code": 400})
+
+    @parameterized.expand([
+        ("negative_start", "start=-1"),
+        ("negative_limit", "limit=-5"),
+        ("zero_limit", "limit=0"),
+    ])
+    def test_get_products_invalid_pagination(self, _, query):
+        """Test if negative offsets and limits are rejected instead of reaching the database"""
+
+        self.mock_product()
+
+        response = self.client.get(f"/apis/v1/catalog/get_products?{query}")
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_products_last_page_has_null_cursor(self):
+        """Test if a full last page returns ``next_cursor: null``"""
+
+        for index in range(4):
+            self.mock_product(name=f"Product {index}")
+
+        response = self.client.get("/apis/v1/catalog/get_products?limit=2&start=2")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json["products"]), 2)
+        self.assertIsNone(response.json["next_cursor"])
+
+    def test_get_item_by_id_uses_cache(self):
+        """Test if repeated lookups are served by the product cache"""
+
+        self.mock_product()
+
+        for _ in range(3):
+            response = self.client.get("/apis/v1/catalog/get_products_by_id/1")
+            self.assertEqual(response.status_code, 200)
+
+        stats = self.client.get("/apis/v1/catalog/cache_stats").json["product_cache"]["by_id"]
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 2)
+
+    def test_product_cache_invalidated_on_save(self):
+        """Test if updating or inserting a product invalidates the cached (and negatively cached) entries"""
+
+        # Cache a miss for the product that will be created
+        response = self.client.get("/apis/v1/catalog/get_products_by_id/1")
+        self.assertEqual(response.status_code, 404)
+
+        product = self.mock_product()
+        response = self.client.get(
+            f"/apis/v1/catalog/get_products_by_name/{self.mock_product_data['name']}")
+        self.assertEqual(response.status_code, 200)
+
+        product.name = "Renamed product"
+        product.save()
+
+        response = self.client.get("/apis/v1/catalog/get_products_by_id/1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["product"]["name"], "Renamed product")
+
+        response = self.client.get(
+            f"/apis/v1/catalog/get_products_by_name/{self.mock_product_data['name']}")
+        self.assertEqual(response.status_code, 404)
+
+    def test_product_cache_invalidated_after_commit(self):
+        """Test if a flushed product write only invalidates the cache when the transaction commits"""
+
+        product = self.mock_product()
+        self.assertEqual(self.client.get("/apis/v1/catalog/get_products_by_id/1").status_code, 200)
+        version = self.app.product_cache.version
+
+        product.price = 99
+        self.app.db.session.flush()
+        self.assertEqual(self.app.product_cache.version, version)
+        self.assertEqual(len(self.app.product_cache.by_id), 1)
+
+        self.app.db.session.commit()
+        self.assertEqual(self.app.product_cache.version, version + 1)
+        self.assertEqual(len(self.app.product_cache.by_id), 0)
+
+    def test_get_products_by_ids(self):
+        """Test if the batch lookup keeps the input order and lists the missing ids"""
+
+        for index in range(3):
+            self.mock_product(name=f"Product {index}")
+
+        response = self.client.get("/apis/v1/catalog/get_products_by_ids?ids=3,100,1,3")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([product["id"] for product in response.json["products"]], [3, 1])
+        self.assertEqual(response.json["missing_ids"], [100])
+
+    @parameterized.expand([
+        ("empty", "", "No ids provided"),
+        ("not_integer", "1,a", "Invalid ids: 1,a"),
+        ("too_many", ",".join(str(i) for i in range(1000)), "Too many ids, the max batch size is 100"),
+    ])
+    def test_get_products_by_ids_invalid(self, _, ids, expected_message):
+
+        response = self.client.get(f"/apis/v1/catalog/get_products_by_ids?ids={ids}")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json["message"], expected_message)
+
+    @parameterized.expand([
+        ("exact", "zelda", ["The Legend of Zelda", "Zelda II"]),
+        ("prefix", "zel", ["The Legend of Zelda", "Zelda II"]),
+        ("substring", "elda", ["The Legend of Zelda", "Zelda II"]),
+        ("many_words", "super mar", ["Super Mario Bros"]),
+        ("accents", "pokemon", ["Pokémon Red"]),
+        ("no_match", "halo", []),
+    ])
+    def test_search(self, _, query, expected):
+        """Test if the search route matches whole words, prefixes and substrings"""
+
+        self.mock_product(name="The Legend of Zelda", score=90)
+        self.mock_product(name="Zelda II", score=70)
+        self.mock_product(name="Super Mario Bros", score=95)
+        self.mock_product(name="Pokémon Red", score=85)
+
+        response = self.client.get(f"/apis/v1/catalog/search?q={query}")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([product["name"] for product in response.json["products"]], expected)
+
+    def test_search_index_is_updated_incrementally(self):
+        """Test if products created or renamed after the index was built are found"""
+
+        product = self.mock_product(name="Metroid")
+        self.assertEqual(len(self.client.get("/apis/v1/catalog/search?q=metroid").json["products"]), 1)
+
+        self.mock_product(name="Metroid Prime")
+        product.name = "Castlevania"
+        product.save()
+
+        response = self.client.get("/apis/v1/catalog/search?q=metroid")
+        self.assertEqual([product["name"] for product in response.json["products"]], ["Metroid Prime"])
+
+        response = self.client.get("/apis/v1/catalog/search/autocomplete?q=cast")
+        self.assertEqual(response.json["suggestions"], ["Castlevania"])
+
+        stats = self.client.get("/apis/v1/catalog/search/stats").json["search_index"]
+        self.assertEqual(stats["documents"], 2)
+        self.assertGreater(stats["memory_bytes"], 0)
+
+    def test_search_index_is_rebuilt_when_stale(self):
+        """Test if products inserted without the ORM (like by another process) are found after a rebuild"""
+
+        self.mock_product(name="Metroid")
+        self.assertEqual(len(self.client.get("/apis/v1/catalog/search?q=metroid").json["products"]), 1)
+
+        self.app.db.session.execute(Products.__table__.insert().values(
+            name="Metroid Fusion", description="Description", price=10, category="Action",
+            release_date=datetime(2002, 11, 17), image_url="https://test.com/image.png", score=90))
+        self.app.db.session.commit()
+
+        self.assertEqual(len(self.client.get("/apis/v1/catalog/search?q=metroid").json["products"]), 1)
+
+        self.app.search_index.built_at -= self.app.search_index.rebuild_interval
+        self.assertEqual(len(self.client.get("/apis/v1/catalog/search?q=metroid").json["products"]), 2)
+
+    def test_search_index_rebuild_keeps_concurrent_writes(self):
+        """Test if a write received while the index is rebuilt is applied to the new index"""
+
+        index = ProductSearchIndex()
+        index.build([(1, "Metroid", 90)])
+
+        def rows():
+            yield 1, "Metroid", 90
+            # Committed after the rows were read, the rebuild must not lose it
+            index.add(2, "Metroid Prime", 95)
+            index.remove(1)
+
+        index.build(rows())
+        self.assertEqual(index.search("metroid"), [2])
+
+    def test_search_without_query(self):
+
+        response = self.client.get("/apis/v1/catalog/search?q=")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"message": "No query provided", "status_code": 400})
+
+    @parameterized.expand([
+        ("search_negative", "search?q=zelda&limit=-1"),
+        ("search_zero", "search?q=zelda&limit=0"),
+        ("autocomplete_negative", "search/autocomplete?q=zel&limit=-1"),
+        ("autocomplete_zero", "search/autocomplete?q=zel&limit=0"),
+    ])
+    def test_search_invalid_limit(self, _, query):
+        """Test if a limit below 1 is rejected, instead of slicing the results from the end"""
+
+        self.mock_product(name="The Legend of Zelda")
+
+        response = self.client.get(f"/apis/v1/catalog/{query}")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"message": "Invalid limit: it must be >= 1", "status_code": 400})
+
+    def _mock_facet_products(self):
+        self.mock_product(name="A", category="Action", price=10, score=50, release_date="2010-01-01T00:00:00")
+        self.mock_product(name="B", category="Action", price=60, score=90, release_date="2015-01-01T00:00:00")
+        self.mock_product(name="C", category="RPG", price=30, score=80, release_date="2020-01-01T00:00:00")
+        self.mock_product(name="D", category="RPG", price=300, score=95, release_date="2021-01-01T00:00:00")
+
+    @parameterized.expand([
+        ("category", "category=RPG", ["C", "D"]),
+        ("price", "min_price=20&max_price=100", ["B", "C"]),
+        ("score", "min_score=85", ["B", "D"]),
+        ("release_date", "released_after=2014-01-01&released_before=2020-06-01", ["B", "C"]),
+        ("combined", "category=Action&min_score=60", ["B"]),
+    ])
+    def test_get_products_filtered(self, _, filters, expected):
+        """Test if the get_products filters are applied"""
+
+        self._mock_facet_products()
+
+        response = self.client.get(f"/apis/v1/catalog/get_products?{filters}")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([product["name"] for product in response.json["products"]], expected)
+
+    def test_get_products_with_facets(self):
+        """Test if the facet counts match the filters, ignoring the filter of the facet itself"""
+
+        self._mock_facet_products()
+
+        response = self.client.get("/apis/v1/catalog/get_products?category=Action&min_price=20&facets=true")
+        facets = response.json["facets"]
+
+        self.assertEqual([product["name"] for product in response.json["products"]], ["B"])
+        self.assertEqual(facets["total"], 1)
+        self.assertEqual(facets["category"], {"Action": 1, "RPG": 2})
+        self.assertEqual(facets["price"], {"0-25": 1, "25-50": 0, "50-100": 1, "100-250": 0, "250+": 0})
+
+        # The engine is kept up to date after it was built
+        self.mock_product(name="E", category="Action", price=40)
+        facets = self.client.get(
+            "/apis/v1/catalog/get_products?category=Action&min_price=20&facets=true").json["facets"]
+        self.assertEqual(facets["total"], 2)
+        self.assertEqual(facets["price"]["25-50"], 1)
+
+    def test_facets_are_rebuilt_when_stale(self):
+        """Test if products inserted without the ORM (like by another process) are counted after a rebuild"""
+
+        self._mock_facet_products()
+        url = "/apis/v1/catalog/get_products?category=RPG&facets=true"
+        self.assertEqual(self.client.get(url).json["facets"]["total"], 2)
+
+        self.app.db.session.execute(Products.__table__.insert().values(
+            name="F", description="Description", price=10, category="RPG",
+            release_date=datetime(2021, 1, 1), image_url="https://test.com/image.png", score=90))
+        self.app.db.session.commit()
+
+        self.app.facet_engine.built_at -= self.app.facet_engine.rebuild_interval
+        response = self.client.get(url)
+        self.assertEqual(len(response.json["products"]), 3)
+        self.assertEqual(response.json["facets"]["total"], 3)
+
+    def test_facet_range_filters_use_the_cumulative_bitsets(self):
+        """Test if the range counts are right across the ``PREFIX_STEP`` boundaries, also after writes"""
+
+        engine = FacetEngine()
+        products = {product_id: ("Action", float(product_id % 300), product_id % 100, datetime(2020, 1, 1))
+                    for product_id in range(PREFIX_STEP * 3 + 10)}
+        engine.build([(product_id, *values) for product_id, values in products.items()])
+
+        engine.remove(7)
+        engine.add(8, "RPG", 299.0, 99, datetime(2021, 1, 1))
+        products.pop(7)
+        products[8] = ("RPG", 299.0, 99, datetime(2021, 1, 1))
+
+        for low, high in [(None, 0), (10, 150), (0, 299), (255, 256), (299, None)]:
+            expected = sum(1 for values in products.values()
+                           if (low is None or values[1] >= low) and (high is None or values[1] <= high))
+            self.assertEqual(engine.facets(min_price=low, max_price=high)["total"], expected)
+
+    def test_get_products_with_invalid_filter(self):
+
+        response = self.client.get("/apis/v1/catalog/get_products?min_price=cheap")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"message": "Invalid filter: min_price", "status_code": 400})
+
+    def test_get_products_payload_matches_to_dict(self):
+        """Test if the rows projected by get_products have the same payload of ``Products.to_dict``"""
+
+        self.mock_product()
+
+        listed = self.client.get("/apis/v1/catalog/get_products").json["products"][0]
+        single = self.client.get("/apis/v1/catalog/get_products_by_id/1").json["product"]
+
+        self.assertEqual(listed, single)
+
+    def test_get_products_conditional_get(self):
+        """Test if the catalog responses have validators and return 304 while the catalog doesn't change"""
+
+        self.mock_product()
+
+        response = self.client.get("/apis/v1/catalog/get_products")
+        etag = response.headers["ETag"]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("max-age=60", response.headers["Cache-Control"])
+        self.assertIn("Last-Modified", response.headers)
+
+        response = self.client.get("/apis/v1/catalog/get_products", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+
+        # Another url has another tag
+        response = self.client.get("/apis/v1/catalog/get_products_by_id/1", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+
+        # Any product write changes the catalog version
+        self.mock_product(name="Another product")
+        response = self.client.get("/apis/v1/catalog/get_products", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_if_modified_since_expires_with_the_ttl_window(self):
+        """Test if ``If-Modified-Since`` stops matching when the TTL window changes, like the ETag"""
+
+        self.mock_product()
+
+        response = self.client.get("/apis/v1/catalog/get_products")
+        last_modified = response.headers["Last-Modified"]
+
+        response = self.client.get("/apis/v1/catalog/get_products", headers={"If-Modified-Since": last_modified})
+        self.assertEqual(response.status_code, 304)
+
+        # A write of another process is only seen when the window changes
+        ttl = self.app.product_cache.by_id.ttl
+        with patch("alpha_store.catalog.http_cache.time.time", return_value=time.time() + ttl):
+            response = self.client.get(
+                "/apis/v1/catalog/get_products", headers={"If-Modified-Since": last_modified})
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_item_not_found_has_no_validators(self):
+
+        response = self.client.get("/apis/v1/catalog/get_products_by_id/100")
+
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn("ETag", response.headers)
+
+    @parameterized.expand([
+        ("plain", "", [1, 2, 3]),
+        ("resume", "after_id=1", [2, 3]),
+        ("gzip", "gzip=true", [1, 2, 3]),
+    ])
+    def test_export(self, name, params, expected_ids):
+        """Test if the export route streams every product as a JSON line"""
+
+        for index in range(3):
+            self.mock_product(name=f"Product {index}")
+
+        response = self.client.get(f"/apis/v1/catalog/export?{params}")
+        body = response.data
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        if name == "gzip":
+            self.assertEqual(response.headers["Content-Encoding"], "gzip")
+            body = gzip.decompress(body)
+
+        products = [json.loads(line) for line in body.decode("utf-8").splitlines()]
+        self.assertEqual([product["id"] for product in products], expected_ids)
+        self.assertEqual(products[0]["name"], f"Product {expected_ids[0] - 1}")
+
+    def test_product_json_cache(self):
+        """Test if the encoded product JSON is reused between requests and refreshed when the product changes"""
+
+        product = self.mock_product()
+
+        first = self.client.get("/apis/v1/catalog/get_products").json
+        second = self.client.get("/apis/v1/catalog/get_products?sort_by=price").json
+
+        stats = self.client.get("/apis/v1/catalog/cache_stats").json["product_cache"]["json_by_id"]
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(first["products"], second["products"])
+
+        product.price = 99.5
+        product.save()
+
+        response = self.client.get("/apis/v1/catalog/get_products").json
+        self.assertEqual(response["products"][0]["price"], 99.5)
+
+    @parameterized.expand([
+        ("gzip", "gzip", "gzip", gzip.decompress),
+        ("deflate", "deflate", "deflate", zlib.decompress),
+        ("preferred", "deflate;q=0.5, gzip;q=0.8", "gzip", gzip.decompress),
+    ])
+    def test_response_compression(self, _, accept_encoding, expected_encoding, decompress):
+        """Test if big responses are compressed with the encoding accepted by the client"""
+
+        for index in range(10):
+            self.mock_product(name=f"Product {index}")
+
+        plain = self.client.get("/apis/v1/catalog/get_products").data
+        response = self.client.get("/apis/v1/catalog/get_products",
+                                   headers={"Accept-Encoding": accept_encoding})
+
+        self.assertNotIn("Content-Encoding", self.client.get("/apis/v1/catalog/get_products").headers)
+        self.assertEqual(response.headers["Content-Encoding"], expected_encoding)
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+        self.assertTrue(response.headers["ETag"].startswith("W/"))
+        self.assertEqual(decompress(response.data), plain)
+
+    def test_response_compression_vary_and_head(self):
+        """Test if compressible responses always vary on Accept-Encoding and HEAD responses are not compressed"""
+
+        for index in range(10):
+            self.mock_product(name=f"Product {index}")
+
+        response = self.client.get("/apis/v1/catalog/get_products")
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+
+        response = self.client.head("/apis/v1/catalog/get_products", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+        self.assertEqual(int(response.headers["Content-Length"]),
+                         len(self.client.get("/apis/v1/catalog/get_products").data))
+
+    def test_response_compression_skips_small_and_streamed_responses(self):
+
+        self.mock_product()
+
+        response = self.client.get("/apis/v1/catalog/get_products_by_id/1", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", response.headers)
+
+        # The export does its own compression, it must not be compressed twice
+        response = self.client.get("/apis/v1/catalog/export?gzip=true", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(json.loads(gzip.decompress(response.data))["id"], 1)
@@ -0,0 +1,69 @@
+import datetime
+import unittest
+
+import flask
+from flask.json.provider import DefaultJSONProvider
+from parameterized import parameterized
+
+from alpha_store.models import Products, Order, SalesRecord
+from alpha_store.serialization import OrjsonProvider, orjson
+
+RELEASE_DATE = datetime.datetime(2017, 10, 27, 3, 0)
+ADDED_AT = datetime.datetime(2023, 2, 12, 2, 30, 22, 243845)
+
+
+@unittest.skipIf(orjson is None, "orjson is not installed")
+class TestJSONProvider(unittest.TestCase):
+
+    def setUp(self):
+        self.app = flask.Flask(__name__)
+        self.default = DefaultJSONProvider(self.app)
+        self.orjson = OrjsonProvider(self.app)
+
+    @parameterized.expand([
+        ("product", Products(id=1, name="Test Product", description="Description", price=59.99, category="RPG",
+                             release_date=RELEASE_DATE, added_at=ADDED_AT, image_url="https://test.com/image.png",
+                             score=87.5)),
+        ("order", Order(id=1, user_id=2, added_at=ADDED_AT, total_price=1234.56, shipping_cost=0.1)),
+        ("sales_record", SalesRecord(id=1, product_id=2, product_price=0.3, product_category="Action",
+                                     sale_date=ADDED_AT)),
+    ])
+    def test_same_output_as_default_provider(self, _, model):
+        """Test if the datetime and plain decimal float fields are encoded exactly like the default provider does"""
+
+        payload = {"message": "ok", "items": [model.to_dict()]}
+
+        expected = self.default.dumps(payload, separators=(",", ":"))
+        self.assertEqual(self.orjson.dumps(payload), expected)
+        self.assertEqual(self.orjson.loads(expected), self.default.loads(expected))
+
+    def test_fallback_to_default_provider(self):
+        """Test if values and options that orjson doesn't support are handled by the standard library"""
+
+        payload = {"big": 2 ** 70, "date": RELEASE_DATE}
+
+        self.assertEqual(self.orjson.dumps(payload), self.default.dumps(payload, separators=(",", ":")))
+        self.assertEqual(self.orjson.dumps(payload, indent=2), self.default.dumps(payload, indent=2))
+
+    def test_exponent_floats_keep_their_value(self):
+        """Test if the floats in exponent form are written by orjson in its own format, with the same value"""
+
+        payload = {"big": 1e16, "small": 1e-7}
+
+        expected = self.default.dumps(payload, separators=(",", ":"))
+        self.assertEqual(expected, '{"big":1e+16,"small":1e-07}')
+        self.assertEqual(self.orjson.dumps(payload), '{"big":1e16,"small":1e-7}')
+        self.assertEqual(self.orjson.loads(self.orjson.dumps(payload)), payload)
+
+    def test_non_finite_floats_are_null(self):
+        """Test if NaN and Infinity are encoded as ``null`` by orjson, without falling back"""
+
+        self.assertEqual(self.orjson.dumps({"a": float("nan"), "b": float("inf"), "c": float("-inf")}),
+                         '{"a":null,"b":null,"c":null}')
+
+    def test_response_is_compact(self):
+
+        with self.app.app_context():
+            response = self.orjson.response({"b": 1, "a": RELEASE_DATE})
+
+        self.assertEqual(response.get_data(as_text=True), '{"a":"Fri, 27 Oct 2017 03:00:00 GMT","b":1}\n')
@@ -1,8 +1,12 @@
 from auth_tests_base import TestBase
-from parameterized import parameterized, parameterized_class
+from parameterized import parameterized
 import datetime
 from flask_login import current_user
 from alpha_store import tools
+from alpha_store.models import User, Cart, Order, SalesRecord, load_user
+from alpha_store.auth.passwords import PasswordHasher
+from alpha_store.auth.availability import BloomFilter, UserAvailability
+from alpha_store.auth.tokens import TokenManager
 
 
 class TestAuth(TestBase):
@@ -106,6 +110,159 @@ class TestAuth(TestBase):
             'message': f"Invalid input data: {expected}", 'status_code': 400}
         response = self.client.post("/apis/v1/user/register", json=input)
         self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, expected_message)
+
+        # The failed registration didn't leave anything behind
+        self.assertEqual(User.query.count(), 1)
+        self.assertEqual(Cart.query.count(), 0)
+
+    @parameterized.expand([
+        ("both_taken", {"username": "test_user", "email": "testuser@validmail.com",
+         "password": "ValidPass@12"}, "username: Username already exists"),
+        ("taken_and_weak_password", {"username": "test_user", "email": "validunique@mail.com",
+         "password": "weakpass"}, "username: Username already exists"),
+        ("weak_password", {"username": "validunique", "email": "validunique@mail.com",
+         "password": "weakpass"}, "password: Password must contain at least one digit"),
+    ])
+    def test_register_error_precedence(self, name, input, expected):
+        """Test if a taken username is reported before a taken email and before the password errors"""
+
+        self.mock_user()
+
+        response = self.client.post("/apis/v1/user/register", json=input)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"message": f"Invalid input data: {expected}", "status_code": 400})
+
+    def test_register_in_a_single_transaction(self):
+        """Test if the registration creates the user and its cart without checking the unique fields first"""
+
+        input_data = {"username": "validname", "email": "valid@email.com", "password": "validPassword!4"}
+
+        with self.capture_statements() as statements:
+            response = self.client.post("/apis/v1/user/register", json=input_data)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([statement.split()[0] for statement in statements], ["INSERT", "INSERT"])
+
+        user = User.query.filter_by(username="validname").one()
+        self.assertIsNotNone(user.cart)
+
+    def test_register_taken_fields_are_looked_up_once(self):
+        """Test if a duplicate registration costs the failed insert and a single lookup of the taken fields"""
+
+        self.mock_user()
+        input_data = {**self.mock_user_data, "email": "another@email.com"}
+
+        with self.capture_statements() as statements:
+            response = self.client.post("/apis/v1/user/register", json=input_data)
+
+        self.assertEqual(response.json["message"], "Invalid input data: username: Username already exists")
+        self.assertEqual([statement.split()[0] for statement in statements], ["INSERT", "SELECT"])
+
+    # availability tests
+    def test_availability_without_parameters(self):
+
+        response = self.client.get("/apis/v1/user/availability")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"message": "No username or email provided", "status_code": 400})
+
+    @parameterized.expand([
+        ("taken_username", "username=test_user", {"username": False}),
+        ("taken_email", "email=testuser@validmail.com", {"email": False}),
+        ("available_username", "username=another_user", {"username": True}),
+        ("both", "username=another_user&email=testuser@validmail.com", {"username": True, "email": False}),
+    ])
+    def test_availability(self, _, query, expected):
+
+        self.mock_user()
+        response = self.client.get(f"/apis/v1/user/availability?{query}")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["available"], expected)
+
+    def test_availability_is_updated_on_register(self):
+        """Test if a registered user is seen by the already built filters, without rebuilding them"""
+
+        response = self.client.get("/apis/v1/user/availability?username=validname")
+        self.assertTrue(response.json["available"]["username"])
+
+        input_data = {"username": "validname", "email": "valid@email.com", "password": "validPassword!4"}
+        _ = self.client.post("/apis/v1/user/register", json=input_data)
+
+        response = self.client.get("/apis/v1/user/availability?username=validname")
+        self.assertFalse(response.json["available"]["username"])
+        self.assertEqual(self.app.user_availability.stats()["filters"]["username"]["values"], 1)
+
+    def test_availability_sees_users_written_by_other_processes(self):
+        """Test if a user inserted without the ORM (like by another process) is seen after a rebuild"""
+
+        response = self.client.get("/apis/v1/user/availability?username=other_process")
+        self.assertTrue(response.json["available"]["username"])
+
+        self.app.db.session.execute(User.__table__.insert().values(
+            username="other_process", email="other@process.com", password="hash"))
+        self.app.db.session.commit()
+
+        # Not in the filter until the next rebuild
+        response = self.client.get("/apis/v1/user/availability?username=other_process")
+        self.assertTrue(response.json["available"]["username"])
+
+        availability = self.app.user_availability
+        availability.built_at -= availability.rebuild_interval
+        response = self.client.get("/apis/v1/user/availability?username=other_process")
+        self.assertFalse(response.json["available"]["username"])
+
+    def test_availability_misses_do_not_query_the_database(self):
+
+        self.mock_user()
+        self.app.user_availability.ensure_built()
+
+        with self.capture_statements() as statements:
+            self.assertTrue(self.app.user_availability.is_available("username", "free_name"))
+
+        self.assertEqual(statements, [])
+
+    def test_availability_rebuild_keeps_concurrent_inserts(self):
+        """Test if a user added while the filters are rebuilt is in the new filters"""
+
+        availability = UserAvailability()
+        availability.build([])
+
+        def rows():
+            yield "test_user", "testuser@validmail.com"
+            # Committed after the rows were read, the rebuild must not lose it
+            availability.add("concurrent", "concurrent@mail.com")
+
+        availability.build(rows())
+        self.assertEqual(availability.stats()["filters"]["username"]["values"], 2)
+
+    def test_availability_stats(self):
+
+        self.mock_user()
+        for index in range(50):
+            _ = self.client.get(f"/apis/v1/user/availability?username=free_name_{index}")
+
+        response = self.client.get("/apis/v1/user/availability/stats")
+        stats = response.json["availability"]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(stats["checks"], 50)
+        self.assertEqual(stats["definite_negatives"] + stats["false_positives"], 50)
+        self.assertGreater(stats["filters"]["username"]["memory_bytes"], 0)
+
+    def test_bloom_filter(self):
+        """Test if the added values are always found and the false positive rate is close to the configured one"""
+
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for index in range(1000):
+            bloom.add(f"user_{index}")
+
+        self.assertTrue(all(f"user_{index}" in bloom for index in range(1000)))
+
+        false_positives = sum(f"other_{index}" in bloom for index in range(10000))
+        self.assertLess(false_positives / 10000, 0.03)
+        self.assertLess(bloom.estimated_false_positive_rate(), 0.03)
 
     # login tests
 
@@ -184,6 +341,190 @@ class TestAuth(TestBase):
         self.assertEqual(
             response.json, {"message": "Logged out successfully", "status_code": 200})
 
+    # Password hashing tests
+    def test_login_rehashes_the_password_when_the_method_changes(self):
+
+        user = self.mock_user()
+        self.assertFalse(self.app.password_hasher.needs_rehash(user.password))
+
+        self.app.password_hasher.method = "pbkdf2:sha256:1000"
+        input_data = {"email": self.mock_user_data["email"], "password": self.mock_user_data["password"]}
+        response = self.client.post("/apis/v1/user/login", json=input_data)
+        self.assertEqual(response.status_code, 200)
+
+        self.assertTrue(user.password.startswith("pbkdf2:sha256:1000$"))
+        self.assertTrue(user.check_password(self.mock_user_data["password"]))
+
+    @parameterized.expand([
+        ("default_iterations", "pbkdf2:sha256", "pbkdf2:sha256:260000"),
+        ("default_hash", "pbkdf2", "pbkdf2:sha256:260000"),
+        ("full", "pbkdf2:sha512:1000", "pbkdf2:sha512:1000"),
+    ])
+    def test_partial_hash_method_does_not_rehash(self, _, method, expected):
+        """Test if a method without all its parameters matches the hashes it makes"""
+
+        hasher = PasswordHasher(method=method, workers=0)
+        self.assertEqual(hasher.method, expected)
+        self.assertFalse(hasher.needs_rehash(hasher.hash(self.mock_user_data["password"])))
+
+    def test_login_when_password_hasher_is_busy(self):
+
+        self.mock_user()
+        # No free slot in the pool, so the operation is rejected without starting any process
+        self.app.password_hasher = PasswordHasher(workers=1, timeout=0.01, max_pending=0)
+
+        input_data = {"email": self.mock_user_data["email"], "password": self.mock_user_data["password"]}
+        response = self.client.post("/apis/v1/user/login", json=input_data)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json, {"message": "Server busy, try again later", "status_code": 503})
+        self.assertEqual(response.headers["Retry-After"], "1")
+        self.assertEqual(self.app.password_hasher.stats()["rejected"], 1)
+
+    def test_password_hasher_process_pool(self):
+
+        hasher = PasswordHasher(method="pbkdf2:sha256:1000", workers=1)
+        self.addCleanup(hasher.shutdown)
+
+        pwhash = hasher.hash(self.mock_user_data["password"])
+
+        self.assertTrue(pwhash.startswith("pbkdf2:sha256:1000$"))
+        self.assertTrue(hasher.verify(pwhash, self.mock_user_data["password"]))
+        self.assertFalse(hasher.verify(pwhash, "wrongPassword"))
+        self.assertEqual(hasher.stats()["completed"], 3)
+
+    # Token tests
+    def token_login(self) -> str:
+        """Enable the token mode, login and return the token"""
+
+        self.app.token_manager = TokenManager(self.app.secret_key, max_age=60)
+        user = self.mock_user()
+        user.cart = Cart()
+        user.save()
+
+        input_data = {"email": self.mock_user_data["email"], "password": self.mock_user_data["password"]}
+        response = self.client.post("/apis/v1/user/login", json=input_data)
+        self.assertEqual(response.json["token_type"], "Bearer")
+        self.assertEqual(response.json["expires_in"], 60)
+        return response.json["token"]
+
+    def token_request(self, method: str, url: str, token: str):
+        """
+        Send a request with only the token, from a client without cookies
+        The test request context is popped meanwhile, so the request doesn't share ``g`` (and its user) with the test
+        """
+
+        self.app_context.pop()
+        try:
+            return self.app.test_client().open(url, method=method, headers={"Authorization": f"Bearer {token}"})
+        finally:
+            self.app_context = self.app.test_request_context()
+            self.app_context.push()
+
+    def test_login_without_token_mode(self):
+
+        self.mock_user()
+        input_data = {"email": self.mock_user_data["email"], "password": self.mock_user_data["password"]}
+        response = self.client.post("/apis/v1/user/login", json=input_data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("token", response.json)
+
+    def test_token_authentication(self):
+        """Test if a valid token authenticates the request without querying the users table"""
+
+        token = self.token_login()
+
+        with self.capture_statements() as statements:
+            response = self.token_request("GET", "/apis/v1/user/cart", token)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(any("FROM users" in statement for statement in statements))
+
+    @parameterized.expand([
+        ("tampered", lambda token: token[:-2] + ("AA" if token[-2:] != "AA" else "BB")),
+        ("not_a_token", lambda token: "not-a-token"),
+    ])
+    def test_token_authentication_with_invalid_token(self, _, change):
+
+        token = self.token_login()
+        response = self.token_request("GET", "/apis/v1/user/cart", change(token))
+
+        self.assertEqual(response.status_code, 401)
+
+    def test_token_authentication_with_expired_token(self):
+
+        token = self.token_login()
+        self.app.token_manager.max_age = -1
+
+        response = self.token_request("GET", "/apis/v1/user/cart", token)
+        self.assertEqual(response.status_code, 401)
+
+    def test_token_is_revoked_on_logout(self):
+
+        token = self.token_login()
+
+        response = self.token_request("POST", "/apis/v1/user/logout", token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.app.token_manager.stats()["revoked"], 1)
+
+        response = self.token_request("GET", "/apis/v1/user/cart", token)
+        self.assertEqual(response.status_code, 401)
+
+    def test_token_is_ignored_without_token_mode(self):
+
+        token = self.token_login()
+        self.app.token_manager = None
+
+        response = self.token_request("GET", "/apis/v1/user/cart", token)
+        self.assertEqual(response.status_code, 401)
+
+    # User cache tests
+    def test_load_user_uses_the_user_cache(self):
+        """Test if a cached user is loaded without querying the database"""
+
+        user = self.mock_user()
+        self.assertEqual(load_user(user.id).id, user.id)
+
+        # Forget the instances of the session, so the user can only come from the cache
+        self.app.db.session.expunge_all()
+
+        with self.capture_statements() as statements:
+            cached_user = load_user(str(user.id))
+            username, email = cached_user.username, cached_user.email
+
+        self.assertEqual(statements, [])
+        self.assertEqual((username, email), (self.mock_user_data["username"], self.mock_user_data["email"]))
+        self.assertEqual(self.app.user_cache.stats()["hits"], 1)
+
+        # The password hash isn't cached, it's loaded when needed
+        self.assertTrue(cached_user.check_password(self.mock_user_data["password"]))
+
+    def test_user_cache_is_invalidated_on_update(self):
+
+        user = self.mock_user()
+        user_id = user.id
+        load_user(user_id)
+
+        user.username = "renamed_user"
+        self.app.db.session.commit()
+        self.app.db.session.expunge_all()
+
+        self.assertEqual(load_user(user_id).username, "renamed_user")
+
+    def test_user_cache_is_invalidated_on_logout(self):
+
+        self.mock_login()
+        user_id = current_user.id
+        load_user(user_id)
+
+        _ = self.client.post("/apis/v1/user/logout")
+
+        self.assertEqual(len(self.app.user_cache), 0)
+        response = self.client.get("/apis/v1/user/cache_stats")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["user_cache"]["size"], 0)
+
     # Cart tests
     def test_add_to_cart_without_user_logged_in(self):
         """Test if the add to cart route return the correct message when the user is not logged in"""
@@ -364,3 +705,223 @@ class TestAuth(TestBase):
         response = self.client.get("/apis/v1/user/orders")
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.json["orders"]), 1)
+
+    def mock_orders(self, count: int) -> None:
+        """Login and checkout ``count`` orders, each one with one more unit of the mocked product"""
+
+        self.mock_login()
+        self.mock_product()
+
+        for _ in range(count):
+            _ = self.client.post("/apis/v1/user/cart/add-to-cart/1")
+            _ = self.client.post("/apis/v1/user/cart/checkout")
+
+    def test_get_orders_pagination(self):
+        """Test if the cursors walk through all the orders, the newest first, without repeating any"""
+
+        self.mock_orders(5)
+
+        # The first two orders have the same date, so the id breaks the tie
+        added_at = datetime.datetime(2023, 2, 12, 2, 30, 22)
+        for order in Order.query.all():
+            order.added_at = added_at + datetime.timedelta(minutes=max(order.id - 2, 0))
+        self.app.db.session.commit()
+
+        order_ids = []
+        response = self.client.get("/apis/v1/user/orders?limit=2")
+        for _ in range(5):
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.json["orders"]), 2)
+            order_ids += [order["id"] for order in response.json["orders"]]
+
+            if response.json["next_cursor"] is None:
+                break
+            response = self.client.get(f"/apis/v1/user/orders?limit=2&cursor={response.json['next_cursor']}")
+
+        self.assertEqual(order_ids, [5, 4, 3, 2, 1])
+
+    def test_get_orders_last_full_page_has_null_cursor(self):
+        """Test if a last page with exactly ``limit`` orders returns ``next_cursor: null``"""
+
+        self.mock_orders(4)
+
+        response = self.client.get("/apis/v1/user/orders?limit=2")
+        self.assertIsNotNone(response.json["next_cursor"])
+
+        response = self.client.get(f"/apis/v1/user/orders?limit=2&cursor={response.json['next_cursor']}")
+        self.assertEqual(len(response.json["orders"]), 2)
+        self.assertIsNone(response.json["next_cursor"])
+
+    def test_get_orders_summary(self):
+
+        self.mock_orders(2)
+
+        response = self.client.get("/apis/v1/user/orders?summary=true")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json["orders"]), 2)
+        for order in response.json["orders"]:
+            self.assertNotIn("products", order)
+            self.assertEqual(order["total_price"], self.mock_product_data["price"])
+
+    def test_get_orders_query_count(self):
+        """Test if the items of a page are loaded with a single query, instead of one query per order"""
+
+        self.mock_orders(4)
+
+        with self.capture_statements() as statements:
+            response = self.client.get("/apis/v1/user/orders")
+
+        self.assertEqual(len(response.json["orders"]), 4)
+        self.assertEqual(len([statement for statement in statements if "order_items" in statement]), 1)
+
+    def test_get_orders_keeps_the_price_paid(self):
+        """Test if the order history shows the price and quantity of the checkout, not the current product"""
+
+        self.mock_login()
+        product = self.mock_product()
+
+        _ = self.client.post("/apis/v1/user/cart/add-to-cart/1?quantity=2")
+        _ = self.client.post("/apis/v1/user/cart/checkout")
+
+        product.price = 99
+        product.name = "Renamed product"
+        self.app.db.session.commit()
+
+        response = self.client.get("/apis/v1/user/orders")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["orders"][0]["products"], [{
+            "id": 1,
+            "name": self.mock_product_data["name"],
+            "price": self.mock_product_data["price"],
+            "category": self.mock_product_data["category"],
+            "quantity": 2
+        }])
+
+    @parameterized.expand([
+        ("not_base64", "not-a-cursor"),
+        ("missing_id", tools.encode_cursor({"added_at": "2023-02-12T02:30:22"})),
+        ("invalid_date", tools.encode_cursor({"added_at": "yesterday", "id": 1})),
+    ])
+    def test_get_orders_with_invalid_cursor(self, _, cursor):
+
+        self.mock_login()
+        response = self.client.get(f"/apis/v1/user/orders?cursor={cursor}")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"message": "Invalid cursor", "status_code": 400})
+
+    def test_remove_from_cart_empties_cart(self):
+        """Test if the product removed from the cart is no longer listed"""
+
+        self.mock_login()
+        self.mock_product()
+        self.mock_product(name="Another product")
+
+        _ = self.client.post("/apis/v1/user/cart/add-to-cart/1")
+        _ = self.client.post("/apis/v1/user/cart/add-to-cart/2")
+        _ = self.client.post("/apis/v1/user/cart/remove-from-cart/1")
+
+        response = self.client.get("/apis/v1/user/cart")
+        self.assertEqual([product["id"] for product in response.json["products"]], [2])
+
+        # Removing it again fails, since it isn't in the cart anymore
+        response = self.client.post("/apis/v1/user/cart/remove-from-cart/1")
+        self.assertEqual(response.status_code, 404)
+
+    def test_cart_quantities(self):
+        """Test if adding the same product increments its quantity and removing decrements it"""
+
+        self.mock_login()
+        self.mock_product()
+
+        _ = self.client.post("/apis/v1/user/cart/add-to-cart/1")
+        _ = self.client.post("/apis/v1/user/cart/add-to-cart/1?quantity=4")
+
+        response = self.client.get("/apis/v1/user/cart")
+        self.assertEqual(len(response.json["products"]), 1)
+        self.assertEqual(response.json["products"][0]["quantity"], 5)
+        self.assertEqual(response.json["total_items"], 5)
+        self.assertEqual(response.json["total_price"], 5 * self.mock_product_data["price"] + 5 * 10)
+
+        _ = self.client.post("/apis/v1/user/cart/remove-from-cart/1?quantity=2")
+        response = self.client.get("/apis/v1/user/cart")
+        self.assertEqual(response.json["products"][0]["quantity"], 3)
+
+        _ = self.client.post("/apis/v1/user/cart/remove-from-cart/1?quantity=3")
+        response = self.client.get("/apis/v1/user/cart")
+        self.assertEqual(response.json["products"], [])
+
+    def test_add_to_cart_with_invalid_quantity(self):
+
+        self.mock_login()
+        self.mock_product()
+
+        for quantity in ("0", "-1", "abc", "1.5", ""):
+            response = self.client.post(f"/apis/v1/user/cart/add-to-cart/1?quantity={quantity}")
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json, {"message": "Invalid quantity", "status_code": 400})
+
+        # Above ``cart_max_quantity``, including values that would overflow the column
+        for quantity in (101, 3000000000):
+            response = self.client.post(f"/apis/v1/user/cart/add-to-cart/1?quantity={quantity}")
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json, {"message": "Invalid quantity, the max is 100", "status_code": 400})
+
+    def test_add_to_cart_caps_the_accumulated_quantity(self):
+        """Test if adding a product many times doesn't go over ``cart_max_quantity``"""
+
+        self.mock_login()
+        self.mock_product()
+
+        for _ in range(3):
+            response = self.client.post("/apis/v1/user/cart/add-to-cart/1?quantity=60")
+            self.assertEqual(response.status_code, 200)
+
+        response = self.client.get("/apis/v1/user/cart")
+        self.assertEqual(response.json["products"][0]["quantity"], 100)
+
+    @parameterized.expand([
+        ("paid_shipping", 25, 250),
+        ("free_shipping", 26, 0),
+    ])
+    def test_get_cart_totals(self, _, quantity, expected_shipping):
+        """Test if the cart totals computed by the database follow the shipping rule"""
+
+        self.mock_login()
+        self.mock_product()
+        self.mock_product(name="Another product", price=5)
+
+        _ = self.client.post(f"/apis/v1/user/cart/add-to-cart/1?quantity={quantity - 1}")
+        _ = self.client.post("/apis/v1/user/cart/add-to-cart/2")
+
+        response = self.client.get("/apis/v1/user/cart")
+        self.assertEqual(response.json["total_items"], quantity)
+        self.assertEqual(response.json["shipping_cost"], expected_shipping)
+        self.assertEqual(response.json["total_price"],
+                         (quantity - 1) * self.mock_product_data["price"] + 5 + expected_shipping)
+
+    def test_checkout_records_order_and_sales(self):
+        """Test if the checkout stores the order totals, its products and one sales record per line"""
+
+        self.mock_login()
+        self.mock_product()
+        self.mock_product(name="Another product", price=5)
+
+        _ = self.client.post("/apis/v1/user/cart/add-to-cart/1?quantity=3")
+        _ = self.client.post("/apis/v1/user/cart/add-to-cart/2")
+
+        response = self.client.post("/apis/v1/user/cart/checkout")
+        self.assertEqual(response.status_code, 200)
+
+        order = Order.query.one()
+        self.assertEqual(order.total_price, 3 * self.mock_product_data["price"] + 5)
+        self.assertEqual(order.shipping_cost, 40)
+        self.assertEqual(sorted(product.id for product in order.products), [1, 2])
+        self.assertEqual(SalesRecord.query.filter_by(product_id=1).one().quantity, 3)
+        self.assertEqual(SalesRecord.query.filter_by(product_id=2).one().quantity, 1)
+
+        # The cart is empty, a second checkout fails
+        response = self.client.post("/apis/v1/user/cart/checkout")
+        self.assertEqual(response.status_code, 400)